@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from peft import PeftModel
+
+# Requests for this name run on the bare base model
+BASE_ADAPTER = '__base__'
+
+
+class AdapterManager:
+    """Serve several LoRA adapters from one resident base model
+
+    Adapters load on first use and the least recently used idle one is
+    unloaded once more than ``max_adapters`` are resident, so every extra
+    variant costs its adapter weights instead of a full model copy.
+    ``locate_fn(name)`` returns the local directory of an adapter.
+    """
+
+    def __init__(self, base_model, names, locate_fn, max_adapters=4):
+        self.names = list(names)
+        self.default = self.names[0]
+        self.locate_fn = locate_fn
+        self.max_adapters = max(max_adapters, 1)
+        self.lock = threading.Lock()
+        self.in_use = Counter()
+        self.resident = OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+        # PEFT wraps the base model around a first adapter, the default one stays resident
+        self.model = PeftModel.from_pretrained(base_model, locate_fn(self.default), adapter_name=self.default)
+        self.model.eval()
+        self.resident[self.default] = 0.0
+
+    def resolve(self, name):
+        """Adapter name for a request, None when it is not served here"""
+        if name is None:
+            return self.default
+        if name == BASE_ADAPTER or name in self.names:
+            return name
+        return None
+
+    @contextmanager
+    def use(self, names):
+        """Keep ``names`` loaded while a forward pass or generate call uses them"""
+        names = set(names) - {BASE_ADAPTER}
+        with self.lock:
+            for name in names:
+                self._load(name)
+                self.in_use[name] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                for name in names:
+                    self.in_use[name] -= 1
+                self._evict()
+
+    def _load(self, name):
+        if name in self.resident:
+            self.resident.move_to_end(name)
+            return
+        start = time.perf_counter()
+        self.model.load_adapter(self.locate_fn(name), adapter_name=name)
+        self.model.eval()
+        self.resident[name] = time.perf_counter() - start
+        self.loads += 1
+        print(f"[API] Loaded adapter {name} in {self.resident[name]:.2f}s")
+
+    def _evict(self):
+        # Adapters still serving a batch stay until they are released
+        for name in list(self.resident):
+            if len(self.resident) <= self.max_adapters:
+                return
+            if name == self.default or self.in_use[name] > 0:
+                continue
+            self.model.delete_adapter(name)
+            del self.resident[name]
+            self.evictions += 1
+            print(f"[API] Unloaded adapter {name}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'default': self.default,
+                'available': self.names,
+                'resident': list(self.resident),
+                'max_adapters': self.max_adapters,
+                'loads': self.loads,
+                'evictions': self.evictions,
+            }
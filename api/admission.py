@@ -0,0 +1,169 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+# Lower values are served first
+PRIORITIES = {'interactive': 0, 'default': 1, 'batch': 2}
+
+
+class Rejected(Exception):
+    def __init__(self, status_code, detail, reason):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.reason = reason
+
+
+class CancelToken:
+    """Cooperative cancellation shared between a request handler and the model thread
+
+    Generation loops poll ``cancelled`` between decoding steps. It turns true
+    when the handler calls ``cancel`` (the client went away) or once the
+    request deadline has passed.
+    """
+
+    def __init__(self, timeout=None):
+        self.expires_at = time.monotonic() + timeout if timeout else None
+        self.event = threading.Event()
+        self.cancel_reason = None
+
+    def cancel(self, reason='disconnect'):
+        if not self.event.is_set():
+            self.cancel_reason = reason
+            self.event.set()
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    @property
+    def cancelled(self):
+        return self.event.is_set() or self.expired
+
+    @property
+    def reason(self):
+        if self.event.is_set():
+            return self.cancel_reason
+        return 'deadline' if self.expired else None
+
+
+class Slot:
+    def __init__(self, controller):
+        self.controller = controller
+        self.released = False
+
+    def release(self):
+        # Safe to call from every exit path of a request, only the first call counts
+        if not self.released:
+            self.released = True
+            self.controller._release()
+
+
+class AdmissionController:
+    """Bound the requests working on the model and the ones queued for it
+
+    At most ``max_inflight`` requests hold a slot. Up to ``max_queue`` more
+    wait for one, highest priority first and then in arrival order. When
+    the queue is full a newcomer is rejected with 429 unless it outranks
+    the newest lowest-priority waiter, which is rejected in its place. A
+    waiter whose deadline passes before it gets a slot fails with 503.
+    Requests waiting for the model to load are bounded the same way.
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, max_inflight, max_queue):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.inflight = 0
+        self.waiters = []
+        self.loading = 0
+        self.order = itertools.count()
+        self.admitted = 0
+        self.rejected = {'queue_full': 0, 'deadline': 0}
+
+    def waiting(self):
+        return len(self.waiters)
+
+    async def acquire(self, priority, token):
+        priority = PRIORITIES[priority]
+        if self.inflight < self.max_inflight and not self.waiters:
+            self.inflight += 1
+            self.admitted += 1
+            return Slot(self)
+        if len(self.waiters) >= self.max_queue:
+            worst = max(self.waiters, default=None)
+            if worst is None or worst[0] <= priority:
+                raise self._reject(429, "Server is busy, retry later", 'queue_full')
+            self._remove(worst)
+            worst[2].set_exception(self._reject(429, "Displaced by a higher-priority request", 'queue_full'))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.order), future)
+        heapq.heappush(self.waiters, entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), token.remaining())
+        except asyncio.TimeoutError:
+            self._leave(entry)
+            raise self._reject(503, "Deadline exceeded while waiting for the model", 'deadline')
+        except asyncio.CancelledError:
+            self._leave(entry)
+            raise
+        self.admitted += 1
+        return Slot(self)
+
+    async def wait_ready(self, ready, token):
+        """Wait for ``ready`` within the deadline, with at most ``max_queue`` requests waiting for it"""
+        if self.loading >= self.max_queue:
+            raise self._reject(429, "Model is loading, retry later", 'queue_full')
+        self.loading += 1
+        try:
+            # Shield the shared load from callers that give up while waiting
+            return await asyncio.wait_for(asyncio.shield(ready), token.remaining())
+        except asyncio.TimeoutError:
+            raise self._reject(503, "Deadline exceeded while the model loads", 'deadline')
+        finally:
+            self.loading -= 1
+
+    def _reject(self, status_code, detail, reason):
+        self.rejected[reason] += 1
+        return Rejected(status_code, detail, reason)
+
+    def _remove(self, entry):
+        self.waiters.remove(entry)
+        heapq.heapify(self.waiters)
+
+    def _leave(self, entry):
+        future = entry[2]
+        if not future.done():
+            self._remove(entry)
+            future.cancel()
+        elif not future.cancelled() and future.exception() is None:
+            # The slot was handed over just as the wait ended, pass it on
+            self._release()
+
+    def _release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                # The slot moves straight to the waiter, inflight stays the same
+                future.set_result(None)
+                return
+        self.inflight -= 1
+
+    def stats(self):
+        return {
+            'inflight': self.inflight,
+            'max_inflight': self.max_inflight,
+            'waiting': len(self.waiters),
+            'waiting_for_load': self.loading,
+            'max_queue': self.max_queue,
+            'admitted': self.admitted,
+            'rejected': dict(self.rejected),
+        }
@@ -1,14 +1,58 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from peft import AutoPeftModelForCausalLM
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from contextlib import nullcontext
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+import asyncio
 import os
-from transformers import pipeline, AutoTokenizer
-from utils.io import download_dir
+import socket
+import threading
+import time
+import torch
+from transformers import AutoTokenizer, DynamicCache, StoppingCriteriaList
+from utils.io import download_dir, is_download_complete, weights_version
 from utils.data_model import Message
+from api.batcher import MicroBatcher
+from api.streaming import AsyncTextStreamer, BatchStreamer, sse_event
+from api.kv_cache import PrefixKVCache, crop_cache
+from api.prompt import PromptBuilder, ASSISTANT_TAG
+from api.response_cache import ResponseCache, make_key
+from api.speculative import prompt_lookup_generate
+from api.generation import SamplingParams, StopSequences, StopOnSequences, StopOnCancel, FinishedRows
+from api.admission import AdmissionController, CancelToken, Rejected
+from api.sessions import open_session_store
+from api import metrics
+from api.engine import ContinuousBatchingEngine
+from api.loader import BackgroundLoader, load_merged, load_adapter_and_merge, load_int8, load_base, prepare_model, configure_threads, BACKENDS
+from api.adapters import AdapterManager, BASE_ADAPTER
+from utils.tiny_model import build_tiny_llama
 import re
 
 app = FastAPI(title="TinyLlama Chat API", version="1.0.0")
 
+class ReplicaHeaderMiddleware:
+    """Tag every response with the replica that served it
+
+    Plain ASGI rather than ``@app.middleware`` so streamed responses and
+    client-disconnect detection pass through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        async def send_with_replica(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', []), (b'x-replica', REPLICA_ID.encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_replica)
+
+app.add_middleware(ReplicaHeaderMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -20,43 +64,678 @@ app.add_middleware(
 
 MODEL_NAME = 'TinyLlama-1.1B-Chat-v1.2'
 MODEL_PATH = f'saved_models/{MODEL_NAME}'
+# Written once by components/exporter.py, loads without merging at startup
+MERGED_MODEL_PATH = f'saved_models/{MODEL_NAME}-merged'
+# Written by components/exporter.py --int8, loads without quantizing at startup
+INT8_MODEL_PATH = f'saved_models/{MODEL_NAME}-int8'
+BASE_TOKENIZER = 'TinyLlama/TinyLlama-1.1B-intermediate-step-1431k-3T'
 MAX_LENGTH = 2048
+MAX_NEW_TOKENS = int(os.environ.get('MAX_NEW_TOKENS', 256))
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 8))
+MAX_BATCH_WAIT_MS = float(os.environ.get('MAX_BATCH_WAIT_MS', 10))
+PREFIX_CACHE_MB = int(os.environ.get('PREFIX_CACHE_MB', 512))
+# 'batch' groups whole requests, 'continuous' schedules per decoding step over a paged KV cache
+SCHEDULER = os.environ.get('SCHEDULER', 'batch')
+KV_BLOCKS = int(os.environ.get('KV_BLOCKS', 1024))
+KV_BLOCK_SIZE = int(os.environ.get('KV_BLOCK_SIZE', 16))
+MAX_RUNNING = int(os.environ.get('MAX_RUNNING', 16))
+# Prompt-lookup speculative decoding, opted into per request
+PROMPT_LOOKUP_NGRAM = int(os.environ.get('PROMPT_LOOKUP_NGRAM', 3))
+PROMPT_LOOKUP_DRAFT = int(os.environ.get('PROMPT_LOOKUP_DRAFT', 8))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH') or None
+# Empty keeps sessions in memory, a path persists them locally, redis://host:port shares them
+SESSION_STORE = os.environ.get('SESSION_STORE', '')
+MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS', 10000))
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 3600))
+# Serve a tiny random-weight Llama instead of the fine-tuned model, for CPU testing
+TINY_RANDOM_MODEL = os.environ.get('TINY_RANDOM_MODEL', '0') == '1'
+# 'background' loads the model right after startup, 'lazy' waits for the first request
+LOAD_MODE = os.environ.get('LOAD_MODE', 'background')
+# 'auto' uses 8-bit bitsandbytes on a GPU, 'fp32' and 'int8' (dynamic quantization) run on the CPU
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'auto')
+TORCH_NUM_THREADS = int(os.environ.get('TORCH_NUM_THREADS', 0))
+TORCH_INTEROP_THREADS = int(os.environ.get('TORCH_INTEROP_THREADS', 0))
+if INFERENCE_BACKEND not in BACKENDS:
+    raise ValueError(f"INFERENCE_BACKEND must be one of {BACKENDS}, got {INFERENCE_BACKEND!r}")
 
-if not os.path.exists(MODEL_PATH):
-    download_dir('saved_models', MODEL_NAME)
-    
-model = AutoPeftModelForCausalLM.from_pretrained(
-    MODEL_PATH,
-    device_map='auto',
-    load_in_8bit=True,
-)
+# Comma-separated adapter names under saved_models served on one unmerged base model, the first is the default
+ADAPTERS = [name.strip() for name in os.environ.get('ADAPTERS', '').split(',') if name.strip()]
+MAX_ADAPTERS = int(os.environ.get('MAX_ADAPTERS', 4))
+
+# Requests allowed to work on the model at once, 0 matches what the scheduler runs together
+MAX_INFLIGHT = int(os.environ.get('MAX_INFLIGHT', 0)) or (MAX_RUNNING if SCHEDULER == 'continuous' else MAX_BATCH_SIZE)
+# Requests waiting for a slot before new ones get 429
+MAX_QUEUE = int(os.environ.get('MAX_QUEUE', 64))
+# Default and longest per-request deadline in seconds, below the proxy and client timeouts
+REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 120))
+RETRY_AFTER_SECONDS = 1
+# Name returned in the X-Replica header, to tell replicas apart behind the load balancer
+REPLICA_ID = os.environ.get('REPLICA_ID') or socket.gethostname()
+# Header nginx hashes to pin a conversation to one replica, also accepted as the id of a new session
+CONVERSATION_HEADER = 'X-Conversation-ID'
+CONVERSATION_ID = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+DISCONNECT_POLL_SECONDS = 0.25
+
+configure_threads(TORCH_NUM_THREADS, TORCH_INTEROP_THREADS)
+
+tokenizer = None
+merged_model = None
+prompt_builder = None
+engine = None
+adapter_manager = None
+# Backend, weights and their version, part of every response-cache key
+model_identity = None
+adapter_versions = {}
+download_lock = threading.Lock()
+
+def locate_adapter(name):
+    path = os.path.join('saved_models', name)
+    with download_lock:
+        # A crashed download leaves the directory behind without its completion marker
+        if not is_download_complete(path):
+            download_dir('saved_models', name)
+            adapter_versions.pop(name, None)
+        if name not in adapter_versions:
+            adapter_versions[name] = weights_version(path)
+    return path
+
+def locate_merged():
+    """Merged export of MODEL_NAME, fetched from S3 when it is not on disk, None if none was pushed"""
+    if is_download_complete(MERGED_MODEL_PATH):
+        return MERGED_MODEL_PATH
+    try:
+        download_dir('saved_models', f'{MODEL_NAME}-merged')
+    except Exception as e:
+        print(f"[API] No merged export of {MODEL_NAME} available ({e}), merging the adapter instead")
+        return None
+    return MERGED_MODEL_PATH
+
+def load_model():
+    global tokenizer, merged_model, prompt_builder, engine, adapter_manager, model_identity
+    if ADAPTERS:
+        tokenizer = AutoTokenizer.from_pretrained(BASE_TOKENIZER, trust_remote_code=True)
+        adapter_manager = AdapterManager(
+            load_base(BASE_TOKENIZER, INFERENCE_BACKEND), ADAPTERS, locate_adapter, max_adapters=MAX_ADAPTERS)
+        # Adapters stay unmerged, requests pick theirs per forward pass
+        model = adapter_manager.model
+        weights = BASE_TOKENIZER
+    elif not TINY_RANDOM_MODEL and INFERENCE_BACKEND == 'int8' and os.path.exists(INT8_MODEL_PATH):
+        tokenizer = AutoTokenizer.from_pretrained(INT8_MODEL_PATH)
+        model = load_int8(INT8_MODEL_PATH)
+        weights = f'{MODEL_NAME}-int8@{weights_version(INT8_MODEL_PATH)}'
+    elif not TINY_RANDOM_MODEL and locate_merged() is not None:
+        tokenizer = AutoTokenizer.from_pretrained(MERGED_MODEL_PATH)
+        model = load_merged(MERGED_MODEL_PATH, INFERENCE_BACKEND)
+        weights = f'{MODEL_NAME}-merged@{weights_version(MERGED_MODEL_PATH)}'
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(BASE_TOKENIZER, trust_remote_code=True)
+        if TINY_RANDOM_MODEL:
+            model = prepare_model(build_tiny_llama(len(tokenizer)), INFERENCE_BACKEND)
+            weights = 'tiny-random'
+        else:
+            # A crashed download leaves the directory behind without its completion marker
+            if not is_download_complete(MODEL_PATH):
+                download_dir('saved_models', MODEL_NAME)
+            model = load_adapter_and_merge(MODEL_PATH, INFERENCE_BACKEND)
+            weights = f'{MODEL_NAME}@{weights_version(MODEL_PATH)}'
+    model_identity = f'{INFERENCE_BACKEND}:{weights}'
+    print(f"[API] Serving with the {INFERENCE_BACKEND} backend")
+    tokenizer.pad_token = '<PAD>'
+    tokenizer.padding_side = 'left'
+
+    # Leave room for the answer inside the context window
+    prompt_builder = PromptBuilder(tokenizer, MAX_LENGTH, reserve_tokens=MAX_NEW_TOKENS)
+    if SCHEDULER == 'continuous':
+        engine = ContinuousBatchingEngine(
+            model,
+            eos_token_id=tokenizer.eos_token_id,
+            num_blocks=KV_BLOCKS,
+            block_size=KV_BLOCK_SIZE,
+            max_running=MAX_RUNNING,
+            max_new_tokens=MAX_NEW_TOKENS,
+            max_model_len=MAX_LENGTH,
+            adapters=adapter_manager,
+        )
+        engine.start()
+    merged_model = model
+
+loader = BackgroundLoader(load_model)
 
-merged_model = model.merge_and_unload()
+async def ensure_ready(cancel):
+    """Wait for the model, failing with 429 when MAX_QUEUE requests already wait for it or 503 past the deadline"""
+    loader.start()
+    try:
+        if not loader.future.done():
+            await admission.wait_ready(asyncio.wrap_future(loader.future), cancel)
+        loader.future.result()
+    except Rejected as e:
+        raise rejection(e)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Model failed to load: {e}")
 
-tokenizer = AutoTokenizer.from_pretrained('TinyLlama/TinyLlama-1.1B-intermediate-step-1431k-3T', trust_remote_code=True)
-tokenizer.pad_token = '<PAD>'
-tokenizer.padding_size = 'left'
+async def resolve_adapter(name):
+    """Adapter serving a request, None when a single merged model is served"""
+    if adapter_manager is None:
+        if name not in (None, MODEL_NAME):
+            raise HTTPException(status_code=400, detail="Adapter selection needs ADAPTERS to be configured")
+        return None
+    adapter = adapter_manager.resolve(name)
+    if adapter is None:
+        raise HTTPException(status_code=404, detail=f"Unknown adapter {name!r}")
+    if adapter != BASE_ADAPTER:
+        # Fetch from S3 off the model thread, loading into the model happens on first use
+        await asyncio.get_running_loop().run_in_executor(None, locate_adapter, adapter)
+    return adapter
 
-pipe = pipeline('text-generation', model=merged_model, tokenizer=tokenizer)
+def using_adapters(adapters):
+    return adapter_manager.use(adapters) if adapter_manager is not None else nullcontext()
+
+def adapter_kwargs(adapters):
+    """PEFT mixed-adapter batch argument, nothing for a merged model"""
+    return {'adapter_names': list(adapters)} if adapter_manager is not None else {}
+
+def log_truncation(prompt_ids, truncated):
+    if truncated:
+        metrics.PROMPT_TRUNCATIONS.inc()
+        print(f"[API] Prompt truncated to {len(prompt_ids)} tokens")
 
 def get_full_prompt(conversation_history):
-    prompt = "\n".join(conversation_history) + "\n<|assistant|>\n"
-    tokens = tokenizer.encode(prompt, add_special_tokens=False)
-    if len(tokens) > MAX_LENGTH:
-        tokens = tokens[-MAX_LENGTH:]
-    trimmed_prompt = tokenizer.decode(tokens, skip_special_tokens=True)
-    return trimmed_prompt
+    prompt_ids, truncated = prompt_builder.build(conversation_history)
+    log_truncation(prompt_ids, truncated)
+    return prompt_ids
+
+sessions = open_session_store(SESSION_STORE, MAX_SESSIONS, SESSION_TTL, max_tokens=MAX_LENGTH)
+
+def encode_turns(messages):
+    return [
+        {'role': 'assistant' if message.startswith(ASSISTANT_TAG) else 'user', 'ids': prompt_builder.encode_message(message)}
+        for message in messages
+    ]
+
+def build_prompt(data):
+    """Prompt ids for a request and its new turns, None turns when the request has no session"""
+    if data.session_id is None:
+        return get_full_prompt(data.content), None
+    history = sessions.get(data.session_id)
+    if history is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    new_turns = encode_turns(data.content)
+    turns = history + new_turns
+    prompt_ids, truncated = prompt_builder.build_pieces(
+        [turn['ids'] for turn in turns], [turn['role'] == 'assistant' for turn in turns])
+    log_truncation(prompt_ids, truncated)
+    return prompt_ids, new_turns
+
+def record_turns(data, new_turns, completion_ids):
+    if new_turns is None:
+        return
+    if completion_ids and completion_ids[-1] == tokenizer.eos_token_id:
+        completion_ids = completion_ids[:-1]
+    # Store the answer exactly as the model saw it so the next turn extends the cached prefix
+    answer = {'role': 'assistant', 'ids': prompt_builder.suffix_ids + completion_ids}
+    if not sessions.append(data.session_id, new_turns + [answer]):
+        print(f"[API] Session {data.session_id} was deleted or expired during generation, its turn is not kept")
+
+def sampling_params(data):
+    """Decoding settings of a request, never generating more than MAX_NEW_TOKENS"""
+    return SamplingParams(
+        min(data.max_new_tokens or MAX_NEW_TOKENS, MAX_NEW_TOKENS),
+        temperature=data.temperature,
+        top_p=data.top_p,
+        stop=data.stop,
+    )
+
+def stop_sequences(params):
+    return StopSequences(tokenizer, params.stop)
+
+def finish_reason(completion_ids, params, cancel=None):
+    if len(completion_ids) >= params.max_new_tokens:
+        return 'length'
+    if completion_ids and completion_ids[-1] == tokenizer.eos_token_id:
+        return 'stop'
+    if cancel is not None and cancel.reason == 'deadline':
+        return 'deadline'
+    return 'stop'
+
+def usage(prompt_ids, completion_ids):
+    return {
+        'prompt_tokens': len(prompt_ids),
+        'completion_tokens': len(completion_ids),
+        'total_tokens': len(prompt_ids) + len(completion_ids),
+    }
+
+prefix_cache = PrefixKVCache(PREFIX_CACHE_MB * 1024 * 1024)
+
+def generate_one(prompt_ids, params, streamer=None, adapter=None, cancel=None):
+    input_ids = torch.tensor([prompt_ids], device=merged_model.device)
+    # Only the part of the prompt past the cached prefix gets prefilled
+    cached_length, past_key_values = prefix_cache.lookup(prompt_ids, namespace=adapter)
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+    # Stop as soon as the answer reaches a role tag instead of inventing the next turns
+    stopping = StoppingCriteriaList([
+        StopOnSequences([stop_sequences(params)], [params.max_new_tokens], len(prompt_ids)),
+        StopOnCancel([cancel]),
+    ])
+    with torch.no_grad(), using_adapters([adapter]):
+        outputs = merged_model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            max_new_tokens=params.max_new_tokens,
+            pad_token_id=tokenizer.pad_token_id,
+            streamer=streamer,
+            stopping_criteria=stopping,
+            **params.generate_kwargs(),
+            **adapter_kwargs([adapter]),
+        )
+    # The cache covers every token except the last generated one
+    sequence = outputs[0].tolist()
+    prefix_cache.store(sequence[:-1], past_key_values, boundaries=(len(prompt_ids),), namespace=adapter)
+    return outputs
+
+def trim_completion(token_ids):
+    # Finished rows of a batch are padded up to the longest one
+    if tokenizer.eos_token_id in token_ids:
+        return token_ids[:token_ids.index(tokenizer.eos_token_id) + 1]
+    # Rows cancelled mid-batch are padded without an EOS
+    while token_ids and token_ids[-1] == tokenizer.pad_token_id:
+        token_ids = token_ids[:-1]
+    return token_ids
+
+def generate_group(requests):
+    """Generated token ids for (prompt_ids, adapter, params, cancel, streamer) requests that decode the same way"""
+    prompts, adapters, params, cancels, streamers = zip(*requests)
+    stops = [stop_sequences(p) for p in params]
+    limits = [p.max_new_tokens for p in params]
+    inputs = tokenizer.pad({'input_ids': list(prompts)}, padding=True, return_tensors='pt').to(merged_model.device)
+    width = inputs['input_ids'].shape[1]
+    # Every row stops at its own limit, stop strings or cancellation, the call ends when the last one does
+    finished = FinishedRows([StopOnSequences(stops, limits, width), StopOnCancel(cancels)], len(requests))
+    streamer = None
+    if any(s is not None for s in streamers):
+        # Streams share the call with the other rows, each gets its own tokens as they are decoded
+        streamer = BatchStreamer(streamers, finished.finished_at, tokenizer.eos_token_id)
+    # Requests for different adapters share one generate call as a mixed-adapter batch
+    with torch.no_grad(), using_adapters(adapters):
+        outputs = merged_model.generate(
+            **inputs,
+            max_new_tokens=max(limits),
+            pad_token_id=tokenizer.pad_token_id,
+            stopping_criteria=StoppingCriteriaList([finished]),
+            streamer=streamer,
+            **params[0].generate_kwargs(),
+            **adapter_kwargs(adapters),
+        )
+    return [
+        stop.truncate(trim_completion(row[width:].tolist()))[:limit]
+        for row, stop, limit in zip(outputs, stops, limits)
+    ]
+
+def generate_requests(requests):
+    results = [None] * len(requests)
+    # Requests cancelled while queued never reach the model
+    live = [i for i, (_, _, _, cancel, _) in enumerate(requests) if not cancel.cancelled]
+    for i in set(range(len(requests))) - set(live):
+        results[i] = []
+        if requests[i][4] is not None:
+            requests[i][4].end()
+    # Prefix reuse needs per-sequence caches, so it only applies to a batch of one
+    if len(live) == 1:
+        prompt_ids, adapter, params, cancel, streamer = requests[live[0]]
+        outputs = generate_one(prompt_ids, params, streamer=streamer, adapter=adapter, cancel=cancel)
+        results[live[0]] = stop_sequences(params).truncate(outputs[0, len(prompt_ids):].tolist())
+        return results
+    # generate takes one set of sampling settings, so requests are split by them
+    groups = {}
+    for i in live:
+        groups.setdefault(tuple(sorted(requests[i][2].generate_kwargs().items())), []).append(i)
+    for indices in groups.values():
+        for i, completion_ids in zip(indices, generate_group([requests[i] for i in indices])):
+            results[i] = completion_ids
+    return results
+
+def generate_alone(request, error):
+    """Generated ids of one request of a failed batch, or the error to fail it with"""
+    streamer = request[4]
+    # A stream that already sent text cannot be replayed
+    if streamer is not None and not streamer.restart():
+        streamer.end()
+        return error
+    try:
+        return generate_requests([request])[0]
+    except Exception as e:
+        if streamer is not None:
+            streamer.end()
+        return e
+
+def generate_batch(requests):
+    """Token ids, or the error it failed with, for each (prompt_ids, adapter, params, cancel, streamer) request"""
+    try:
+        return generate_requests(requests)
+    except Exception as e:
+        if len(requests) > 1:
+            # One bad request must not fail the others, run each on its own to find it
+            print(f"[API] Batch of {len(requests)} failed ({e!r}), generating its requests one at a time")
+            return [generate_alone(request, e) for request in requests]
+        # Unblock the stream waiting on this request before surfacing the error
+        if requests[0][4] is not None:
+            requests[0][4].end()
+        raise
+
+def generate_speculative(prompt_ids, params, streamer=None, adapter=None, cancel=None):
+    cached_length, past_key_values = prefix_cache.lookup(prompt_ids, namespace=adapter)
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+    try:
+        with torch.no_grad(), using_adapters([adapter]):
+            completion_ids, stats = prompt_lookup_generate(
+                merged_model,
+                prompt_ids,
+                past_key_values,
+                cached_length,
+                max_new_tokens=params.max_new_tokens,
+                eos_token_id=tokenizer.eos_token_id,
+                max_ngram=PROMPT_LOOKUP_NGRAM,
+                num_draft=PROMPT_LOOKUP_DRAFT,
+                streamer=streamer,
+                model_kwargs=adapter_kwargs([adapter]),
+                stop=stop_sequences(params),
+                cancel=cancel,
+            )
+    except Exception:
+        if streamer is not None:
+            streamer.end()
+        raise
+    # Keep only cache entries that belong to the returned tokens
+    sequence = prompt_ids + completion_ids
+    valid_length = min(past_key_values.get_seq_length(), len(sequence) - 1)
+    crop_cache(past_key_values, valid_length)
+    prefix_cache.store(sequence[:valid_length], past_key_values, boundaries=(len(prompt_ids),), namespace=adapter)
+    metrics.SPECULATIVE_ACCEPTANCE.observe(stats['acceptance_rate'])
+    print(f"[API] Speculative decoding accepted {stats['accepted_tokens']}/{stats['drafted_tokens']} "
+          f"drafted tokens, estimated speedup {stats['estimated_speedup']:.2f}x")
+    return completion_ids, stats
+
+batcher = MicroBatcher(generate_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_BATCH_WAIT_MS)
+
+@app.on_event("startup")
+async def start_scheduler():
+    await batcher.start()
+    if LOAD_MODE == 'background':
+        loader.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    if engine is not None:
+        engine.stop()
+    await batcher.stop()
+    response_cache.close()
+    sessions.close()
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_PATH)
+
+admission = AdmissionController(MAX_INFLIGHT, MAX_QUEUE)
+
+def request_deadline(data):
+    return CancelToken(min(data.timeout or REQUEST_TIMEOUT, REQUEST_TIMEOUT))
+
+def rejection(e):
+    metrics.REJECTED.labels(e.reason).inc()
+    headers = {'Retry-After': str(RETRY_AFTER_SECONDS)} if e.status_code == 429 else None
+    return HTTPException(status_code=e.status_code, detail=e.detail, headers=headers)
+
+async def admit(data, cancel):
+    """Wait for a model slot, failing fast with 429 when the queue is full or 503 past the deadline"""
+    start = time.perf_counter()
+    try:
+        slot = await admission.acquire(data.priority, cancel)
+    except Rejected as e:
+        raise rejection(e)
+    metrics.ADMISSION_WAIT.observe(time.perf_counter() - start)
+    return slot
+
+async def watch_disconnect(request, cancel):
+    """Cancel the generation as soon as the client goes away"""
+    while not cancel.cancelled:
+        if await request.is_disconnected():
+            cancel.cancel('disconnect')
+            return
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+def observe_cancel(cancel):
+    if cancel.reason is not None:
+        metrics.CANCELLED.labels(cancel.reason).inc()
+        print(f"[API] Generation stopped early: {cancel.reason}")
+
+def generation_params(params, adapter=None):
+    # A new push, backend or model changes the key, so a persisted cache never answers for other weights
+    model = model_identity
+    if adapter is not None:
+        model = f"{model}+{adapter}@{adapter_versions.get(adapter, '')}"
+    return {'model': model, **params.to_dict(), 'do_sample': params.do_sample}
+
+def cache_key(data, prompt_ids, params, adapter=None):
+    """Key for the response cache, None when the request must not be cached"""
+    params = generation_params(params, adapter)
+    # Sampled outputs are not reproducible, caching them would freeze one draw
+    if not data.use_cache or params['do_sample']:
+        return None
+    return make_key(prompt_ids, params)
+
+async def generate_completion(prompt_ids, params, adapter=None, cancel=None):
+    if engine is not None:
+        sequence = await engine.submit(
+            prompt_ids, adapter=adapter, params=params, stop=stop_sequences(params), cancel=cancel)
+        return sequence[len(prompt_ids):]
+    return await batcher.submit((prompt_ids, adapter, params, cancel, None))
+
+def start_stream(prompt_ids, streamer, params, speculative=False, adapter=None, cancel=None):
+    loop = asyncio.get_running_loop()
+    if speculative:
+        return loop.run_in_executor(
+            batcher.executor, generate_speculative, prompt_ids, params, streamer, adapter, cancel)
+    if engine is not None:
+        return asyncio.wrap_future(engine.add_request(
+            prompt_ids, streamer=streamer, adapter=adapter, params=params, stop=stop_sequences(params),
+            cancel=cancel))
+    # Streams are batched with each other and with non-streaming requests
+    return asyncio.ensure_future(batcher.submit((prompt_ids, adapter, params, cancel, streamer)))
 
 @app.post("/api/v1/conversation")
-async def conversation_endpoint(data: Message):
-    conversation_history = data.content
-    full_prompt = get_full_prompt(conversation_history)
-    response = pipe(full_prompt)
-    assistant_message = response[0]['generated_text']
-    return {"response": assistant_message}
-
-@app.delete("/api/v1/conversation")
-async def clear_conversation():
-    global conversation_history
-    conversation_history = []
+async def conversation_endpoint(data: Message, request: Request):
+    start = time.perf_counter()
+    cancel = request_deadline(data)
+    await ensure_ready(cancel)
+    adapter = await resolve_adapter(data.adapter)
+    params = sampling_params(data)
+    prompt_ids, new_turns = build_prompt(data)
+    key = cache_key(data, prompt_ids, params, adapter)
+    completion_ids = response_cache.get(key) if key else None
+    speculative_stats = None
+    if completion_ids is None:
+        slot = await admit(data, cancel)
+        watcher = asyncio.create_task(watch_disconnect(request, cancel))
+        try:
+            # Prompt lookup verifies drafts against the argmax, so it only applies to greedy decoding
+            if data.speculative and not params.do_sample:
+                loop = asyncio.get_running_loop()
+                completion_ids, speculative_stats = await loop.run_in_executor(
+                    batcher.executor, generate_speculative, prompt_ids, params, None, adapter, cancel)
+            else:
+                completion_ids = await generate_completion(prompt_ids, params, adapter, cancel)
+        except Exception:
+            metrics.REQUESTS.labels('conversation', 'error').inc()
+            raise
+        finally:
+            watcher.cancel()
+            slot.release()
+        observe_cancel(cancel)
+        if cancel.reason == 'disconnect':
+            # Nobody is left to read the answer
+            return Response(status_code=499)
+        # A cut-short answer is not what the prompt deterministically produces
+        if key and cancel.reason is None:
+            response_cache.put(key, completion_ids)
+    else:
+        metrics.RESPONSE_CACHE_HITS.inc()
+    record_turns(data, new_turns, completion_ids)
+    metrics.observe_generation('conversation', time.perf_counter() - start, len(prompt_ids), len(completion_ids))
+    # Only the new answer goes back, the client already has the conversation
+    assistant_message = tokenizer.decode(completion_ids, skip_special_tokens=True).strip()
+    body = {
+        "response": assistant_message,
+        "finish_reason": finish_reason(completion_ids, params, cancel),
+        "usage": usage(prompt_ids, completion_ids),
+    }
+    if data.session_id is not None:
+        body["session_id"] = data.session_id
+    if speculative_stats is not None:
+        body["speculative"] = speculative_stats
+    return body
+
+@app.post("/api/v1/conversation/stream")
+async def conversation_stream_endpoint(data: Message):
+    start = time.perf_counter()
+    cancel = request_deadline(data)
+    await ensure_ready(cancel)
+    adapter = await resolve_adapter(data.adapter)
+    params = sampling_params(data)
+    prompt_ids, new_turns = build_prompt(data)
+    key = cache_key(data, prompt_ids, params, adapter)
+    cached_ids = response_cache.get(key) if key else None
+    if cached_ids is not None:
+        metrics.RESPONSE_CACHE_HITS.inc()
+
+        async def cached_events():
+            yield sse_event({"token": tokenizer.decode(cached_ids, skip_special_tokens=True)})
+            record_turns(data, new_turns, cached_ids)
+            latency = time.perf_counter() - start
+            metrics.observe_generation('stream', latency, len(prompt_ids), len(cached_ids), ttft=latency)
+            yield sse_event({
+                "ttft": latency,
+                "latency": latency,
+                "generated_tokens": len(cached_ids),
+                "cached": True,
+                "session_id": data.session_id,
+                "finish_reason": finish_reason(cached_ids, params),
+                "usage": usage(prompt_ids, cached_ids),
+            }, event="done")
+        return StreamingResponse(
+            cached_events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    # Admit before the response starts so a rejection is still a plain 429/503
+    slot = await admit(data, cancel)
+    speculative = data.speculative and not params.do_sample
+    streamer = AsyncTextStreamer(
+        tokenizer, asyncio.get_running_loop(), stop_strings=params.stop, skip_special_tokens=True)
+    generation = start_stream(prompt_ids, streamer, params, speculative=speculative, adapter=adapter, cancel=cancel)
+    # Also frees the slot when the client is gone before the stream body ever starts
+    generation.add_done_callback(lambda _: slot.release())
+
+    async def events():
+        finished = False
+        try:
+            async for text in streamer:
+                yield sse_event({"token": text})
+            try:
+                outcome = await generation
+            except Exception as e:
+                finished = True
+                metrics.REQUESTS.labels('stream', 'error').inc()
+                yield sse_event({"error": str(e)}, event="error")
+                return
+            finished = True
+        finally:
+            # Leaving early means the client disconnected, stop generating for it
+            if not finished:
+                cancel.cancel('disconnect')
+                observe_cancel(cancel)
+            slot.release()
+        observe_cancel(cancel)
+        # The streamer saw the tokens of a stop string before generation ended on it
+        completion_ids = stop_sequences(params).truncate(trim_completion(streamer.token_ids))
+        if key and cancel.reason is None:
+            response_cache.put(key, completion_ids)
+        record_turns(data, new_turns, completion_ids)
+        end = time.perf_counter()
+        ttft = streamer.first_token_time - start if streamer.first_token_time else None
+        metrics.observe_generation('stream', end - start, len(prompt_ids), len(completion_ids), ttft=ttft)
+        print(f"[API] Streamed {len(completion_ids)} tokens, ttft={ttft}s, latency={end - start:.3f}s")
+        done = {
+            "ttft": ttft,
+            "latency": end - start,
+            "generated_tokens": len(completion_ids),
+            "cached": False,
+            "session_id": data.session_id,
+            "finish_reason": finish_reason(completion_ids, params, cancel),
+            "usage": usage(prompt_ids, completion_ids),
+        }
+        if speculative:
+            done["speculative"] = outcome[1]
+        yield sse_event(done, event="done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def queue_depth():
+    if engine is not None:
+        return len(engine.waiting) + admission.waiting()
+    return batcher.qsize() + admission.waiting()
+
+metrics.QUEUE_DEPTH.set_function(queue_depth)
+metrics.MODEL_READY.set_function(lambda: 1 if loader.ready else 0)
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/readyz")
+async def readyz():
+    status = loader.status()
+    body = {"status": status, "load_seconds": loader.load_seconds}
+    return JSONResponse(body, status_code=200 if status == 'ready' else 503)
+
+@app.get("/api/v1/engine/stats")
+async def engine_stats():
+    stats = {
+        "scheduler": SCHEDULER,
+        "admission": admission.stats(),
+        "response_cache": response_cache.stats(),
+        "sessions": sessions.stats(),
+    }
+    if adapter_manager is not None:
+        stats["adapters"] = adapter_manager.stats()
+    if engine is None:
+        return {**stats, "waiting": batcher.qsize()}
+    return {**stats, **engine.stats()}
+
+@app.post("/api/v1/sessions")
+async def create_session(request: Request):
+    # Behind several replicas the client names the session up front, so creating it
+    # lands on the same replica that its turns will be routed to
+    session_id = request.headers.get(CONVERSATION_HEADER)
+    if session_id is not None and not CONVERSATION_ID.match(session_id):
+        raise HTTPException(status_code=400, detail=f"{CONVERSATION_HEADER} must be 8-64 letters, digits, - or _")
+    session_id = sessions.create(session_id)
+    if session_id is None:
+        raise HTTPException(status_code=409, detail="Session already exists")
+    return {"session_id": session_id}
+
+@app.delete("/api/v1/conversation/{session_id}")
+async def clear_conversation(session_id: str):
+    if not sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
     return {"message": "Conversation cleared", "status": "success"}
\ No newline at end of file
@@ -0,0 +1,77 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MicroBatcher:
+    """Group requests that arrive within a short window into one generate call
+
+    ``generate_fn`` returns one result per prompt. An exception in place of
+    a result fails only that request, raising fails the whole batch.
+    """
+
+    def __init__(self, generate_fn, max_batch_size=8, max_wait_ms=10):
+        self.generate_fn = generate_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # A single model thread keeps generate calls from running concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='generate')
+        self.queue = None
+        self.worker = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=False)
+
+    def qsize(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def submit(self, prompt):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((prompt, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Drop requests whose caller has already gone away
+        return [(prompt, future) for prompt, future in batch if not future.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            prompts = [prompt for prompt, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.generate_fn, prompts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
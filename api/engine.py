@@ -0,0 +1,422 @@
+import asyncio
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import torch
+from transformers import DynamicCache
+from api.generation import sample_tokens
+from api.kv_cache import cache_layers
+
+
+class BlockPool:
+    """Preallocated KV memory split into fixed-size blocks shared by all sequences
+
+    Each layer's keys and values are one ``[heads, num_blocks * block_size,
+    head_dim]`` tensor allocated up front, so memory is bounded by
+    ``num_blocks`` and a sequence only holds a block table into it. A new
+    sequence is placed in the middle of the largest free run and grows into
+    the block after its last one, so sequences tend to stay one run, whose
+    history is then read as a view instead of being gathered.
+    """
+
+    def __init__(self, num_blocks, block_size, num_layers, num_heads, head_dim, dtype=torch.float32, device='cpu'):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.device = torch.device(device)
+        self.free_blocks = set(range(num_blocks))
+        shape = (num_heads, num_blocks * block_size, head_dim)
+        self.keys = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.values = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+
+    @classmethod
+    def for_model(cls, model, num_blocks, block_size):
+        config = model.config
+        num_heads = getattr(config, 'num_key_value_heads', None) or config.num_attention_heads
+        head_dim = getattr(config, 'head_dim', None) or config.hidden_size // config.num_attention_heads
+        # Quantized linears keep float embeddings, which is the dtype attention runs in
+        dtype = model.get_input_embeddings().weight.dtype
+        return cls(num_blocks, block_size, config.num_hidden_layers, num_heads, head_dim, dtype, model.device)
+
+    def allocate(self, after=None):
+        """A free block, preferably the one right after block ``after``"""
+        if not self.free_blocks:
+            return None
+        if after is not None and after + 1 in self.free_blocks:
+            block = after + 1
+        else:
+            block = min(self.free_blocks)
+        self.free_blocks.remove(block)
+        return block
+
+    def allocate_run(self, num_blocks):
+        """``num_blocks`` free blocks, consecutive when the largest free run has room"""
+        if num_blocks > len(self.free_blocks):
+            return None
+        start, length, best = None, 0, (0, 0)
+        for block in sorted(self.free_blocks):
+            if start is not None and block == start + length:
+                length += 1
+            else:
+                start, length = block, 1
+            best = max(best, (length, start))
+        length, start = best
+        if length < num_blocks:
+            return [self.allocate() for _ in range(num_blocks)]
+        # Leave the room on either side for this sequence and the one before it to grow into
+        start += (length - num_blocks) // 2
+        blocks = list(range(start, start + num_blocks))
+        self.free_blocks.difference_update(blocks)
+        return blocks
+
+    def free(self, blocks):
+        self.free_blocks.update(blocks)
+
+    def num_free(self):
+        return len(self.free_blocks)
+
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.keys + self.values)
+
+    def index(self, block_table, start, end):
+        """Pool positions of tokens ``start:end`` of a sequence, a slice when its blocks there are one run"""
+        block_size = self.block_size
+        blocks = block_table[start // block_size:(end - 1) // block_size + 1]
+        if all(block == blocks[0] + i for i, block in enumerate(blocks)):
+            offset = blocks[0] * block_size + start % block_size
+            return slice(offset, offset + end - start)
+        positions = torch.arange(start, end)
+        table = torch.tensor(block_table, dtype=torch.long)
+        return (table[positions // block_size] * block_size + positions % block_size).to(self.device)
+
+    def write(self, layer, index, key, value):
+        """Store key/value of shape [heads, tokens, head_dim] at ``index``"""
+        self.keys[layer][:, index] = key
+        self.values[layer][:, index] = value
+
+    def read(self, layer, index):
+        return self.keys[layer][:, index], self.values[layer][:, index]
+
+
+class PagedKV:
+    """Per-sequence keys or values read from the pool, handed to ``block_table_attention``"""
+
+    def __init__(self, tensors):
+        self.tensors = tensors
+
+
+class PagedDecodeCache(DynamicCache):
+    """Decode-step cache that writes each sequence's new token into its block and reads its history back
+
+    ``writes`` and ``reads`` hold one ``BlockPool.index`` per sequence. A
+    sequence whose blocks form one run is read as a view of the pool,
+    otherwise its history is gathered one layer at a time.
+    """
+
+    def __init__(self, pool, writes, reads, lengths):
+        super().__init__()
+        self.pool = pool
+        self.writes = writes
+        self.reads = reads
+        self.lengths = lengths
+
+    def update(self, key_states, value_states, layer_idx, *args, **kwargs):
+        keys, values = [], []
+        for i, (write, read) in enumerate(zip(self.writes, self.reads)):
+            self.pool.write(layer_idx, write, key_states[i, :, -1:], value_states[i, :, -1:])
+            key, value = self.pool.read(layer_idx, read)
+            keys.append(key)
+            values.append(value)
+        return PagedKV(keys), PagedKV(values)
+
+    def get_seq_length(self, layer_idx=0):
+        return max(self.lengths)
+
+
+def use_block_table_attention(model):
+    """Route ``PagedKV`` decode steps through per-sequence attention, everything else as before"""
+    from transformers import AttentionInterface
+    from transformers.integrations.sdpa_attention import sdpa_attention_forward
+    from transformers.masking_utils import ALL_MASK_ATTENTION_FUNCTIONS, AttentionMaskInterface
+    from transformers.modeling_utils import ALL_ATTENTION_FUNCTIONS
+
+    implementation = model.config._attn_implementation
+    if implementation.startswith('block_table|'):
+        return
+    # Eager is not registered, sdpa computes the same thing
+    fallback = ALL_ATTENTION_FUNCTIONS.get(implementation, sdpa_attention_forward)
+    mask = ALL_MASK_ATTENTION_FUNCTIONS[implementation if implementation in ALL_ATTENTION_FUNCTIONS else 'sdpa']
+
+    def block_table_attention(module, query, key, value, attention_mask, scaling=None, dropout=0.0, **kwargs):
+        if not isinstance(key, PagedKV):
+            return fallback(module, query, key, value, attention_mask, scaling=scaling, dropout=dropout, **kwargs)
+        head_dim = query.shape[-1]
+        outputs = []
+        for i, (k, v) in enumerate(zip(key.tensors, value.tensors)):
+            # Query heads sharing a key/value head attend together, so keys are never repeated
+            q = query[i, :, -1].reshape(k.shape[0], -1, head_dim)
+            output = torch.nn.functional.scaled_dot_product_attention(q, k, v, scale=scaling)
+            outputs.append(output.reshape(-1, head_dim))
+        return torch.stack(outputs)[:, None], None
+
+    name = f'block_table|{implementation}'
+    AttentionInterface.register(name, block_table_attention)
+    AttentionMaskInterface.register(name, mask)
+    model.config._attn_implementation = name
+
+
+class Sequence:
+    def __init__(self, seq_id, prompt_ids, max_new_tokens, streamer=None, adapter=None, params=None, stop=None,
+                 cancel=None):
+        self.seq_id = seq_id
+        self.prompt_ids = list(prompt_ids)
+        self.output_ids = []
+        self.max_new_tokens = max_new_tokens
+        self.streamer = streamer
+        self.adapter = adapter
+        self.params = params
+        self.stop = stop
+        self.cancel = cancel
+        self.block_table = []
+        self.num_cached = 0
+        self.future = Future()
+        self.arrival_time = time.perf_counter()
+
+    @property
+    def abandoned(self):
+        return self.future.cancelled() or (self.cancel is not None and self.cancel.cancelled)
+
+    @property
+    def token_ids(self):
+        return self.prompt_ids + self.output_ids
+
+
+class ContinuousBatchingEngine:
+    """Iteration-level scheduler over a paged KV cache
+
+    Every step admits waiting sequences while blocks are free, prefills them
+    and then runs one decode iteration for the whole running batch, so a
+    finished sequence frees its slot for the next request immediately. When
+    the pool runs dry the most recently admitted sequence is preempted and
+    recomputed later. With an ``adapters`` manager, sequences for different
+    LoRA adapters share a step as one mixed-adapter batch. Each sequence
+    samples with its own ``params`` and finishes as soon as its ``stop``
+    sequences show up in the output, which is then cut before them. A
+    sequence whose ``cancel`` token fires is finished with what it has at
+    the next step, releasing its blocks.
+    """
+
+    def __init__(self, model, eos_token_id, num_blocks=1024, block_size=16, max_running=16,
+                 max_new_tokens=256, max_model_len=2048, adapters=None):
+        self.model = model
+        use_block_table_attention(model)
+        self.adapters = adapters
+        self.eos_token_id = eos_token_id
+        self.pool = BlockPool.for_model(model, num_blocks, block_size)
+        self.max_running = max_running
+        self.max_new_tokens = max_new_tokens
+        self.max_model_len = max_model_len
+        self.waiting = deque()
+        self.running = []
+        self.condition = threading.Condition()
+        self.seq_ids = itertools.count()
+        self.thread = None
+        self.stopped = False
+        self.steps = 0
+        self.finished = 0
+        self.preempted = 0
+
+    def start(self):
+        self.stopped = False
+        self.thread = threading.Thread(target=self._loop, name='engine', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def add_request(self, prompt_ids, max_new_tokens=None, streamer=None, adapter=None, params=None, stop=None,
+                    cancel=None):
+        if max_new_tokens is None and params is not None:
+            max_new_tokens = params.max_new_tokens
+        seq = Sequence(next(self.seq_ids), prompt_ids, max_new_tokens or self.max_new_tokens, streamer, adapter,
+                       params, stop, cancel)
+        blocks_needed = -(-min(len(seq.prompt_ids) + seq.max_new_tokens, self.max_model_len) // self.pool.block_size)
+        if len(seq.prompt_ids) >= self.max_model_len or blocks_needed > self.pool.num_blocks:
+            seq.future.set_exception(ValueError(f"Prompt of {len(seq.prompt_ids)} tokens does not fit the KV cache"))
+            if streamer is not None:
+                streamer.end()
+            return seq.future
+        if streamer is not None:
+            streamer.put(torch.tensor(seq.prompt_ids))
+        with self.condition:
+            self.waiting.append(seq)
+            self.condition.notify()
+        return seq.future
+
+    async def submit(self, prompt_ids, **kwargs):
+        return await asyncio.wrap_future(self.add_request(prompt_ids, **kwargs))
+
+    def stats(self):
+        used = self.pool.num_blocks - self.pool.num_free()
+        return {
+            'running': len(self.running),
+            'waiting': len(self.waiting),
+            'blocks_used': used,
+            'blocks_total': self.pool.num_blocks,
+            'block_size': self.pool.block_size,
+            'block_utilization': used / self.pool.num_blocks,
+            'kv_pool_bytes': self.pool.nbytes(),
+            'steps': self.steps,
+            'finished': self.finished,
+            'preempted': self.preempted,
+        }
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.stopped and not self.waiting and not self.running:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+            try:
+                self.step()
+            except Exception as e:
+                print(f"[Engine] Step failed: {e}")
+                for seq in list(self.running):
+                    self._finish(seq, error=e)
+
+    def step(self):
+        with torch.no_grad():
+            for seq in list(self.running):
+                if seq.abandoned:
+                    self._finish(seq)
+            for seq in self._admit():
+                self._prefill(seq)
+            if self.running:
+                self._reserve_slots()
+            if self.running:
+                self._decode()
+        self.steps += 1
+
+    def _admit(self):
+        admitted = []
+        with self.condition:
+            while self.waiting and len(self.running) < self.max_running:
+                seq = self.waiting[0]
+                if seq.abandoned:
+                    self.waiting.popleft()
+                    self._finish(seq)
+                    continue
+                # Room for everything already known plus the next token
+                blocks_needed = len(seq.token_ids) // self.pool.block_size + 1
+                if blocks_needed > self.pool.num_free():
+                    break
+                self.waiting.popleft()
+                seq.block_table = self.pool.allocate_run(blocks_needed)
+                self.running.append(seq)
+                admitted.append(seq)
+        return admitted
+
+    def _prefill(self, seq):
+        # A preempted sequence recomputes its cache and feeds its last token in decode
+        resumed = bool(seq.output_ids)
+        input_ids = seq.token_ids[:-1] if resumed else seq.prompt_ids
+        cache = DynamicCache()
+        outputs = self._forward(
+            [seq],
+            input_ids=torch.tensor([input_ids], device=self.model.device),
+            past_key_values=cache,
+            use_cache=True,
+        )
+        index = self.pool.index(seq.block_table, 0, len(input_ids))
+        for layer, (key, value) in enumerate(cache_layers(cache)):
+            self.pool.write(layer, index, key[0], value[0])
+        seq.num_cached = len(input_ids)
+        if not resumed:
+            self._append_token(seq, self._sample(outputs.logits[0, -1:], [seq])[0])
+
+    def _reserve_slots(self):
+        """Make sure every running sequence has a slot for the token it writes next"""
+        for seq in list(self.running):
+            while seq in self.running and len(seq.block_table) * self.pool.block_size <= seq.num_cached:
+                block = self.pool.allocate(after=seq.block_table[-1])
+                if block is not None:
+                    seq.block_table.append(block)
+                else:
+                    self._preempt(self.running[-1])
+
+    def _preempt(self, seq):
+        self.pool.free(seq.block_table)
+        seq.block_table = []
+        seq.num_cached = 0
+        self.running.remove(seq)
+        self.preempted += 1
+        with self.condition:
+            self.waiting.appendleft(seq)
+
+    def _decode(self):
+        batch = list(self.running)
+        lengths = [seq.num_cached for seq in batch]
+        device = self.model.device
+        outputs = self._forward(
+            batch,
+            input_ids=torch.tensor([[seq.output_ids[-1]] for seq in batch], device=device),
+            # Every sequence attends over exactly its own cache, so there is nothing to mask
+            attention_mask=torch.zeros(len(batch), 1, 1, 1, device=device),
+            position_ids=torch.tensor([[n] for n in lengths], device=device),
+            past_key_values=PagedDecodeCache(
+                self.pool,
+                [self.pool.index(seq.block_table, n, n + 1) for seq, n in zip(batch, lengths)],
+                [self.pool.index(seq.block_table, 0, n + 1) for seq, n in zip(batch, lengths)],
+                lengths,
+            ),
+            use_cache=True,
+        )
+
+        next_tokens = self._sample(outputs.logits[:, -1], batch)
+        for seq, token in zip(batch, next_tokens.tolist()):
+            seq.num_cached += 1
+            self._append_token(seq, token)
+
+    def _forward(self, batch, **kwargs):
+        if self.adapters is None:
+            return self.model(**kwargs)
+        names = [seq.adapter for seq in batch]
+        with self.adapters.use(names):
+            return self.model(adapter_names=names, **kwargs)
+
+    def _sample(self, logits, batch):
+        return sample_tokens(logits, [seq.params for seq in batch])
+
+    def _append_token(self, seq, token):
+        token = int(token)
+        seq.output_ids.append(token)
+        if seq.streamer is not None:
+            seq.streamer.put(torch.tensor([token]))
+        keep = seq.stop.find(seq.output_ids) if seq.stop is not None else None
+        if keep is not None:
+            del seq.output_ids[keep:]
+            self._finish(seq)
+        elif (token == self.eos_token_id
+                or len(seq.output_ids) >= seq.max_new_tokens
+                or len(seq.token_ids) >= self.max_model_len):
+            self._finish(seq)
+
+    def _finish(self, seq, error=None):
+        self.pool.free(seq.block_table)
+        seq.block_table = []
+        if seq in self.running:
+            self.running.remove(seq)
+        self.finished += 1
+        if seq.streamer is not None:
+            seq.streamer.end()
+        if not seq.future.done():
+            if error is not None:
+                seq.future.set_exception(error)
+            else:
+                seq.future.set_result(seq.token_ids)
@@ -0,0 +1,139 @@
+import torch
+from transformers import StoppingCriteria
+from api.prompt import ROLE_TAGS
+
+
+class SamplingParams:
+    """Per-request decoding settings, temperature 0 decodes greedily"""
+
+    def __init__(self, max_new_tokens, temperature=0.0, top_p=1.0, stop=()):
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        # The chat template's role tags always end the assistant turn
+        self.stop = tuple(dict.fromkeys([*ROLE_TAGS, *(s for s in stop if s)]))
+
+    @property
+    def do_sample(self):
+        return self.temperature > 0
+
+    def generate_kwargs(self):
+        if not self.do_sample:
+            return {'do_sample': False}
+        return {'do_sample': True, 'temperature': self.temperature, 'top_p': self.top_p}
+
+    def to_dict(self):
+        return {
+            'max_new_tokens': self.max_new_tokens,
+            'temperature': self.temperature,
+            'top_p': self.top_p,
+            'stop': list(self.stop),
+        }
+
+
+class StopSequences:
+    """Find where the first stop string starts in generated token ids
+
+    Only a window of the newest tokens is decoded on every check, long
+    enough to hold the longest stop string even at one character per
+    token, so checking after each decoding step stays cheap. Callers that
+    append several tokens between checks pass ``new_tokens`` so the window
+    also covers a stop string that started before them.
+    """
+
+    def __init__(self, tokenizer, stop_strings):
+        self.tokenizer = tokenizer
+        self.stop_strings = [s for s in stop_strings if s]
+        self.window = max((len(s) for s in self.stop_strings), default=0) + 2
+
+    def _decode(self, token_ids):
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True)
+
+    def find(self, token_ids, new_tokens=1):
+        """Number of leading tokens to keep when a stop string has been generated, otherwise None"""
+        if not self.stop_strings:
+            return None
+        tail_start = max(0, len(token_ids) - self.window - max(new_tokens, 1) + 1)
+        tail = list(token_ids[tail_start:])
+        text = self._decode(tail)
+        positions = [text.find(s) for s in self.stop_strings if s in text]
+        if not positions:
+            return None
+        index = min(positions)
+        keep = len(tail)
+        while keep > 0 and len(self._decode(tail[:keep])) > index:
+            keep -= 1
+        # The newline before a role tag belongs to the template, not to the answer
+        while keep > 0 and not self._decode(tail[keep - 1:keep]).strip():
+            keep -= 1
+        return tail_start + keep
+
+    def truncate(self, token_ids):
+        keep = self.find(token_ids, new_tokens=len(token_ids))
+        return list(token_ids) if keep is None else list(token_ids[:keep])
+
+
+class StopOnSequences(StoppingCriteria):
+    """Stop every row of a generate call at its own stop strings or token budget"""
+
+    def __init__(self, stops, max_new_tokens, prompt_width):
+        self.stops = stops
+        self.max_new_tokens = max_new_tokens
+        self.prompt_width = prompt_width
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = []
+        for row, stop, limit in zip(input_ids.tolist(), self.stops, self.max_new_tokens):
+            generated = row[self.prompt_width:]
+            done.append(len(generated) >= limit or stop.find(generated) is not None)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class StopOnCancel(StoppingCriteria):
+    """End the rows of a generate call whose request was cancelled or ran past its deadline"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = [token is not None and token.cancelled for token in self.tokens]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class FinishedRows(StoppingCriteria):
+    """Combine per-row stopping criteria and remember where each row finished
+
+    ``finished_at`` holds the sequence length, prompt included, of the
+    step that finished a row. A BatchStreamer reads it to tell the row's
+    last token from the padding generated after it.
+    """
+
+    def __init__(self, criteria, batch_size):
+        self.criteria = criteria
+        self.finished_at = [None] * batch_size
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = self.criteria[0](input_ids, scores, **kwargs)
+        for criterion in self.criteria[1:]:
+            done = done | criterion(input_ids, scores, **kwargs)
+        for i, row_done in enumerate(done.tolist()):
+            if row_done and self.finished_at[i] is None:
+                self.finished_at[i] = input_ids.shape[1]
+        return done
+
+
+def sample_tokens(logits, params):
+    """Next token for each row of ``logits`` under that row's SamplingParams"""
+    tokens = logits.argmax(dim=-1)
+    for i, p in enumerate(params):
+        if p is None or not p.do_sample:
+            continue
+        probs = torch.softmax(logits[i].float() / p.temperature, dim=-1)
+        if p.top_p < 1.0:
+            sorted_probs, order = probs.sort(descending=True)
+            # Keep the smallest set of tokens whose probability reaches top_p
+            outside = sorted_probs.cumsum(dim=-1) - sorted_probs > p.top_p
+            sorted_probs[outside] = 0
+            probs = torch.zeros_like(probs).scatter(-1, order, sorted_probs)
+        tokens[i] = torch.multinomial(probs, 1)[0]
+    return tokens
@@ -0,0 +1,144 @@
+import copy
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict, Counter
+
+
+def prefix_key(token_ids, namespace=None):
+    digest = hashlib.blake2b(array('q', token_ids).tobytes(), digest_size=16)
+    if namespace is not None:
+        # Caches produced by different adapters never match each other
+        digest.update(namespace.encode())
+    return digest.hexdigest()
+
+
+def cache_layers(cache):
+    """Yield (key, value) tensors per layer for both old and new DynamicCache layouts"""
+    if hasattr(cache, 'layers'):
+        for layer in cache.layers:
+            yield layer.keys, layer.values
+    else:
+        yield from zip(cache.key_cache, cache.value_cache)
+
+
+def cache_nbytes(cache):
+    total = 0
+    for key, value in cache_layers(cache):
+        if key is not None:
+            total += key.numel() * key.element_size() + value.numel() * value.element_size()
+    return total
+
+
+def crop_cache(cache, length):
+    """Drop cached positions from ``length`` on
+
+    A negative count removes that many tokens in transformers 4.x and 5.x
+    alike, the positive max-length form is deprecated in 5.x.
+    """
+    excess = cache.get_seq_length() - length
+    if excess > 0:
+        cache.crop(-excess)
+
+
+class PrefixKVCache:
+    """LRU store of past-key-values for already processed token prefixes
+
+    Each entry holds the cache for one processed sequence and is indexed
+    under several prefix lengths (e.g. the prompt and the prompt plus the
+    generated answer), so a follow-up turn can reuse the longest one.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.index = {}
+        self.lengths = Counter()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, token_ids, namespace=None):
+        """Return (prefix_length, cache) for the longest cached strict prefix of token_ids"""
+        if self.max_bytes <= 0:
+            return 0, None
+        with self.lock:
+            for length in sorted(self.lengths, reverse=True):
+                # generate needs at least one uncached token to run
+                if length >= len(token_ids):
+                    continue
+                entry_key = self.index.get(prefix_key(token_ids[:length], namespace))
+                if entry_key is None:
+                    continue
+                entry = self.entries[entry_key]
+                if entry['namespace'] != namespace or entry['token_ids'][:length] != token_ids[:length]:
+                    continue
+                self.entries.move_to_end(entry_key)
+                self.hits += 1
+                cache = copy.deepcopy(entry['cache'])
+                crop_cache(cache, length)
+                return length, cache
+            self.misses += 1
+            return 0, None
+
+    def store(self, token_ids, cache, boundaries=(), namespace=None):
+        """Keep the cache for token_ids, reusable at its full length and at each boundary"""
+        nbytes = cache_nbytes(cache)
+        if self.max_bytes <= 0 or nbytes > self.max_bytes:
+            return
+        token_ids = list(token_ids)
+        lengths = sorted({len(token_ids), *(b for b in boundaries if 0 < b <= len(token_ids))})
+        entry_key = prefix_key(token_ids, namespace)
+        with self.lock:
+            if entry_key in self.entries:
+                self._evict(entry_key)
+            while self.entries and self.total_bytes + nbytes > self.max_bytes:
+                self._evict(next(iter(self.entries)))
+            self.entries[entry_key] = {
+                'token_ids': token_ids,
+                'namespace': namespace,
+                'cache': cache,
+                'nbytes': nbytes,
+                'keys': [],
+            }
+            for length in lengths:
+                key = prefix_key(token_ids[:length], namespace)
+                if key in self.index:
+                    # A newer sequence takes over a shared prefix
+                    self._unindex(key)
+                self.index[key] = entry_key
+                self.entries[entry_key]['keys'].append((key, length))
+                self.lengths[length] += 1
+            self.total_bytes += nbytes
+
+    def _unindex(self, key):
+        owner = self.entries[self.index.pop(key)]
+        for i, (owned_key, length) in enumerate(owner['keys']):
+            if owned_key == key:
+                del owner['keys'][i]
+                self._drop_length(length)
+                break
+
+    def _drop_length(self, length):
+        self.lengths[length] -= 1
+        if self.lengths[length] <= 0:
+            del self.lengths[length]
+
+    def _evict(self, entry_key):
+        entry = self.entries.pop(entry_key)
+        for key, length in entry['keys']:
+            if self.index.get(key) == entry_key:
+                del self.index[key]
+            self._drop_length(length)
+        self.total_bytes -= entry['nbytes']
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
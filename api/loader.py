@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+import torch
+from peft import AutoPeftModelForCausalLM
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+# 'auto' uses bitsandbytes 8-bit on a GPU, 'fp32' and 'int8' run on the CPU
+BACKENDS = ('auto', 'fp32', 'int8')
+INT8_WEIGHTS = 'model_int8.pt'
+
+
+def quantization_kwargs(backend='auto'):
+    if backend == 'auto' and torch.cuda.is_available():
+        return {'device_map': 'auto', 'quantization_config': BitsAndBytesConfig(load_in_8bit=True)}
+    # bitsandbytes 8-bit needs a GPU, fall back to full precision on CPU
+    return {'torch_dtype': torch.float32}
+
+
+def configure_threads(intra_op=0, inter_op=0):
+    """Set the PyTorch CPU thread pools, 0 keeps the default"""
+    if intra_op > 0:
+        torch.set_num_threads(intra_op)
+    if inter_op > 0:
+        # Only allowed before the first inter-op parallel work
+        torch.set_num_interop_threads(inter_op)
+    print(f"[API] Using {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} inter-op threads")
+
+
+def quantize_int8(model):
+    """Dynamic int8 quantization of every Linear layer for CPU inference
+
+    Weights are stored as int8 and activations are quantized on the fly,
+    which roughly quarters the memory of the linear layers and lets matmuls
+    use the int8 kernels of fbgemm/onednn.
+    """
+    model = torch.ao.quantization.quantize_dynamic(model.float().cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
+    return model
+
+
+def prepare_model(model, backend='auto'):
+    if backend == 'int8':
+        return quantize_int8(model)
+    return model
+
+
+def load_merged(path, backend='auto'):
+    """Load an exported merged checkpoint, safetensors shards are memory-mapped"""
+    model = AutoModelForCausalLM.from_pretrained(path, low_cpu_mem_usage=True, **quantization_kwargs(backend))
+    return prepare_model(model, backend)
+
+
+def load_base(model_id, backend='auto'):
+    """Load the unmerged base model that serves several adapters"""
+    if backend == 'int8':
+        raise ValueError("LoRA adapters cannot wrap dynamically quantized layers, use the fp32 or auto backend")
+    return AutoModelForCausalLM.from_pretrained(model_id, low_cpu_mem_usage=True, **quantization_kwargs(backend))
+
+
+def load_adapter_and_merge(path, backend='auto'):
+    model = AutoPeftModelForCausalLM.from_pretrained(path, **quantization_kwargs(backend))
+    return prepare_model(model.merge_and_unload(), backend)
+
+
+def load_int8(path):
+    """Load a model quantized ahead of time by components/exporter.py --int8
+
+    The module is pickled, so it must be loaded with the same torch and
+    transformers versions that exported it.
+    """
+    model = torch.load(os.path.join(path, INT8_WEIGHTS), map_location='cpu', weights_only=False)
+    model.eval()
+    return model
+
+
+class BackgroundLoader:
+    """Run a slow load function once, off the event loop, and report when it is done"""
+
+    def __init__(self, load_fn):
+        self.load_fn = load_fn
+        self.future = Future()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.load_seconds = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name='model-loader', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            self.load_fn()
+        except Exception as e:
+            print(f"[API] Model loading failed: {e}")
+            self.future.set_exception(e)
+            return
+        self.load_seconds = time.perf_counter() - start
+        print(f"[API] Model ready in {self.load_seconds:.1f}s")
+        self.future.set_result(True)
+
+    @property
+    def ready(self):
+        return self.future.done() and self.future.exception() is None
+
+    def status(self):
+        if not self.future.done():
+            return 'loading' if self.thread is not None else 'idle'
+        return 'failed' if self.future.exception() is not None else 'ready'
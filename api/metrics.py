@@ -0,0 +1,52 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# The default registry also exports process_resident_memory_bytes and friends
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 300)
+TOKEN_BUCKETS = (1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+
+REQUESTS = Counter(
+    'tinyllama_requests_total', 'Conversation requests by endpoint and outcome', ['endpoint', 'status'])
+REQUEST_LATENCY = Histogram(
+    'tinyllama_request_latency_seconds', 'End-to-end request latency', ['endpoint'], buckets=LATENCY_BUCKETS)
+TIME_TO_FIRST_TOKEN = Histogram(
+    'tinyllama_time_to_first_token_seconds', 'Time until the first generated token', buckets=LATENCY_BUCKETS)
+PROMPT_TOKENS = Histogram(
+    'tinyllama_prompt_tokens_per_request', 'Prompt length in tokens', buckets=TOKEN_BUCKETS)
+GENERATED_TOKENS = Histogram(
+    'tinyllama_generated_tokens_per_request', 'Generated tokens per request', buckets=TOKEN_BUCKETS)
+GENERATED_TOKENS_TOTAL = Counter(
+    'tinyllama_generated_tokens_total', 'Generated tokens across all requests')
+TOKENS_PER_SECOND = Histogram(
+    'tinyllama_tokens_per_second', 'Per-request decoding throughput',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+PROMPT_TRUNCATIONS = Counter(
+    'tinyllama_prompt_truncations_total', 'Prompts that dropped old turns to fit the context window')
+RESPONSE_CACHE_HITS = Counter(
+    'tinyllama_response_cache_hits_total', 'Requests answered from the response cache')
+SPECULATIVE_ACCEPTANCE = Histogram(
+    'tinyllama_speculative_acceptance_rate', 'Share of drafted tokens accepted per speculative request',
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0))
+ADMISSION_WAIT = Histogram(
+    'tinyllama_admission_wait_seconds', 'Time requests waited for a model slot', buckets=LATENCY_BUCKETS)
+REJECTED = Counter(
+    'tinyllama_requests_rejected_total', 'Requests turned away by admission control', ['reason'])
+CANCELLED = Counter(
+    'tinyllama_generations_cancelled_total', 'Generations stopped early by a disconnect or deadline', ['reason'])
+QUEUE_DEPTH = Gauge(
+    'tinyllama_queue_depth', 'Requests waiting for the model')
+MODEL_READY = Gauge(
+    'tinyllama_model_ready', 'Whether the model finished loading')
+
+
+def observe_generation(endpoint, latency, prompt_tokens, generated_tokens, ttft=None):
+    REQUESTS.labels(endpoint, 'ok').inc()
+    REQUEST_LATENCY.labels(endpoint).observe(latency)
+    PROMPT_TOKENS.observe(prompt_tokens)
+    GENERATED_TOKENS.observe(generated_tokens)
+    GENERATED_TOKENS_TOTAL.inc(generated_tokens)
+    if ttft is not None:
+        TIME_TO_FIRST_TOKEN.observe(ttft)
+    # Decoding speed excludes the time spent waiting for and computing the first token
+    decode_time = latency - (ttft or 0)
+    if generated_tokens > 1 and decode_time > 0:
+        TOKENS_PER_SECOND.observe((generated_tokens - 1) / decode_time)
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+
+SEPARATOR = "\n"
+ASSISTANT_TAG = "<|assistant|>"
+# Tags that open a turn in the chat template, generating one means the answer is over
+ROLE_TAGS = ("<|user|>", ASSISTANT_TAG, "<|system|>")
+
+
+class PromptBuilder:
+    """Assemble prompt token ids from role-tagged messages without re-tokenizing the history
+
+    Every message is encoded once as it appears after a newline and the ids
+    are cached, so a turn only tokenizes the messages it has not seen yet.
+    When the history does not fit the budget, whole oldest turns are dropped.
+    """
+
+    def __init__(self, tokenizer, max_length, reserve_tokens=0, cache_size=4096):
+        self.tokenizer = tokenizer
+        self.budget = max_length - reserve_tokens
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.separator_ids = tokenizer.encode(SEPARATOR, add_special_tokens=False)
+        self.bos_ids = [tokenizer.bos_token_id] if tokenizer.bos_token_id is not None else []
+        self.suffix_ids = self.encode_message(ASSISTANT_TAG) + self.encode_message("")
+
+    def encode_message(self, message):
+        """Token ids of SEPARATOR + message as they appear inside the joined prompt"""
+        ids = self.cache.get(message)
+        if ids is not None:
+            self.cache.move_to_end(message)
+            return ids
+        ids = self.tokenizer.encode(SEPARATOR + message, add_special_tokens=False)
+        if ids[:len(self.separator_ids)] == self.separator_ids:
+            ids = self.separator_ids[-1:] + ids[len(self.separator_ids):]
+        self.cache[message] = ids
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return ids
+
+    def build(self, messages):
+        """Return (token_ids, truncated) for the newest messages that fit the budget"""
+        pieces = [self.encode_message(message) for message in messages]
+        return self.build_pieces(pieces, [message.startswith(ASSISTANT_TAG) for message in messages])
+
+    def build_pieces(self, pieces, is_assistant):
+        """Same as build for messages that are already encoded"""
+        available = self.budget - len(self.bos_ids) - len(self.suffix_ids)
+        start = len(pieces)
+        used = 0
+        while start > 0 and used + len(pieces[start - 1]) <= available:
+            start -= 1
+            used += len(pieces[start])
+        truncated = start > 0
+        # Keep the history starting on a user turn rather than a dangling answer
+        while start < len(pieces) - 1 and is_assistant[start]:
+            start += 1
+        token_ids = [ids for piece in pieces[start:] for ids in piece]
+        if start == len(pieces) and pieces:
+            # Even the newest message alone is too long, keep its tail
+            token_ids = pieces[-1][-max(available, 0):] if available > 0 else []
+        return self.bos_ids + token_ids + self.suffix_ids, truncated
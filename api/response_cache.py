@@ -0,0 +1,73 @@
+import hashlib
+import json
+import shelve
+import time
+from array import array
+from collections import OrderedDict
+
+
+def make_key(prompt_ids, params):
+    digest = hashlib.sha256(array('q', prompt_ids).tobytes())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """Size-bounded LRU of generated token ids with a TTL and optional on-disk backing
+
+    Expiry uses wall-clock time so entries persisted with ``path`` stay
+    valid across restarts until their TTL runs out.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.store = shelve.open(path) if path else None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if self.max_entries <= 0:
+            return None
+        entry = self.entries.get(key)
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None:
+                self.entries[key] = entry
+        if entry is None or entry[0] < time.time():
+            if entry is not None:
+                self._delete(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        entry = (time.time() + self.ttl_seconds, value)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if self.store is not None:
+            self.store[key] = entry
+        while len(self.entries) > self.max_entries:
+            self._delete(next(iter(self.entries)))
+
+    def _delete(self, key):
+        self.entries.pop(key, None)
+        if self.store is not None and key in self.store:
+            del self.store[key]
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,212 @@
+import json
+import shelve
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class MemoryBackend:
+    """Process-local LRU of session entries"""
+
+    # Shared backends are visible to every API replica
+    shared = False
+
+    def __init__(self, max_sessions=10000):
+        self.max_sessions = max_sessions
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, ttl_seconds):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_sessions:
+                self.delete(next(iter(self.entries)))
+
+    def update(self, key, update, ttl_seconds):
+        """Replace the entry with ``update(entry)`` atomically, nothing is written when that returns None"""
+        with self.lock:
+            entry = update(self.entries.get(key))
+            if entry is not None:
+                self.set(key, entry, ttl_seconds)
+            return entry
+
+    def delete(self, key):
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def size(self):
+        return len(self.entries)
+
+    def close(self):
+        pass
+
+
+class FileBackend(MemoryBackend):
+    """Memory LRU mirrored to a local shelve file so sessions survive restarts"""
+
+    def __init__(self, path, max_sessions=10000):
+        self.store = shelve.open(path)
+        super().__init__(max_sessions)
+        # Replay oldest first so the most recently used sessions win the LRU bound
+        for key, entry in sorted(self.store.items(), key=lambda item: item[1][0]):
+            super().set(key, entry, None)
+
+    def set(self, key, entry, ttl_seconds):
+        with self.lock:
+            self.store[key] = entry
+            super().set(key, entry, ttl_seconds)
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.store:
+                del self.store[key]
+            return super().delete(key)
+
+    def close(self):
+        self.store.close()
+
+
+class RedisBackend:
+    """Sessions in a Redis-compatible server, expired by the server itself
+
+    ``client`` only needs ``get``, ``set(..., ex=)``, ``delete`` and
+    ``pipeline`` for WATCH/MULTI updates, so any Redis-compatible server or
+    an in-process stand-in works.
+    """
+
+    shared = True
+
+    def __init__(self, client, prefix='tinyllama:session:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError(f"SESSION_STORE={url} needs the redis package: pip install redis") from e
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, entry, ttl_seconds):
+        self.client.set(self.prefix + key, json.dumps(entry), ex=ttl_seconds)
+
+    def update(self, key, update, ttl_seconds):
+        """Replace the entry with ``update(entry)``, retried until no other replica changed it in between"""
+        from redis.exceptions import WatchError
+
+        key = self.prefix + key
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    raw = pipe.get(key)
+                    entry = update(json.loads(raw) if raw is not None else None)
+                    if entry is None:
+                        return None
+                    pipe.multi()
+                    pipe.set(key, json.dumps(entry), ex=ttl_seconds)
+                    pipe.execute()
+                    return entry
+                except WatchError:
+                    continue
+
+    def delete(self, key):
+        return self.client.delete(self.prefix + key) > 0
+
+    def size(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class SessionStore:
+    """Token-id history of server-side conversations with a TTL
+
+    Each turn is stored as ``{"role": ..., "ids": [...]}`` so a request only
+    has to carry and tokenize its new messages. Turns older than
+    ``max_tokens`` can never fit a prompt again and are dropped. Creating
+    and appending are atomic read-modify-writes in the backend, so
+    concurrent turns never lose each other and a deleted session stays
+    deleted.
+    """
+
+    def __init__(self, backend, ttl_seconds=3600, max_tokens=2048):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.max_tokens = max_tokens
+
+    def create(self, session_id=None):
+        """Start a session, under ``session_id`` when the client picked one, None if that id is taken"""
+        if session_id is None:
+            session_id = uuid.uuid4().hex
+
+        def claim(entry):
+            return None if self._live(entry) else (time.time() + self.ttl_seconds, [])
+
+        return session_id if self.backend.update(session_id, claim, self.ttl_seconds) is not None else None
+
+    def get(self, session_id):
+        """Turns of the session, None when it is unknown or expired"""
+        entry = self.backend.get(session_id)
+        if entry is None:
+            return None
+        if not self._live(entry):
+            self.backend.delete(session_id)
+            return None
+        return entry[1]
+
+    def append(self, session_id, turns):
+        """Add turns to the session, False without writing anything when it was deleted or expired meanwhile"""
+        def extend(entry):
+            if not self._live(entry):
+                return None
+            history = entry[1] + turns
+            total = sum(len(turn['ids']) for turn in history)
+            while len(history) > 1 and total > self.max_tokens:
+                total -= len(history.pop(0)['ids'])
+            return time.time() + self.ttl_seconds, history
+
+        return self.backend.update(session_id, extend, self.ttl_seconds) is not None
+
+    def delete(self, session_id):
+        return self.backend.delete(session_id)
+
+    @staticmethod
+    def _live(entry):
+        return entry is not None and entry[0] >= time.time()
+
+    def close(self):
+        self.backend.close()
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'sessions': self.backend.size(),
+            'ttl_seconds': self.ttl_seconds,
+        }
+
+
+def open_session_store(url=None, max_sessions=10000, ttl_seconds=3600, max_tokens=2048):
+    """In memory when ``url`` is empty, Redis for redis:// URLs, otherwise a local shelve file"""
+    if not url:
+        backend = MemoryBackend(max_sessions)
+    elif url.startswith(('redis://', 'rediss://', 'unix://')):
+        backend = RedisBackend.from_url(url)
+    else:
+        backend = FileBackend(url, max_sessions)
+    return SessionStore(backend, ttl_seconds, max_tokens)
@@ -0,0 +1,95 @@
+import torch
+from api.kv_cache import crop_cache
+
+
+def find_draft(token_ids, max_ngram, num_draft):
+    """Tokens that followed the latest earlier occurrence of the trailing n-gram"""
+    if num_draft <= 0:
+        return []
+    for n in range(max_ngram, 0, -1):
+        if len(token_ids) <= n:
+            continue
+        tail = token_ids[-n:]
+        for start in range(len(token_ids) - n - 1, -1, -1):
+            if token_ids[start:start + n] == tail:
+                draft = token_ids[start + n:start + n + num_draft]
+                if draft:
+                    return draft
+    return []
+
+
+def prompt_lookup_generate(model, prompt_ids, past_key_values, cached_length, max_new_tokens, eos_token_id,
+                           max_ngram=3, num_draft=8, streamer=None, model_kwargs=None, stop=None,
+                           cancel=None):
+    """Greedy decoding with n-gram drafts copied from the context and verified by the model
+
+    Every forward pass scores the last accepted token plus a draft, keeps the
+    longest draft prefix matching the model's own argmax and appends the
+    model's next token, so the output is identical to plain greedy decoding.
+    ``past_key_values`` may already hold the first ``cached_length`` prompt
+    tokens. ``model_kwargs`` are passed to every forward pass. Generation
+    ends early once a ``stop`` sequence appears, and the tokens from it on
+    are dropped, and it is abandoned between passes once ``cancel`` is
+    cancelled. Returns the generated token ids and acceptance statistics.
+    """
+    device = model.device
+    model_kwargs = model_kwargs or {}
+    if streamer is not None:
+        streamer.put(torch.tensor(prompt_ids))
+    outputs = model(
+        input_ids=torch.tensor([prompt_ids[cached_length:]], device=device),
+        past_key_values=past_key_values,
+        use_cache=True,
+        **model_kwargs,
+    )
+    generated = [int(outputs.logits[0, -1].argmax())]
+    if streamer is not None:
+        streamer.put(torch.tensor(generated))
+    forward_passes = 1
+    drafted = 0
+    accepted = 0
+
+    while len(generated) < max_new_tokens and generated[-1] != eos_token_id:
+        if cancel is not None and cancel.cancelled:
+            break
+        context = prompt_ids + generated
+        draft = find_draft(context, max_ngram, min(num_draft, max_new_tokens - len(generated) - 1))
+        outputs = model(
+            input_ids=torch.tensor([[generated[-1]] + draft], device=device),
+            past_key_values=past_key_values,
+            use_cache=True,
+            **model_kwargs,
+        )
+        forward_passes += 1
+        predictions = outputs.logits[0].argmax(dim=-1).tolist()
+        num_accepted = 0
+        while num_accepted < len(draft) and draft[num_accepted] == predictions[num_accepted]:
+            num_accepted += 1
+        drafted += len(draft)
+        accepted += num_accepted
+        # Drop the cache entries of rejected draft tokens
+        crop_cache(past_key_values, len(context) + num_accepted)
+
+        new_tokens = draft[:num_accepted] + [predictions[num_accepted]]
+        new_tokens = new_tokens[:max_new_tokens - len(generated)]
+        if eos_token_id in new_tokens:
+            new_tokens = new_tokens[:new_tokens.index(eos_token_id) + 1]
+        generated.extend(new_tokens)
+        if streamer is not None:
+            streamer.put(torch.tensor(new_tokens))
+        keep = stop.find(generated, new_tokens=len(new_tokens)) if stop is not None else None
+        if keep is not None:
+            del generated[keep:]
+            break
+
+    if streamer is not None:
+        streamer.end()
+    stats = {
+        'drafted_tokens': drafted,
+        'accepted_tokens': accepted,
+        'acceptance_rate': accepted / drafted if drafted else 0.0,
+        'forward_passes': forward_passes,
+        # Plain greedy decoding needs one forward pass per generated token
+        'estimated_speedup': len(generated) / forward_passes,
+    }
+    return generated, stats
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import time
+from transformers import TextStreamer
+from transformers.generation.streamers import BaseStreamer
+
+
+class AsyncTextStreamer(TextStreamer):
+    """Forward decoded text from the generate thread to an asyncio queue
+
+    Text that could be the start of one of ``stop_strings`` is held back
+    until it is known not to be one, and nothing from a stop string on is
+    ever sent.
+    """
+
+    def __init__(self, tokenizer, loop, stop_strings=(), **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt=True, **decode_kwargs)
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.token_ids = []
+        self.first_token_time = None
+        self.stop_strings = [s for s in stop_strings if s]
+        self.held = ""
+        self.stopped = False
+
+    def put(self, value):
+        if not self.next_tokens_are_prompt:
+            if self.first_token_time is None:
+                self.first_token_time = time.perf_counter()
+            self.token_ids.extend(value.reshape(-1).tolist())
+        super().put(value)
+
+    def restart(self):
+        """Take the prompt again for a retried call, False once generated tokens were forwarded"""
+        if self.token_ids:
+            return False
+        self.token_cache = []
+        self.print_len = 0
+        self.next_tokens_are_prompt = True
+        return True
+
+    def _hold_back(self, text):
+        # Longest suffix that is a proper prefix of a stop string
+        for length in range(min(len(text), max(map(len, self.stop_strings))), 0, -1):
+            if any(s.startswith(text[-length:]) for s in self.stop_strings):
+                return length
+        return 0
+
+    def on_finalized_text(self, text, stream_end=False):
+        if self.stop_strings and not self.stopped:
+            text = self.held + text
+            self.held = ""
+            positions = [text.find(s) for s in self.stop_strings if s in text]
+            if positions:
+                text = text[:min(positions)].rstrip()
+                self.stopped = True
+            elif not stream_end:
+                held = self._hold_back(text)
+                if held:
+                    text, self.held = text[:-held], text[-held:]
+        elif self.stopped:
+            text = ""
+        if text:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    async def __aiter__(self):
+        while True:
+            text = await self.queue.get()
+            if text is None:
+                break
+            yield text
+
+
+class BatchStreamer(BaseStreamer):
+    """Fan the tokens of a batched generate call out to one streamer per row
+
+    Rows without a streamer are skipped. A row's streamer ends with its
+    EOS or the last token before ``finished_at``, so its client is not
+    kept waiting on the longest row and the padding generated for finished
+    rows is never forwarded. Depending on the transformers version the
+    stopping criteria run before or after the streamer sees a step, the
+    sequence length tells both cases apart.
+    """
+
+    def __init__(self, streamers, finished_at, eos_token_id):
+        self.streamers = streamers
+        self.finished_at = finished_at
+        self.eos_token_id = eos_token_id
+        self.ended = [streamer is None for streamer in streamers]
+        self.length = None
+
+    def _end(self, i):
+        self.ended[i] = True
+        self.streamers[i].end()
+
+    def put(self, value):
+        if self.length is None:
+            self.length = value.shape[-1]
+            for i, streamer in enumerate(self.streamers):
+                if streamer is not None:
+                    streamer.put(value[i:i + 1])
+            return
+        self.length += 1
+        for i, token in enumerate(value.tolist()):
+            if self.ended[i]:
+                continue
+            finished_at = self.finished_at[i]
+            if finished_at is not None and self.length > finished_at:
+                self._end(i)
+                continue
+            self.streamers[i].put(value[i:i + 1])
+            if token == self.eos_token_id or self.length == finished_at:
+                self._end(i)
+
+    def end(self):
+        for i, ended in enumerate(self.ended):
+            if not ended:
+                self._end(i)
+
+
+def sse_event(data, event=None):
+    payload = f"data: {json.dumps(data)}\n\n"
+    if event is not None:
+        payload = f"event: {event}\n" + payload
+    return payload
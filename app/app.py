@@ -1,13 +1,31 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
+import os
 import re
 import html
+import json
+import threading
+import time
+import uuid
 
-conversation_history = []
+# Turns sent back to the API and messages kept on screen per browser session
+MAX_HISTORY_TURNS = int(os.environ.get("MAX_HISTORY_TURNS", "20"))
+MAX_MESSAGES = int(os.environ.get("MAX_MESSAGES", "200"))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "32"))
+HEALTH_CHECK_INTERVAL = float(os.environ.get("HEALTH_CHECK_INTERVAL", "10"))
+# Messages rendered together as one cached chunk of history HTML
+HISTORY_BLOCK = 20
+# Seconds between redraws of an answer while it streams
+STREAM_REFRESH_SECONDS = 0.05
+ROLE_TAG = re.compile(r'<\|(?:user|assistant|system)\|>')
 
 def add_to_conversation(role, message):
-    conversation_history.append(f"<|{role}|>\n{message}")
+    history = st.session_state.conversation_history
+    history.append(f"<|{role}|>\n{message}")
+    # Only resent when the server-side session is gone, the API trims long prompts to the context window anyway
+    del history[:-MAX_HISTORY_TURNS]
 
 # Page config
 st.set_page_config(
@@ -271,39 +289,70 @@ st.markdown("""
 # API Configuration
 API_BASE_URL = "http://localhost:8082"
 CONVERSATION_ENDPOINT = f"{API_BASE_URL}/api/v1/conversation"
+STREAM_ENDPOINT = f"{CONVERSATION_ENDPOINT}/stream"
+SESSIONS_ENDPOINT = f"{API_BASE_URL}/api/v1/sessions"
 
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "conversation_history" not in st.session_state:
+    st.session_state.conversation_history = []
+if "history_blocks" not in st.session_state:
+    st.session_state.history_blocks = []
 if "is_typing" not in st.session_state:
     st.session_state.is_typing = False
+if "conversation_id" not in st.session_state:
+    # nginx hashes this header so every turn lands on the replica that already caches the conversation
+    st.session_state.conversation_id = uuid.uuid4().hex
+if "session_ready" not in st.session_state:
+    # The API keeps the conversation in a session named after conversation_id once it is created
+    st.session_state.session_ready = False
+
+@st.cache_resource
+def get_http_session():
+    """Keep-alive connection pool shared by every browser session"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class HealthMonitor:
+    """Probe the API readiness in a background thread so reruns only read the last result
+
+    ``online`` is None until the first probe has answered.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.online = None
+        self.checked_at = None
+        threading.Thread(target=self._run, name="api-health", daemon=True).start()
+
+    def probe(self):
+        try:
+            response = get_http_session().get(f"{API_BASE_URL}/readyz", timeout=2)
+            self.online = response.status_code == 200
+        except requests.exceptions.RequestException:
+            self.online = False
+        self.checked_at = time.time()
+        return self.online
+
+    def _run(self):
+        while True:
+            self.probe()
+            time.sleep(self.interval)
+
+@st.cache_resource
+def get_health_monitor():
+    return HealthMonitor(HEALTH_CHECK_INTERVAL)
 
 def check_api_status():
-    try:
-        response = requests.get(f"{API_BASE_URL}/docs", timeout=5)
-        return response.status_code == 200
-    except:
-        return False
+    return get_health_monitor().online
 
 def clean_response(response_text):
-    print(response_text)
-    """Extract only the most recent assistant response and clean it"""
-    # Split by assistant tags to find all assistant responses
-    assistant_parts = re.split(r'<\|assistant\|>', response_text)
-    
-    if len(assistant_parts) > 1:
-        # Take the last assistant response (most recent)
-        last_response = assistant_parts[-1]
-    else:
-        # If no assistant tag found, use the whole response
-        last_response = response_text
-    
-    # Remove any remaining conversation tags and user input
-    cleaned = re.sub(r'<\|user\|>.*?(?=<\|assistant\|>|$)', '', last_response, flags=re.DOTALL)
-    cleaned = re.sub(r'<\|.*?\|>', '', cleaned)
-    
-    # Remove extra whitespace and newlines
-    cleaned = cleaned.strip()
+    """Cut the answer at a role tag the model may have started on its own"""
+    cleaned = ROLE_TAG.split(response_text, maxsplit=1)[0].strip()
     
     # If the response is empty after cleaning, provide a fallback
     if not cleaned:
@@ -311,27 +360,81 @@ def clean_response(response_text):
     
     return cleaned
 
-def send_message_to_api(message):
-    add_to_conversation("user", message)
+def conversation_headers(conversation_id=None):
+    # nginx routes on this header, so the session and all of its turns stay on one replica
+    return {"Content-Type": "application/json", "X-Conversation-ID": conversation_id or st.session_state.conversation_id}
+
+def ensure_session():
+    """Create the server-side session for this conversation unless it already exists"""
+    if st.session_state.session_ready:
+        return
+    response = get_http_session().post(SESSIONS_ENDPOINT, headers=conversation_headers(), timeout=10)
+    # 409 means an earlier run already created it
+    if response.status_code != 409:
+        response.raise_for_status()
+    st.session_state.session_ready = True
+
+def stream_turn(content):
+    ensure_session()
+    payload = {
+        "timestamp": datetime.now().isoformat(),
+        "session_id": st.session_state.conversation_id,
+        "content": content,
+        # A person is waiting on this answer, it goes ahead of batch traffic
+        "priority": "interactive",
+    }
+    return get_http_session().post(
+        STREAM_ENDPOINT,
+        json=payload,
+        headers=conversation_headers(),
+        timeout=60*5,
+        stream=True
+    )
+
+def end_session(conversation_id):
+    """Free the server-side session of a cleared conversation, it would expire on its own anyway"""
     try:
-        payload = {
-            "timestamp": datetime.now().isoformat(),
-            "content": conversation_history,
+        get_http_session().delete(
+            f"{CONVERSATION_ENDPOINT}/{conversation_id}", headers=conversation_headers(conversation_id), timeout=5)
+    except requests.exceptions.RequestException:
+        pass
 
-        }
-        response = requests.post(
-            CONVERSATION_ENDPOINT,
-            json=payload,
-            headers={"Content-Type": "application/json"},
-            timeout=60*5
-        )
+def send_message_to_api(message, placeholder=None):
+    add_to_conversation("user", message)
+    try:
+        # The server holds the earlier turns, only the new message is sent and tokenized
+        response = stream_turn(st.session_state.conversation_history[-1:])
+        if response.status_code == 404:
+            # The session expired or its replica restarted, start a new one from the turns kept here
+            response.close()
+            st.session_state.session_ready = False
+            response = stream_turn(st.session_state.conversation_history)
         
         print(f"API Response Status: {response}")  # Debugging line
         if response.status_code == 200:
-            result = response.json()
-            raw_response = result.get("response", "No response received")
+            # The stream only carries the new answer, each token is escaped once as it arrives
+            tokens = []
+            escaped = []
+            timestamp = datetime.now().strftime("%H:%M")
+            last_render = 0.0
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                event = json.loads(line[len("data: "):])
+                if "token" in event:
+                    tokens.append(event["token"])
+                    escaped.append(escape_text(event["token"]))
+                    # Redraw the partial answer at a bounded rate rather than on every token
+                    now = time.monotonic()
+                    if placeholder is not None and now - last_render >= STREAM_REFRESH_SECONDS:
+                        placeholder.markdown(message_html("".join(escaped), False, timestamp), unsafe_allow_html=True)
+                        last_render = now
+                elif "error" in event:
+                    return f"Error: {event['error']}"
+                elif "ttft" in event:
+                    print(f"Time to first token: {event['ttft']}s, total: {event['latency']:.3f}s")
             # Clean the response before returning
-            cleaned_response = clean_response(raw_response)
+            cleaned_response = clean_response("".join(tokens))
             add_to_conversation("assistant", cleaned_response)
             return cleaned_response
         else:
@@ -344,25 +447,45 @@ def send_message_to_api(message):
     except Exception as e:
         return f"Error: {str(e)}"
 
-def display_message(message, is_user=True):
-    """Display a message with appropriate styling"""
-    timestamp = datetime.now().strftime("%H:%M")
-    
-    # Jika pesan sudah mengandung HTML yang ingin dirender, jangan di-escape
-    if is_user:
-        st.markdown(f"""
-        <div class="user-message">
-            <div>{message}</div>
-            <div class="timestamp">{timestamp}</div>
-        </div>
-        """, unsafe_allow_html=True)
-    else:
-        st.markdown(f"""
-        <div class="assistant-message">
-            <div>{message}</div>
+def escape_text(text):
+    return html.escape(text).replace("\n", "<br>")
+
+def message_html(escaped, is_user, timestamp):
+    css_class = "user-message" if is_user else "assistant-message"
+    return f"""
+        <div class="{css_class}">
+            <div>{escaped}</div>
             <div class="timestamp">{timestamp}</div>
         </div>
-        """, unsafe_allow_html=True)
+        """
+
+def add_message(role, content):
+    """Escape and format a message once, when it enters the history"""
+    messages = st.session_state.messages
+    timestamp = datetime.now().strftime("%H:%M")
+    messages.append({
+        "role": role,
+        "content": content,
+        "html": message_html(escape_text(content), role == "user", timestamp),
+    })
+    # Trim whole blocks so the cached chunks stay aligned with the messages
+    while len(messages) > MAX_MESSAGES:
+        del messages[:HISTORY_BLOCK]
+        del st.session_state.history_blocks[:1]
+
+def display_history():
+    """Render the history as cached chunks, only the last partial chunk is joined again"""
+    messages = st.session_state.messages
+    blocks = st.session_state.history_blocks
+    complete = len(messages) // HISTORY_BLOCK
+    while len(blocks) < complete:
+        start = len(blocks) * HISTORY_BLOCK
+        blocks.append("".join(message["html"] for message in messages[start:start + HISTORY_BLOCK]))
+    for block in blocks:
+        st.markdown(block, unsafe_allow_html=True)
+    tail = messages[complete * HISTORY_BLOCK:]
+    if tail:
+        st.markdown("".join(message["html"] for message in tail), unsafe_allow_html=True)
 
 def display_typing_indicator():
     """Display typing indicator"""
@@ -394,7 +517,8 @@ with st.sidebar:
     
     # API Status
     api_status = check_api_status()
-    status_text = "System Online" if api_status else "System Offline"
+    # None until the health thread's first probe has answered
+    status_text = {True: "System Online", False: "System Offline", None: "Checking System"}[api_status]
     
     st.markdown("""
     <div style="display: flex; align-items: center; gap: 0.5rem; margin-bottom: 1rem;">
@@ -416,6 +540,17 @@ with st.sidebar:
             <span>{status_text}</span>
         </div>
         """, unsafe_allow_html=True)
+    elif api_status is None:
+        st.markdown(f"""
+        <div style="background: linear-gradient(135deg, #edf2f7 0%, #e2e8f0 100%); 
+                    color: #2d3748; border: 1px solid #cbd5e0; padding: 0.75rem 1rem; 
+                    border-radius: 8px; margin: 0.5rem 0; display: flex; align-items: center; gap: 0.5rem;">
+            <svg width="16" height="16" fill="#2d3748" viewBox="0 0 24 24">
+                <path d="M12,20A8,8 0 0,0 20,12A8,8 0 0,0 12,4A8,8 0 0,0 4,12A8,8 0 0,0 12,20M12,2A10,10 0 0,1 22,12A10,10 0 0,1 12,22C6.47,22 2,17.5 2,12A10,10 0 0,1 12,2M12.5,7V12.25L17,14.92L16.25,16.15L11,13V7H12.5Z"/>
+            </svg>
+            <span>{status_text}</span>
+        </div>
+        """, unsafe_allow_html=True)
     else:
         st.markdown(f"""
         <div style="background: linear-gradient(135deg, #fed7d7 0%, #feb2b2 100%); 
@@ -428,7 +563,7 @@ with st.sidebar:
         </div>
         """, unsafe_allow_html=True)
     
-    if not api_status:
+    if api_status is False:
         st.markdown("""
         <div style="background: linear-gradient(135deg, #fef5e7 0%, #fed7aa 100%); 
                     color: #744210; border: 1px solid #f6ad55; padding: 0.75rem 1rem; 
@@ -470,12 +605,18 @@ with st.sidebar:
     col1, col2 = st.columns(2)
     with col1:
         if st.button("Clear", use_container_width=True, help="Clear conversation history", key="clear_btn"):
+            if st.session_state.session_ready:
+                end_session(st.session_state.conversation_id)
+            st.session_state.session_ready = False
             st.session_state.messages = []
-            conversation_history.clear()
+            st.session_state.history_blocks = []
+            st.session_state.conversation_history = []
+            st.session_state.conversation_id = uuid.uuid4().hex
             st.rerun()
     
     with col2:
         if st.button("Refresh", use_container_width=True, help="Refresh system status", key="refresh_btn"):
+            get_health_monitor().probe()
             st.rerun()
     
     # Stats
@@ -493,7 +634,7 @@ with st.sidebar:
     with col_stat1:
         st.metric("Messages", message_count)
     with col_stat2:
-        st.metric("Status", "Active" if api_status else "Inactive")
+        st.metric("Status", {True: "Active", False: "Inactive", None: "Checking"}[api_status])
 
 # Professional Main Interface Header
 st.markdown("""
@@ -517,12 +658,13 @@ with chat_container:
     st.markdown('<div class="chat-messages">', unsafe_allow_html=True)
     
     # Display chat history
-    for message in st.session_state.messages:
-        display_message(message["content"], message["role"] == "user")
+    display_history()
     
-    # Display typing indicator if needed
+    # Display typing indicator if needed, streamed tokens replace it in place
     if st.session_state.is_typing:
-        display_typing_indicator()
+        stream_placeholder = st.empty()
+        with stream_placeholder:
+            display_typing_indicator()
     
     st.markdown('</div>', unsafe_allow_html=True)
 
@@ -607,7 +749,8 @@ with st.form(key="chat_form", clear_on_submit=True):
 
 # Process message with professional handling
 if send_button and message_input.strip():
-    if not api_status:
+    # Before the first probe answers the message is sent anyway, a failure shows up as its error
+    if api_status is False:
         st.markdown("""
         <div style="background: linear-gradient(135deg, #fed7d7 0%, #feb2b2 100%); 
                     color: #742a2a; border: 1px solid #fc8181; padding: 0.75rem 1rem; 
@@ -620,10 +763,7 @@ if send_button and message_input.strip():
         """, unsafe_allow_html=True)
     else:
         # Add user message to chat
-        st.session_state.messages.append({
-            "role": "user",
-            "content": message_input.strip()
-        })
+        add_message("user", message_input.strip())
         
         # Show typing indicator
         st.session_state.is_typing = True
@@ -636,13 +776,10 @@ if st.session_state.is_typing and len(st.session_state.messages) > 0:
     if last_message["role"] == "user":
         # Send message to API with professional loading message
         with st.spinner("AI is processing your request... Please wait"):
-            response = send_message_to_api(last_message["content"])
+            response = send_message_to_api(last_message["content"], stream_placeholder)
         
         # Add assistant response
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": response
-        })
+        add_message("assistant", response)
         
         # Hide typing indicator
         st.session_state.is_typing = False
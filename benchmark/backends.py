@@ -0,0 +1,138 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+from datetime import datetime
+import torch
+from transformers import AutoTokenizer
+from api.loader import INT8_WEIGHTS, configure_threads, load_int8, load_merged, prepare_model
+from benchmark.workload import generate_workload
+from utils.tiny_model import build_tiny_llama
+
+BASE_TOKENIZER = 'TinyLlama/TinyLlama-1.1B-intermediate-step-1431k-3T'
+
+
+def rss_bytes():
+    """Current resident set size, the peak where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_backend(backend, merged_path=None, int8_path=None):
+    if merged_path is None:
+        tokenizer = AutoTokenizer.from_pretrained(BASE_TOKENIZER, trust_remote_code=True)
+        return tokenizer, prepare_model(build_tiny_llama(len(tokenizer)), backend)
+    if backend == 'int8' and int8_path and os.path.exists(os.path.join(int8_path, INT8_WEIGHTS)):
+        return AutoTokenizer.from_pretrained(int8_path), load_int8(int8_path)
+    return AutoTokenizer.from_pretrained(merged_path), load_merged(merged_path, backend)
+
+
+def run_backend(backend, prompts, max_new_tokens, merged_path=None, int8_path=None, intra_op=0, inter_op=0):
+    """Load one backend and time greedy generation, meant to run in a fresh process"""
+    configure_threads(intra_op, inter_op)
+    rss_start = rss_bytes()
+    start = time.perf_counter()
+    tokenizer, model = load_backend(backend, merged_path, int8_path)
+    load_seconds = time.perf_counter() - start
+    rss_loaded = rss_bytes()
+
+    def generate(prompt, new_tokens):
+        input_ids = tokenizer(prompt, return_tensors='pt').input_ids
+        with torch.no_grad():
+            outputs = model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=new_tokens,
+                # Fixed-length answers make the backends comparable token for token
+                min_new_tokens=new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.eos_token_id,
+            )
+        return outputs.shape[1] - input_ids.shape[1]
+
+    generate(prompts[0], 4)
+    generated = 0
+    latencies = []
+    for prompt in prompts:
+        request_start = time.perf_counter()
+        generated += generate(prompt, max_new_tokens)
+        latencies.append(time.perf_counter() - request_start)
+    duration = sum(latencies)
+    return {
+        'backend': backend,
+        'load_seconds': load_seconds,
+        'rss_model_mb': (rss_loaded - rss_start) / 2 ** 20,
+        'rss_peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'generated_tokens': generated,
+        'tokens_per_s': generated / duration if duration > 0 else 0.0,
+        'mean_latency_s': duration / len(latencies),
+        'threads': {'intra_op': torch.get_num_threads(), 'inter_op': torch.get_num_interop_threads()},
+    }
+
+
+def compare_backends(backends, prompts, max_new_tokens, merged_path=None, int8_path=None, intra_op=0, inter_op=0):
+    """Run every backend in its own process so RSS and thread settings do not leak between them"""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for backend in backends:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(
+                run_backend, (backend, prompts, max_new_tokens, merged_path, int8_path, intra_op, inter_op)))
+        print(f"[Bench] {backend}: {results[-1]['tokens_per_s']:.1f} tokens/s, "
+              f"{results[-1]['rss_model_mb']:.0f} MB model RSS")
+    report = {'results': results}
+    baseline = next((r for r in results if r['backend'] == 'fp32'), None)
+    if baseline is not None:
+        report['relative_to_fp32'] = {
+            r['backend']: {
+                'speedup': r['tokens_per_s'] / baseline['tokens_per_s'] if baseline['tokens_per_s'] else None,
+                'rss_ratio': r['rss_model_mb'] / baseline['rss_model_mb'] if baseline['rss_model_mb'] > 0 else None,
+            }
+            for r in results
+        }
+    return report
+
+
+def build_prompts(num_prompts, max_turns, seed):
+    workload = generate_workload(num_prompts, 1, max_turns, seed)
+    return ["\n".join(content) + "\n<|assistant|>\n" for content in workload]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare CPU inference backends by tokens/s and memory')
+    parser.add_argument('--backends', nargs='+', default=['fp32', 'int8'], choices=['fp32', 'int8'])
+    parser.add_argument('--tiny', action='store_true', help='use a tiny random-weight model instead of saved_models')
+    parser.add_argument('--merged-path', default='saved_models/TinyLlama-1.1B-Chat-v1.2-merged')
+    parser.add_argument('--int8-path', default='saved_models/TinyLlama-1.1B-Chat-v1.2-int8')
+    parser.add_argument('--prompts', type=int, default=8)
+    parser.add_argument('--max-turns', type=int, default=4)
+    parser.add_argument('--max-new-tokens', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 for the PyTorch default')
+    parser.add_argument('--interop-threads', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    report = compare_backends(
+        args.backends,
+        build_prompts(args.prompts, args.max_turns, args.seed),
+        args.max_new_tokens,
+        merged_path=None if args.tiny else args.merged_path,
+        int8_path=None if args.tiny else args.int8_path,
+        intra_op=args.threads,
+        inter_op=args.interop_threads,
+    )
+    report['config'] = vars(args)
+    report['timestamp'] = datetime.now().isoformat()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+import requests
+from utils.data_model import Message
+from benchmark.workload import generate_workload, load_workload, save_workload
+
+_local = threading.local()
+
+
+def get_session():
+    # One keep-alive session per worker thread
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+
+def send_conversation(base_url, content, stream=True, use_cache=True, timeout=300, scheduled=None):
+    """Send one request, timing it from ``scheduled`` (its intended arrival) when given"""
+    payload = Message(timestamp=datetime.now().isoformat(), content=content, use_cache=use_cache).model_dump()
+    result = {'ok': False, 'ttft': None, 'generated_tokens': None, 'cached': None}
+    session = get_session()
+    sent = time.perf_counter()
+    start = sent if scheduled is None else scheduled
+    result['send_lag'] = sent - start
+    try:
+        if stream:
+            with session.post(f"{base_url}/api/v1/conversation/stream", json=payload, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[len("data: "):])
+                    if "token" in event:
+                        if result['ttft'] is None:
+                            result['ttft'] = time.perf_counter() - start
+                    elif "error" in event:
+                        raise RuntimeError(event["error"])
+                    elif "generated_tokens" in event:
+                        result['generated_tokens'] = event["generated_tokens"]
+                        result['cached'] = event.get("cached")
+        else:
+            response = session.post(f"{base_url}/api/v1/conversation", json=payload, timeout=timeout)
+            response.raise_for_status()
+            result['generated_tokens'] = response.json().get('usage', {}).get('completion_tokens')
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = str(e)
+    result['latency'] = time.perf_counter() - start
+    return result
+
+
+def run_load(base_url, workload, concurrency=8, rate=0.0, stream=True, use_cache=True, seed=0):
+    """Drive the API with ``workload`` and return per-request results and wall time
+
+    ``rate`` > 0 issues requests as a Poisson process of that many requests per
+    second (open loop), otherwise requests are sent back to back by
+    ``concurrency`` workers (closed loop). In the open loop every request gets
+    its own worker, so a slow server never holds back later arrivals, and
+    latency is measured from the scheduled arrival rather than from when the
+    request was actually sent, which would hide the queueing (coordinated
+    omission).
+    """
+    rng = random.Random(seed)
+    futures = []
+    start = time.perf_counter()
+    # Threads are only started when no idle one is left, so the open loop grows to whatever is in flight
+    workers = max(len(workload), 1) if rate > 0 else concurrency
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        next_arrival = start
+        for content in workload:
+            scheduled = None
+            if rate > 0:
+                next_arrival += rng.expovariate(rate)
+                scheduled = next_arrival
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(
+                send_conversation, base_url, content, stream, use_cache, scheduled=scheduled))
+        results = [future.result() for future in futures]
+    return results, time.perf_counter() - start
+
+
+def build_report(results, duration, config):
+    ok = [r for r in results if r['ok']]
+    tokens = sum(r['generated_tokens'] or 0 for r in ok)
+    errors = [r.get('error') for r in results if not r['ok']]
+    return {
+        'config': config,
+        'timestamp': datetime.now().isoformat(),
+        'requests': len(results),
+        'errors': len(errors),
+        'error_rate': len(errors) / len(results) if results else 0.0,
+        'error_samples': errors[:5],
+        'duration_s': duration,
+        'throughput_rps': len(ok) / duration if duration > 0 else 0.0,
+        'tokens_per_s': tokens / duration if duration > 0 else 0.0,
+        'latency_s': summarize([r['latency'] for r in ok]),
+        'ttft_s': summarize([r['ttft'] for r in ok if r['ttft'] is not None]),
+        # How late the client sent requests after their scheduled arrival, already part of latency and ttft
+        'send_lag_s': summarize([r['send_lag'] for r in results]),
+    }
+
+
+def wait_until_ready(base_url, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/readyz", timeout=2).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(1)
+    raise TimeoutError(f"API at {base_url} was not ready after {timeout}s")
+
+
+@contextmanager
+def boot_api(port=5003, env=None, timeout=600):
+    """Start the API on a tiny random-weight model on CPU for the duration of the block"""
+    process_env = {**os.environ, 'TINY_RANDOM_MODEL': '1', 'CUDA_VISIBLE_DEVICES': '', **(env or {})}
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'api.app:app', '--host', '127.0.0.1', '--port', str(port)],
+        env=process_env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_ready(base_url, timeout)
+        yield base_url
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def parse_env(pairs):
+    return dict(pair.split('=', 1) for pair in pairs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load-test the TinyLlama chat API')
+    parser.add_argument('--url', default='http://localhost:8082')
+    parser.add_argument('--boot', action='store_true', help='start a local API on a tiny random-weight model')
+    parser.add_argument('--port', type=int, default=5013)
+    parser.add_argument('--env', action='append', default=[], help='KEY=VALUE passed to the booted API')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8, help='closed-loop workers, ignored with --rate')
+    parser.add_argument('--rate', type=float, default=0.0, help='requests per second, 0 for closed loop')
+    parser.add_argument('--min-turns', type=int, default=1)
+    parser.add_argument('--max-turns', type=int, default=8)
+    parser.add_argument('--workload', help='replay conversations from a JSONL file')
+    parser.add_argument('--save-workload', help='write the generated workload to a JSONL file')
+    parser.add_argument('--no-stream', action='store_true', help='use the non-streaming endpoint')
+    parser.add_argument('--no-cache', action='store_true', help='bypass the response cache')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    if args.workload:
+        workload = load_workload(args.workload)[:args.requests]
+    else:
+        workload = generate_workload(args.requests, args.min_turns, args.max_turns, args.seed)
+    if args.save_workload:
+        save_workload(args.save_workload, workload)
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'save_workload')}
+
+    def run(base_url):
+        results, duration = run_load(
+            base_url, workload, args.concurrency, args.rate,
+            stream=not args.no_stream, use_cache=not args.no_cache, seed=args.seed,
+        )
+        return build_report(results, duration, config)
+
+    if args.boot:
+        with boot_api(args.port, parse_env(args.env)) as base_url:
+            report = run(base_url)
+    else:
+        report = run(args.url)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+import requests
+from benchmark.loadgen import boot_api, wait_until_ready
+from nginx.generate_config import write_config
+
+
+@contextmanager
+def boot_nginx(servers, port, timeout=30):
+    """Run nginx in the foreground in front of ``servers`` for the duration of the block"""
+    if shutil.which('nginx') is None:
+        raise SystemExit("nginx is not on PATH, start the compose profile and pass --url instead")
+    with tempfile.TemporaryDirectory() as prefix:
+        os.makedirs(os.path.join(prefix, 'logs'))
+        config_path = os.path.join(prefix, 'nginx.conf')
+        write_config(config_path, servers, listen=port, access_log=os.path.join(prefix, 'logs', 'access.log'))
+        process = subprocess.Popen([
+            'nginx', '-p', prefix, '-c', config_path, '-e', 'stderr',
+            '-g', f"daemon off; pid {os.path.join(prefix, 'nginx.pid')};",
+        ])
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            wait_until_ready(base_url, timeout)
+            yield base_url
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+
+def send_turn(session, base_url, conversation_id, content, session_id=None):
+    """Send one non-streaming turn and return the replica that answered it"""
+    payload = {
+        'timestamp': datetime.now().isoformat(),
+        'content': content,
+        'session_id': session_id,
+        'max_new_tokens': 8,
+        'use_cache': False,
+    }
+    headers = {'X-Conversation-ID': conversation_id} if conversation_id else {}
+    response = session.post(f"{base_url}/api/v1/conversation", json=payload, headers=headers, timeout=120)
+    response.raise_for_status()
+    return response.headers.get('X-Replica')
+
+
+def check_replicas(base_url, conversations=16, turns=3):
+    session = requests.Session()
+    pinned = {}
+    for i in range(conversations):
+        conversation_id = uuid.uuid4().hex
+        history = []
+        replicas = []
+        for turn in range(turns):
+            history.append(f"<|user|>\nConversation {i}, turn {turn}")
+            replicas.append(send_turn(session, base_url, conversation_id, history))
+        pinned[conversation_id] = replicas
+
+    # A server-side session is created with the same header as its turns, so it lives where they go
+    conversation_id = uuid.uuid4().hex
+    response = session.post(f"{base_url}/api/v1/sessions", headers={'X-Conversation-ID': conversation_id}, timeout=30)
+    response.raise_for_status()
+    session_replicas = [response.headers.get('X-Replica')]
+    for turn in range(2):
+        session_replicas.append(send_turn(
+            session, base_url, conversation_id, [f"<|user|>\nSession turn {turn}"], session_id=conversation_id))
+
+    unkeyed = Counter(send_turn(session, base_url, None, ["<|user|>\nNo conversation key"]) for _ in range(conversations))
+    spread = Counter(replicas[0] for replicas in pinned.values())
+    checks = {
+        'conversations_pinned': all(len(set(replicas)) == 1 for replicas in pinned.values()),
+        'conversations_spread': len(spread) > 1,
+        'session_pinned': len(set(session_replicas)) == 1,
+    }
+    return {
+        'conversations': conversations,
+        'turns': turns,
+        'conversations_per_replica': dict(spread),
+        'unkeyed_requests_per_replica': dict(unkeyed),
+        'session_replicas': session_replicas,
+        'checks': checks,
+        'passed': all(checks.values()),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check conversation-affine balancing across API replicas')
+    parser.add_argument('--url', help='nginx in front of running replicas, e.g. http://localhost:8083')
+    parser.add_argument('--replicas', type=int, default=2, help='tiny CPU replicas to boot when --url is not given')
+    parser.add_argument('--port', type=int, default=5020, help='first replica port, nginx listens one past the last')
+    parser.add_argument('--conversations', type=int, default=16)
+    parser.add_argument('--turns', type=int, default=3)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.url:
+        report = check_replicas(args.url, args.conversations, args.turns)
+    else:
+        with ExitStack() as stack:
+            ports = [args.port + i for i in range(args.replicas)]
+            for i, port in enumerate(ports):
+                stack.enter_context(boot_api(port, {'REPLICA_ID': f'replica-{i}', 'INFERENCE_BACKEND': 'fp32'}))
+            base_url = stack.enter_context(boot_nginx([f'127.0.0.1:{port}' for port in ports], ports[-1] + 1))
+            report = check_replicas(base_url, args.conversations, args.turns)
+    report['duration'] = time.perf_counter() - start
+
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['passed'] else 1)
@@ -0,0 +1,40 @@
+import json
+import random
+
+WORDS = (
+    "model data python function explain quantum history music travel write list "
+    "compare summary recipe code error network memory book science answer question "
+    "example simple detail reason story plan budget health language learn"
+).split()
+
+
+def random_text(rng, min_words, max_words):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def generate_conversation(rng, turns, min_words=5, max_words=40):
+    """Role-tagged history of ``turns`` user messages ending on a user turn"""
+    content = []
+    for turn in range(turns):
+        content.append(f"<|user|>\n{random_text(rng, min_words, max_words)}")
+        if turn < turns - 1:
+            content.append(f"<|assistant|>\n{random_text(rng, min_words * 2, max_words * 2)}")
+    return content
+
+
+def generate_workload(num_requests, min_turns=1, max_turns=8, seed=0):
+    """Conversations whose history length is uniform in [min_turns, max_turns]"""
+    rng = random.Random(seed)
+    return [generate_conversation(rng, rng.randint(min_turns, max_turns)) for _ in range(num_requests)]
+
+
+def load_workload(path):
+    """Replay conversations from a JSONL file with one ``{"content": [...]}`` object per line"""
+    with open(path) as f:
+        return [json.loads(line)['content'] for line in f if line.strip()]
+
+
+def save_workload(path, workload):
+    with open(path, 'w') as f:
+        for content in workload:
+            f.write(json.dumps({'content': content}) + "\n")
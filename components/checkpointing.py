@@ -0,0 +1,154 @@
+import dataclasses
+import glob
+import json
+import os
+import random
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from peft import get_peft_model_state_dict
+from safetensors.torch import save_file
+from transformers import TrainerCallback
+
+COMPLETE_MARKER = 'COMPLETE'
+DATA_STATE_FILE = 'data_state.json'
+CHECKPOINT_PATTERN = re.compile(r'checkpoint-(\d+)$')
+
+
+def to_cpu(obj):
+    """Copy every tensor in a nested state dict to the CPU so training can keep mutating the originals"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    # Same layout as transformers' rng_state.pth so Trainer restores it on resume
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'cpu': torch.random.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.random.get_rng_state_all()
+    return state
+
+
+def list_checkpoints(output_dir):
+    """Completed checkpoints in ``output_dir``, oldest first"""
+    checkpoints = []
+    for path in glob.glob(os.path.join(output_dir, 'checkpoint-*')):
+        match = CHECKPOINT_PATTERN.search(path)
+        if match and os.path.exists(os.path.join(path, COMPLETE_MARKER)):
+            checkpoints.append((int(match.group(1)), path))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def latest_checkpoint(output_dir):
+    checkpoints = list_checkpoints(output_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+def read_data_state(checkpoint):
+    path = os.path.join(checkpoint, DATA_STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _fsync_dir(path):
+    for name in os.listdir(path):
+        with open(os.path.join(path, name), 'rb') as f:
+            os.fsync(f.fileno())
+
+
+class AsyncCheckpointCallback(TrainerCallback):
+    """Save adapter-only checkpoints every ``save_steps`` without blocking training
+
+    On the training thread the adapter weights, optimizer and scheduler
+    state and RNG state are only copied to the CPU. A writer thread then
+    saves them in the layout ``Trainer(resume_from_checkpoint=...)``
+    expects, marks the directory complete and renames it into place, so a
+    crash mid-write never leaves a checkpoint that looks valid. Only the
+    newest ``keep_last`` checkpoints are kept. ``data_state_fn(consumed)``
+    may return a JSON-serializable position of the training data after
+    ``consumed`` sequences, for datasets the Trainer cannot skip through.
+    """
+
+    def __init__(self, output_dir, save_steps, keep_last=3, data_state_fn=None):
+        self.output_dir = output_dir
+        self.save_steps = save_steps
+        self.keep_last = keep_last
+        self.data_state_fn = data_state_fn
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self.pending = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        # Leftovers of writes interrupted by a crash
+        for path in glob.glob(os.path.join(self.output_dir, 'checkpoint-*.tmp')):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def on_step_end(self, args, state, control, model=None, optimizer=None, lr_scheduler=None, **kwargs):
+        if self.save_steps <= 0 or state.global_step % self.save_steps != 0 or not state.is_world_process_zero:
+            return
+        # Only one write in flight, a slow disk throttles checkpointing instead of piling up copies
+        self.wait()
+        consumed = (state.global_step * args.per_device_train_batch_size
+                    * args.gradient_accumulation_steps * args.world_size)
+        snapshot = {
+            'step': state.global_step,
+            'adapter': {key: value.contiguous() for key, value in to_cpu(get_peft_model_state_dict(model)).items()},
+            'adapter_config': model.peft_config[model.active_adapter],
+            'optimizer': to_cpu(optimizer.state_dict()) if optimizer is not None else None,
+            'scheduler': lr_scheduler.state_dict() if lr_scheduler is not None else None,
+            'trainer_state': json.dumps(dataclasses.asdict(state), indent=2, sort_keys=True) + "\n",
+            'rng': rng_state(),
+            'data': self.data_state_fn(consumed) if self.data_state_fn is not None else None,
+        }
+        self.pending = self.executor.submit(self._write, snapshot)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def _write(self, snapshot):
+        path = os.path.join(self.output_dir, f"checkpoint-{snapshot['step']}")
+        tmp_path = f'{path}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        save_file(snapshot['adapter'], os.path.join(tmp_path, 'adapter_model.safetensors'))
+        snapshot['adapter_config'].save_pretrained(tmp_path)
+        if snapshot['optimizer'] is not None:
+            torch.save(snapshot['optimizer'], os.path.join(tmp_path, 'optimizer.pt'))
+        if snapshot['scheduler'] is not None:
+            torch.save(snapshot['scheduler'], os.path.join(tmp_path, 'scheduler.pt'))
+        torch.save(snapshot['rng'], os.path.join(tmp_path, 'rng_state.pth'))
+        with open(os.path.join(tmp_path, 'trainer_state.json'), 'w') as f:
+            f.write(snapshot['trainer_state'])
+        if snapshot['data'] is not None:
+            with open(os.path.join(tmp_path, DATA_STATE_FILE), 'w') as f:
+                json.dump(snapshot['data'], f)
+        _fsync_dir(tmp_path)
+        # The marker is written last, a directory without it is never resumed from
+        with open(os.path.join(tmp_path, COMPLETE_MARKER), 'w') as f:
+            f.write(str(snapshot['step']))
+            os.fsync(f.fileno())
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        print(f'[Checkpoint] Saved {path}')
+
+        for old in list_checkpoints(self.output_dir)[:-self.keep_last] if self.keep_last > 0 else []:
+            shutil.rmtree(old, ignore_errors=True)
+            print(f'[Checkpoint] Removed {old}')
@@ -0,0 +1,274 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+from datetime import datetime
+import torch
+import torch.nn.functional as F
+from datasets import load_dataset
+from peft import LoraConfig, PeftModel, get_peft_model
+from transformers import AutoModelForCausalLM
+from api.loader import quantization_kwargs
+from components.preprocess import BASE_MODEL, DATASET_NAME, load_tokenizers, tokenizer_fingerprint
+from utils.io import file_sha256
+from utils.tiny_model import build_tiny_llama
+
+REPORT_FILE = 'eval_report.json'
+ADAPTER_WEIGHTS = 'adapter_model.safetensors'
+CACHE_DIR = 'eval_cache'
+# Bump whenever a metric changes so cached base results are recomputed
+EVAL_VERSION = 1
+
+
+def load_examples(source, split='test_sft', max_examples=500):
+    """Conversations ending on an assistant turn, from the hub or a local JSONL/parquet file"""
+    if os.path.exists(source):
+        builder = 'parquet' if source.endswith('.parquet') else 'json'
+        dataset = load_dataset(builder, data_files=source, split='train')
+    else:
+        dataset = load_dataset(source, split=split)
+    examples = []
+    for row in dataset:
+        messages = row['messages']
+        if len(messages) >= 2 and messages[-1]['role'] == 'assistant':
+            examples.append(messages)
+        if len(examples) >= max_examples:
+            break
+    return examples
+
+
+def encode_examples(examples, tokenizer, template_tokenizer, max_length, max_new_tokens):
+    """Full conversations for perplexity, and prompts with their reference answer for generation"""
+    encoded = []
+    for messages in examples:
+        full_text = template_tokenizer.apply_chat_template(messages, tokenize=False)
+        prompt_text = template_tokenizer.apply_chat_template(messages[:-1], tokenize=False, add_generation_prompt=True)
+        encoded.append({
+            'input_ids': tokenizer(full_text)['input_ids'][:max_length],
+            # Keep the end of long prompts, that is where the question is
+            'prompt_ids': tokenizer(prompt_text)['input_ids'][-(max_length - max_new_tokens):],
+            'reference': messages[-1]['content'],
+        })
+    return encoded
+
+
+def length_sorted_batches(lengths, max_batch_tokens, max_batch_size=64):
+    """Index batches of similar length, longest first, so padding stays small and OOMs show up early"""
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # Rows are padded to the first (longest) member of the batch
+        width = lengths[batch[0]] if batch else lengths[i]
+        if batch and ((len(batch) + 1) * width > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def negative_log_likelihood(model, sequences, pad_token_id, max_batch_tokens):
+    """(summed NLL, predicted tokens) for every sequence"""
+    results = [None] * len(sequences)
+    for batch in length_sorted_batches([len(s) for s in sequences], max_batch_tokens):
+        width = max(len(sequences[i]) for i in batch)
+        input_ids = torch.full((len(batch), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        for row, i in enumerate(batch):
+            input_ids[row, :len(sequences[i])] = torch.tensor(sequences[i])
+            attention_mask[row, :len(sequences[i])] = 1
+        input_ids = input_ids.to(model.device)
+        attention_mask = attention_mask.to(model.device)
+        with torch.no_grad():
+            logits = model(input_ids=input_ids, attention_mask=attention_mask).logits.float()
+        labels = input_ids[:, 1:].masked_fill(attention_mask[:, 1:] == 0, -100)
+        losses = F.cross_entropy(logits[:, :-1].transpose(1, 2), labels, reduction='none', ignore_index=-100)
+        for row, i in enumerate(batch):
+            results[i] = (losses[row].sum().item(), int(attention_mask[row, 1:].sum().item()))
+    return results
+
+
+def generate_answers(model, tokenizer, prompts, max_new_tokens, max_batch_tokens):
+    answers = [None] * len(prompts)
+    for batch in length_sorted_batches([len(p) + max_new_tokens for p in prompts], max_batch_tokens):
+        inputs = tokenizer.pad({'input_ids': [prompts[i] for i in batch]}, padding=True, return_tensors='pt')
+        inputs = inputs.to(model.device)
+        with torch.no_grad():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+        width = inputs['input_ids'].shape[1]
+        for row, i in enumerate(batch):
+            answers[i] = tokenizer.decode(outputs[row, width:], skip_special_tokens=True).strip()
+    return answers
+
+
+def rouge_l(prediction, reference):
+    """ROUGE-L F1 over whitespace tokens"""
+    a, b = prediction.split(), reference.split()
+    if not a or not b:
+        return 0.0
+    previous = [0] * (len(b) + 1)
+    for token in a:
+        current = [0]
+        for j, other in enumerate(b):
+            current.append(previous[j] + 1 if token == other else max(previous[j + 1], current[j]))
+        previous = current
+    lcs = previous[-1]
+    if lcs == 0:
+        return 0.0
+    precision, recall = lcs / len(a), lcs / len(b)
+    return 2 * precision * recall / (precision + recall)
+
+
+def evaluate_model(model, tokenizer, encoded, max_new_tokens, max_batch_tokens):
+    """Per-example NLL, token count, generated answer and ROUGE-L"""
+    nll = negative_log_likelihood(model, [e['input_ids'] for e in encoded], tokenizer.pad_token_id, max_batch_tokens)
+    answers = generate_answers(model, tokenizer, [e['prompt_ids'] for e in encoded], max_new_tokens, max_batch_tokens)
+    return [
+        {'nll': loss, 'tokens': tokens, 'answer': answer, 'rouge_l': rouge_l(answer, example['reference'])}
+        for (loss, tokens), answer, example in zip(nll, answers, encoded)
+    ]
+
+
+def summarize(results):
+    tokens = sum(r['tokens'] for r in results)
+    nll = sum(r['nll'] for r in results)
+    return {
+        'perplexity': math.exp(nll / tokens) if tokens else None,
+        'rouge_l': sum(r['rouge_l'] for r in results) / len(results) if results else None,
+        'examples': len(results),
+        'tokens': tokens,
+    }
+
+
+def cache_fingerprint(base_model, tokenizer, template_tokenizer, encoded, max_new_tokens):
+    payload = {
+        'version': EVAL_VERSION,
+        'base_model': base_model,
+        'tokenizer': tokenizer_fingerprint(tokenizer),
+        'template': hashlib.sha256(template_tokenizer.chat_template.encode()).hexdigest(),
+        'examples': hashlib.sha256(json.dumps(encoded, sort_keys=True).encode()).hexdigest(),
+        'max_new_tokens': max_new_tokens,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def base_results(model, tokenizer, encoded, max_new_tokens, max_batch_tokens, cache_path):
+    """Base-model results from the cache, computed with the adapter disabled on a miss"""
+    if os.path.exists(cache_path):
+        print(f'[Eval] Reusing base results from {cache_path}')
+        with open(cache_path) as f:
+            return json.load(f)
+    print('[Eval] Evaluating the base model')
+    with model.disable_adapter():
+        results = evaluate_model(model, tokenizer, encoded, max_new_tokens, max_batch_tokens)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f'{cache_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(results, f)
+    os.replace(tmp_path, cache_path)
+    return results
+
+
+def load_model(adapter_path, base_model=BASE_MODEL, tiny=False, vocab_size=None):
+    if tiny:
+        base = build_tiny_llama(vocab_size)
+        if not os.path.exists(adapter_path):
+            # A fresh LoRA is an identity update, enough to exercise the pipeline on CPU
+            config = LoraConfig(r=8, lora_alpha=16, task_type='CAUSAL_LM', target_modules=['q_proj', 'v_proj'])
+            model = get_peft_model(base, config)
+            model.save_pretrained(adapter_path)
+            return model.eval()
+    else:
+        base = AutoModelForCausalLM.from_pretrained(base_model, low_cpu_mem_usage=True, **quantization_kwargs())
+    return PeftModel.from_pretrained(base, adapter_path).eval()
+
+
+def evaluate_adapter(adapter_path, source=DATASET_NAME, split='test_sft', max_examples=500, max_length=2048,
+                     max_new_tokens=128, max_batch_tokens=16384, max_perplexity_ratio=1.0, min_rouge_delta=-0.01,
+                     cache_dir=CACHE_DIR, tiny=False):
+    """Score an adapter against its base model and decide whether it may ship"""
+    tokenizer, template_tokenizer = load_tokenizers()
+    tokenizer.pad_token = '<PAD>'
+    tokenizer.padding_side = 'left'
+    model = load_model(adapter_path, tiny=tiny, vocab_size=len(tokenizer))
+    base_model = 'tiny-random' if tiny else BASE_MODEL
+
+    examples = load_examples(source, split, max_examples)
+    encoded = encode_examples(examples, tokenizer, template_tokenizer, max_length, max_new_tokens)
+    fingerprint = cache_fingerprint(base_model, tokenizer, template_tokenizer, encoded, max_new_tokens)
+    base = base_results(model, tokenizer, encoded, max_new_tokens, max_batch_tokens,
+                        os.path.join(cache_dir, f'base-{fingerprint}.json'))
+    print(f'[Eval] Evaluating {adapter_path} on {len(encoded)} examples')
+    adapter = evaluate_model(model, tokenizer, encoded, max_new_tokens, max_batch_tokens)
+
+    base_summary, adapter_summary = summarize(base), summarize(adapter)
+    gates = {
+        'perplexity': adapter_summary['perplexity'] <= base_summary['perplexity'] * max_perplexity_ratio,
+        'rouge_l': adapter_summary['rouge_l'] - base_summary['rouge_l'] >= min_rouge_delta,
+    }
+    weights = os.path.join(adapter_path, ADAPTER_WEIGHTS)
+    return {
+        'adapter': adapter_path,
+        'adapter_sha256': file_sha256(weights) if os.path.exists(weights) else None,
+        'base_model': base_model,
+        'dataset': source,
+        'split': split,
+        'timestamp': datetime.now().isoformat(),
+        'base': base_summary,
+        'adapter_metrics': adapter_summary,
+        'delta': {
+            'perplexity': adapter_summary['perplexity'] - base_summary['perplexity'],
+            'rouge_l': adapter_summary['rouge_l'] - base_summary['rouge_l'],
+        },
+        'thresholds': {'max_perplexity_ratio': max_perplexity_ratio, 'min_rouge_delta': min_rouge_delta},
+        'gates': gates,
+        'passed': all(gates.values()),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate a fine-tuned adapter against its base model')
+    parser.add_argument('--model-name', default='TinyLlama-1.1B-Chat-v1.2')
+    parser.add_argument('--models-dir', default='saved_models')
+    parser.add_argument('--dataset', default=DATASET_NAME, help='hub dataset or a local JSONL/parquet file')
+    parser.add_argument('--split', default='test_sft')
+    parser.add_argument('--max-examples', type=int, default=500)
+    parser.add_argument('--max-length', type=int, default=2048)
+    parser.add_argument('--max-new-tokens', type=int, default=128)
+    parser.add_argument('--batch-tokens', type=int, default=16384, help='padded tokens per batch')
+    parser.add_argument('--max-perplexity-ratio', type=float, default=1.0,
+                        help='adapter perplexity may be at most this multiple of the base perplexity')
+    parser.add_argument('--min-rouge-delta', type=float, default=-0.01,
+                        help='lowest allowed change in ROUGE-L versus the base model')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--tiny', action='store_true', help='use a tiny random-weight base model on CPU')
+    parser.add_argument('--output', help=f'report path, defaults to {REPORT_FILE} inside the adapter directory')
+    args = parser.parse_args()
+
+    adapter_path = os.path.join(args.models_dir, args.model_name)
+    report = evaluate_adapter(
+        adapter_path,
+        source=args.dataset,
+        split=args.split,
+        max_examples=args.max_examples,
+        max_length=args.max_length,
+        max_new_tokens=args.max_new_tokens,
+        max_batch_tokens=args.batch_tokens,
+        max_perplexity_ratio=args.max_perplexity_ratio,
+        min_rouge_delta=args.min_rouge_delta,
+        cache_dir=args.cache_dir,
+        tiny=args.tiny,
+    )
+    output = args.output or os.path.join(adapter_path, REPORT_FILE)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({key: report[key] for key in ('base', 'adapter_metrics', 'gates', 'passed')}, indent=2))
+    print(f'[Eval] Report written to {output}')
@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import shutil
+import torch
+from peft import AutoPeftModelForCausalLM
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from api.loader import INT8_WEIGHTS, quantize_int8
+from utils.io import COMPLETE_MARKER, file_sha256
+
+BASE_MODEL = 'TinyLlama/TinyLlama-1.1B-intermediate-step-1431k-3T'
+# Records which adapter weights a merged export was built from
+EXPORT_FILE = 'export.json'
+ADAPTER_WEIGHTS = 'adapter_model.safetensors'
+
+
+def export_merged(adapter_path, output_path, max_shard_size='500MB', dtype=torch.float16):
+    """Merge a PEFT adapter into its base model once and save it as sharded safetensors"""
+    print(f'[Export] Merging adapter {adapter_path}')
+    # Merge in full precision, an 8-bit base would bake quantization error into the weights
+    model = AutoPeftModelForCausalLM.from_pretrained(adapter_path, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+    merged_model = model.merge_and_unload().to(dtype)
+
+    tmp_path = f'{output_path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    merged_model.save_pretrained(tmp_path, safe_serialization=True, max_shard_size=max_shard_size)
+    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL, trust_remote_code=True)
+    tokenizer.save_pretrained(tmp_path)
+    with open(os.path.join(tmp_path, EXPORT_FILE), 'w') as f:
+        json.dump({'adapter_sha256': file_sha256(os.path.join(adapter_path, ADAPTER_WEIGHTS))}, f, indent=2)
+    # Same marker a finished S3 download leaves, the API only loads complete exports
+    open(os.path.join(tmp_path, COMPLETE_MARKER), 'w').close()
+
+    # Swap the finished export in place so the API never sees a partial checkpoint
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.replace(tmp_path, output_path)
+    print(f'[Export] Merged model written to {output_path}')
+
+
+def export_int8(merged_path, output_path):
+    """Quantize a merged checkpoint to dynamic int8 once so CPU replicas skip it at startup"""
+    print(f'[Export] Quantizing {merged_path} to int8')
+    model = AutoModelForCausalLM.from_pretrained(merged_path, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+    model = quantize_int8(model)
+
+    tmp_path = f'{output_path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    # Quantized modules have no safetensors format, pickle the whole model
+    torch.save(model, os.path.join(tmp_path, INT8_WEIGHTS))
+    model.config.save_pretrained(tmp_path)
+    AutoTokenizer.from_pretrained(merged_path).save_pretrained(tmp_path)
+
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.replace(tmp_path, output_path)
+    print(f'[Export] Int8 model written to {output_path}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge a fine-tuned adapter and export it for serving')
+    parser.add_argument('--model-name', default='TinyLlama-1.1B-Chat-v1.2')
+    parser.add_argument('--models-dir', default='saved_models')
+    parser.add_argument('--max-shard-size', default='500MB')
+    parser.add_argument('--int8', action='store_true', help='also write a dynamic int8 model for the CPU backend')
+    args = parser.parse_args()
+
+    merged_path = os.path.join(args.models_dir, f'{args.model_name}-merged')
+    export_merged(
+        os.path.join(args.models_dir, args.model_name),
+        merged_path,
+        max_shard_size=args.max_shard_size,
+    )
+    if args.int8:
+        export_int8(merged_path, os.path.join(args.models_dir, f'{args.model_name}-int8'))
@@ -0,0 +1,103 @@
+import importlib.util
+from bisect import bisect_left, insort
+
+
+def best_fit_decreasing(lengths, capacity):
+    """Group item indices into bins of at most ``capacity`` tokens
+
+    Items are placed longest first into the bin whose free space fits them
+    most tightly, opening a new bin when none does. Longer items are
+    counted at ``capacity`` and truncated by the caller. Bins are tracked by
+    their free space, so each placement costs a bisect over at most
+    ``capacity + 1`` distinct values.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: (-min(lengths[i], capacity), i))
+    bins = []
+    by_free = {}
+    free_sizes = []
+    for i in order:
+        length = min(lengths[i], capacity)
+        position = bisect_left(free_sizes, length)
+        if position < len(free_sizes):
+            free = free_sizes[position]
+            bin_id = by_free[free].pop()
+            if not by_free[free]:
+                del by_free[free]
+                free_sizes.pop(position)
+        else:
+            free = capacity
+            bin_id = len(bins)
+            bins.append([])
+        bins[bin_id].append(i)
+        free -= length
+        if free not in by_free:
+            by_free[free] = []
+            insort(free_sizes, free)
+        by_free[free].append(bin_id)
+    return bins
+
+
+def concat_documents(documents, max_length):
+    """Concatenate documents truncated to ``max_length`` into (input_ids, seq_lengths)
+
+    ``seq_lengths`` is the column TRL's padding-free collator reads the
+    document boundaries from, it restarts the position ids at each one.
+    """
+    input_ids = []
+    seq_lengths = []
+    for document in documents:
+        document = document[:max_length]
+        input_ids.extend(document)
+        seq_lengths.append(len(document))
+    return input_ids, seq_lengths
+
+
+def pack_documents(documents, max_length):
+    """Best-fit pack token id lists into (input_ids, seq_lengths) sequences"""
+    bins = best_fit_decreasing([len(document) for document in documents], max_length)
+    return [concat_documents([documents[i] for i in members], max_length) for members in bins]
+
+
+def packed_attention(attn_implementation):
+    """Attention implementation for padding-free packed batches
+
+    Only flash attention turns the restarting position ids into separate
+    varlen sequences. Other implementations see one long sequence per row,
+    so documents packed together attend to each other.
+    """
+    if attn_implementation == 'flash_attention_2' and importlib.util.find_spec('flash_attn') is None:
+        print('[Packing] flash_attn is not installed, falling back to sdpa')
+        attn_implementation = 'sdpa'
+    if attn_implementation != 'flash_attention_2':
+        print(f'[Packing] WARNING: {attn_implementation} attention does not isolate packed documents, '
+              f'install flash-attn for per-document attention')
+    return attn_implementation
+
+
+def packing_stats(lengths, num_sequences, capacity):
+    """Padding and truncation waste of packing documents of ``lengths`` into sequences, in tokens"""
+    total = sum(lengths)
+    kept = sum(min(length, capacity) for length in lengths)
+    slots = num_sequences * capacity
+    return {
+        'documents': len(lengths),
+        'sequences': num_sequences,
+        'tokens': total,
+        'truncated_tokens': total - kept,
+        'padding_tokens': slots - kept,
+        'efficiency': kept / slots if slots else 0.0,
+    }
+
+
+def merge_packing_stats(total, stats):
+    """Running totals of packing_stats over several packings"""
+    merged = {key: total.get(key, 0) + stats[key] for key in stats if key != 'efficiency'}
+    kept = merged['tokens'] - merged['truncated_tokens']
+    merged['efficiency'] = kept / (kept + merged['padding_tokens']) if kept else 0.0
+    return merged
+
+
+def log_packing_stats(stats, prefix='[Packing]'):
+    print(f"{prefix} {stats['documents']} documents into {stats['sequences']} sequences, "
+          f"{stats['efficiency']:.1%} of token slots used, {stats['padding_tokens']} padding "
+          f"and {stats['truncated_tokens']} truncated tokens")
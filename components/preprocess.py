@@ -0,0 +1,145 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from datasets import Dataset, load_dataset, load_from_disk
+from transformers import AutoTokenizer
+from components.packing import best_fit_decreasing, concat_documents, log_packing_stats, packing_stats
+
+DATASET_NAME = 'HuggingFaceH4/ultrachat_200k'
+BASE_MODEL = 'TinyLlama/TinyLlama-1.1B-intermediate-step-1431k-3T'
+TEMPLATE_MODEL = 'TinyLlama/TinyLlama-1.1B-Chat-v1.0'
+CACHE_DIR = 'data_cache'
+# Bump whenever tokenization or packing changes so stale shards are never reused
+PREPROCESS_VERSION = 3
+
+
+def resolve_revision(dataset_name, revision):
+    """Pin a branch name to the commit it points at, keep it as is when offline"""
+    try:
+        from huggingface_hub import HfApi
+        return HfApi().dataset_info(dataset_name, revision=revision).sha
+    except Exception:
+        return revision
+
+
+def tokenizer_fingerprint(tokenizer):
+    # Hash what decides the token ids rather than where the tokenizer was loaded from
+    digest = hashlib.sha256()
+    digest.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode())
+    digest.update(json.dumps(tokenizer.all_special_tokens).encode())
+    digest.update(type(tokenizer).__name__.encode())
+    return digest.hexdigest()
+
+
+def dataset_fingerprint(dataset_name, revision, split, chat_template, tokenizer, max_length):
+    payload = {
+        'version': PREPROCESS_VERSION,
+        'dataset': dataset_name,
+        'revision': revision,
+        'split': split,
+        'template': hashlib.sha256(chat_template.encode()).hexdigest(),
+        'tokenizer': tokenizer_fingerprint(tokenizer),
+        'max_length': max_length,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16], payload
+
+
+def tokenize_batch(batch, tokenizer, template_tokenizer):
+    """Apply the chat template and tokenize a batch of conversations"""
+    texts = [template_tokenizer.apply_chat_template(messages, tokenize=False) for messages in batch['messages']]
+    input_ids = tokenizer(texts)['input_ids']
+    return {'input_ids': input_ids, 'length': [len(ids) for ids in input_ids]}
+
+
+def gather_bins(batch, tokenized, max_length):
+    """Concatenate the documents of each bin with the length of every document"""
+    packed = {'input_ids': [], 'seq_lengths': []}
+    for members in batch['members']:
+        input_ids, seq_lengths = concat_documents(tokenized[members]['input_ids'], max_length)
+        packed['input_ids'].append(input_ids)
+        packed['seq_lengths'].append(seq_lengths)
+    return packed
+
+
+def build_packed_dataset(split, tokenizer, template_tokenizer, dataset_name=DATASET_NAME, revision='main',
+                         max_length=2048, cache_dir=CACHE_DIR, num_proc=None):
+    """Tokenize and pack a split once, later runs memory-map the saved Arrow shards
+
+    Documents are best-fit packed into max_length sequences that record
+    the length of each document, so no document is split and the
+    padding-free collator restarts position ids at every boundary. The cache directory is keyed by a fingerprint of
+    the dataset revision, chat template, tokenizer and max_length, so
+    changing any of them preprocesses again while hyperparameter changes
+    reuse the shards.
+    """
+    revision = resolve_revision(dataset_name, revision)
+    fingerprint, payload = dataset_fingerprint(
+        dataset_name, revision, split, template_tokenizer.chat_template, tokenizer, max_length)
+    path = os.path.join(cache_dir, f'{split}-{fingerprint}')
+    if os.path.exists(path):
+        print(f'[Preprocess] Reusing {path}')
+        return load_from_disk(path)
+
+    print(f'[Preprocess] Building {path} from {dataset_name}@{revision} ({split})')
+    dataset = load_dataset(dataset_name, split=split, revision=revision)
+    tokenized = dataset.map(
+        tokenize_batch,
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        fn_kwargs={'tokenizer': tokenizer, 'template_tokenizer': template_tokenizer},
+        desc='Tokenizing',
+    )
+    lengths = tokenized['length']
+    bins = best_fit_decreasing(lengths, max_length)
+    stats = packing_stats(lengths, len(bins), max_length)
+    log_packing_stats(stats, prefix=f'[Preprocess] {split}:')
+    dataset = Dataset.from_dict({'members': bins}).map(
+        gather_bins,
+        batched=True,
+        batch_size=100,
+        num_proc=num_proc,
+        remove_columns=['members'],
+        fn_kwargs={'tokenized': tokenized, 'max_length': max_length},
+        desc='Packing',
+    )
+
+    # Write next to the final location and swap it in, a crash never leaves half a cache behind
+    tmp_path = f'{path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    dataset.save_to_disk(tmp_path, num_proc=num_proc)
+    with open(os.path.join(tmp_path, 'preprocess.json'), 'w') as f:
+        json.dump({**payload, 'rows': len(dataset), 'packing': stats}, f, indent=2)
+    os.replace(tmp_path, path)
+    print(f'[Preprocess] Wrote {len(dataset)} packed sequences to {path}')
+    return load_from_disk(path)
+
+
+def load_tokenizers(model_name=BASE_MODEL, template_model=TEMPLATE_MODEL):
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+    template_tokenizer = AutoTokenizer.from_pretrained(template_model)
+    return tokenizer, template_tokenizer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tokenize and pack the training data into a reusable cache')
+    parser.add_argument('--dataset', default=DATASET_NAME)
+    parser.add_argument('--revision', default='main')
+    parser.add_argument('--splits', nargs='+', default=['train_sft', 'test_sft'])
+    parser.add_argument('--max-length', type=int, default=2048)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--num-proc', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    tokenizer, template_tokenizer = load_tokenizers()
+    for split in args.splits:
+        build_packed_dataset(
+            split, tokenizer, template_tokenizer,
+            dataset_name=args.dataset,
+            revision=args.revision,
+            max_length=args.max_length,
+            cache_dir=args.cache_dir,
+            num_proc=args.num_proc,
+        )
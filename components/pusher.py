@@ -1,9 +1,28 @@
+import argparse
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import hashlib
+import json
 import os
+from components.exporter import ADAPTER_WEIGHTS, EXPORT_FILE
+from utils.io import COMPLETE_MARKER, LATEST_FILE, MANIFEST_FILE, OBJECTS_DIR, STATE_FILE, VERSIONS_DIR, file_sha256
 
 s3 = boto3.client('s3')
 BUCKET_NAME = 'mausneg-mlops'
+# Written by components.evaluator next to the adapter it scored
+EVAL_REPORT_FILE = 'eval_report.json'
+# Local bookkeeping of utils.io downloads, never part of a version
+LOCAL_FILES = (MANIFEST_FILE, COMPLETE_MARKER, STATE_FILE)
+MAX_WORKERS = 8
+# 64MB parts keep multi-GB checkpoints well under the 10k part limit
+transfer_config = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=64 * 1024 * 1024,
+    max_concurrency=4,
+)
 
 def create_bucket(bucket_name: str = None):
     region = s3.meta.region_name
@@ -22,15 +41,125 @@ def create_bucket(bucket_name: str = None):
             print(f"[S3] Error checking bucket: {e}")
             raise
 
-def upload_folder(folder_path, s3_prefix):
+def build_manifest(folder_path, max_workers=MAX_WORKERS):
+    relpaths = []
     for root, dirs, files in os.walk(folder_path):
         for file in files:
-            local_file = os.path.join(root, file)
-            relpath = os.path.relpath(local_file, folder_path)
-            s3_key = os.path.join(s3_prefix, relpath)
-            s3.upload_file(local_file, BUCKET_NAME, s3_key)
-    print(f"[S3] Folder {folder_path} uploaded to bucket {BUCKET_NAME} with prefix {s3_prefix}")
+            relpath = os.path.relpath(os.path.join(root, file), folder_path)
+            if relpath not in LOCAL_FILES:
+                relpaths.append(relpath)
+    relpaths.sort()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        hashes = list(executor.map(file_sha256, [os.path.join(folder_path, relpath) for relpath in relpaths]))
+    files = {
+        relpath: {'sha256': sha256, 'size': os.path.getsize(os.path.join(folder_path, relpath))}
+        for relpath, sha256 in zip(relpaths, hashes)
+    }
+    return {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'files': files,
+    }
+
+def version_id(manifest):
+    """Content address of a version, pushing the same files twice yields the same version"""
+    return hashlib.sha256(json.dumps(manifest['files'], sort_keys=True).encode()).hexdigest()[:16]
+
+def fetch_stored_objects(s3_prefix, client=None):
+    """SHA-256 of every file already stored for this model by any version"""
+    client = client or s3
+    stored = set()
+    paginator = client.get_paginator('list_objects_v2')
+    for result in paginator.paginate(Bucket=BUCKET_NAME, Prefix=f"{s3_prefix}/{OBJECTS_DIR}/"):
+        stored.update(obj['Key'].rsplit('/', 1)[-1] for obj in result.get('Contents', []))
+    return stored
+
+def check_eval_report(folder_path, report_path=None):
+    """Refuse to ship a model whose evaluation failed, is missing, or scored different weights"""
+    report_path = report_path or os.path.join(folder_path, EVAL_REPORT_FILE)
+    if not os.path.exists(report_path):
+        raise SystemExit(f"[S3] No evaluation report at {report_path}, run python -m components.evaluator first")
+    with open(report_path) as f:
+        report = json.load(f)
+    if not report.get('passed'):
+        raise SystemExit(f"[S3] Evaluation failed ({report.get('gates')}), not pushing {folder_path}")
+    weights = os.path.join(folder_path, ADAPTER_WEIGHTS)
+    if report.get('adapter_sha256') and file_sha256(weights) != report['adapter_sha256']:
+        raise SystemExit(f"[S3] {report_path} was written for different weights than {weights}")
+    print(f"[S3] Evaluation passed: {report.get('delta')}")
+
+def check_merged_export(folder_path, merged_path):
+    """True when a merged export exists and was built from the adapter being pushed"""
+    if not os.path.exists(os.path.join(merged_path, COMPLETE_MARKER)):
+        return False
+    try:
+        with open(os.path.join(merged_path, EXPORT_FILE)) as f:
+            export = json.load(f)
+    except (OSError, ValueError):
+        export = {}
+    if export.get('adapter_sha256') != file_sha256(os.path.join(folder_path, ADAPTER_WEIGHTS)):
+        raise SystemExit(f"[S3] {merged_path} was exported from different weights, "
+                         f"run python -m components.exporter again or pass --no-merged")
+    return True
+
+def upload_folder(folder_path, s3_prefix, client=None, max_workers=MAX_WORKERS):
+    """Push ``folder_path`` as a new version under ``s3_prefix`` and point LATEST at it"""
+    client = client or s3
+    manifest = build_manifest(folder_path, max_workers)
+    version = version_id(manifest)
+    manifest['version'] = version
+    stored = fetch_stored_objects(s3_prefix, client)
+    # Files are stored by content, so an unchanged file is never uploaded again or overwritten
+    missing = {}
+    for relpath, meta in manifest['files'].items():
+        if meta['sha256'] not in stored:
+            missing.setdefault(meta['sha256'], relpath)
+    print(f"[S3] {len(missing)} of {len(manifest['files'])} files not yet stored under {s3_prefix}")
+
+    def upload(item):
+        sha256, relpath = item
+        client.upload_file(
+            os.path.join(folder_path, relpath),
+            BUCKET_NAME,
+            f"{s3_prefix}/{OBJECTS_DIR}/{sha256}",
+            ExtraArgs={'Metadata': {'sha256': sha256}},
+            Config=transfer_config,
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(upload, missing.items()))
+
+    client.put_object(
+        Bucket=BUCKET_NAME,
+        Key=f"{s3_prefix}/{VERSIONS_DIR}/{version}/{MANIFEST_FILE}",
+        Body=json.dumps(manifest, indent=2).encode(),
+        ContentType='application/json',
+    )
+    # Moving LATEST is the only switch, readers see either the old version or the complete new one
+    client.put_object(
+        Bucket=BUCKET_NAME,
+        Key=f"{s3_prefix}/{LATEST_FILE}",
+        Body=json.dumps({'version': version, 'created_at': manifest['created_at']}).encode(),
+        ContentType='application/json',
+    )
+    print(f"[S3] Folder {folder_path} uploaded to bucket {BUCKET_NAME} as {s3_prefix} version {version}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Upload a saved model version to S3')
+    parser.add_argument('--model-name', default='TinyLlama-1.1B-Chat-v1.2')
+    parser.add_argument('--models-dir', default='saved_models')
+    parser.add_argument('--require-eval', action='store_true', help='only push if the evaluation report passed')
+    parser.add_argument('--eval-report', help=f'defaults to {EVAL_REPORT_FILE} inside the model directory')
+    parser.add_argument('--no-merged', action='store_true', help='skip the merged export even if it exists')
+    args = parser.parse_args()
+
+    folder_path = os.path.join(args.models_dir, args.model_name)
+    merged_name = f'{args.model_name}-merged'
+    if args.require_eval:
+        check_eval_report(folder_path, args.eval_report)
+    # Checked before anything is uploaded so a stale export never ships next to a new adapter
+    push_merged = not args.no_merged and check_merged_export(folder_path, os.path.join(args.models_dir, merged_name))
     create_bucket(BUCKET_NAME)
-    upload_folder('saved_models/TinyLlama-1.1B-Chat-v1.2', 'saved_models/TinyLlama-1.1B-Chat-v1.2')
\ No newline at end of file
+    upload_folder(folder_path, f'saved_models/{args.model_name}')
+    if push_merged:
+        # API replicas load the merged export directly instead of merging the adapter on every start
+        upload_folder(os.path.join(args.models_dir, merged_name), f'saved_models/{merged_name}')
@@ -0,0 +1,177 @@
+import glob
+import os
+import queue
+import random
+import threading
+from collections import deque
+from datasets import load_dataset
+from torch.utils.data import IterableDataset
+from components.packing import log_packing_stats, merge_packing_stats, pack_documents, packing_stats
+from components.preprocess import tokenize_batch
+
+# Examples tokenized together, the fast tokenizers are much quicker on batches
+TOKENIZE_BATCH = 64
+LOG_EVERY_WINDOWS = 10
+# Positions remembered for sequences the data loader fetched ahead of training
+POSITION_HISTORY = 4096
+_END = object()
+
+
+def _put(output, item, stop):
+    # Give up once the consumer has gone away instead of blocking on a full queue
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def open_stream(source, split='train_sft', revision='main'):
+    """Lazily read a hub dataset by name, or local parquet/JSONL shards given as a list of paths or globs"""
+    if isinstance(source, list):
+        files = sorted(path for pattern in source for path in glob.glob(pattern))
+        if not files:
+            raise FileNotFoundError(f"No data files match {source}")
+        extension = os.path.splitext(files[0])[1]
+        builder = 'parquet' if extension == '.parquet' else 'json'
+        return load_dataset(builder, data_files=files, split='train', streaming=True)
+    return load_dataset(source, split=split, revision=revision, streaming=True)
+
+
+class StreamingPackedDataset(IterableDataset):
+    """Format, tokenize and pack examples on the fly with a background prefetch worker
+
+    Nothing is materialized: examples are read lazily, shuffled
+    deterministically through a ``shuffle_buffer`` seeded with ``seed``, and
+    every ``pack_window`` examples are best-fit packed into ``max_length``
+    sequences by a worker thread that stays at most ``prefetch`` sequences
+    ahead of training. Every iteration is a new pass over the data,
+    shuffled with the pass number as well. ``position`` is ``(pass, window
+    start example, sequences of that window already emitted)`` and passing
+    it back as ``start`` resumes exactly where a run stopped, later passes
+    begin at the start of the data.
+    """
+
+    def __init__(self, source, tokenizer, template_tokenizer, max_length=2048, split='train_sft', revision='main',
+                 seed=0, shuffle_buffer=10000, prefetch=64, pack_window=1000, start=(0, 0, 0)):
+        self.source = source
+        self.tokenizer = tokenizer
+        self.template_tokenizer = template_tokenizer
+        self.max_length = max_length
+        self.split = split
+        self.revision = revision
+        self.seed = seed
+        self.shuffle_buffer = shuffle_buffer
+        self.prefetch = prefetch
+        self.pack_window = pack_window
+        # Padding and truncation waste of the sequences packed so far
+        self.packing = {}
+        # Positions saved before passes were counted have no pass number
+        self.start = tuple(start) if len(start) == 3 else (0, *start)
+        self.position = self.start
+        self.next_start = self.start
+        self.sequences = 0
+        self.history = deque(maxlen=POSITION_HISTORY)
+
+    def position_at(self, sequences):
+        """Position after the first ``sequences`` sequences of this run, the latest one if it is forgotten"""
+        for count, position in reversed(self.history):
+            if count == sequences:
+                return position
+        if sequences == 0:
+            return self.start
+        print(f'[Stream] No position recorded after {sequences} sequences, using the latest')
+        return self.position
+
+    def _examples(self, epoch, example_index):
+        stream = open_stream(self.source, self.split, self.revision)
+        if self.shuffle_buffer > 0:
+            # Seeded like set_epoch does, which skip() would not carry over, so every pass sees a different order
+            stream = stream.shuffle(seed=self.seed + epoch, buffer_size=self.shuffle_buffer)
+        if example_index:
+            stream = stream.skip(example_index)
+        batch = []
+        for example in stream:
+            batch.append(example['messages'])
+            if len(batch) == TOKENIZE_BATCH:
+                yield from self._tokenize(batch)
+                batch = []
+        if batch:
+            yield from self._tokenize(batch)
+
+    def _tokenize(self, batch):
+        yield from tokenize_batch({'messages': batch}, self.tokenizer, self.template_tokenizer)['input_ids']
+
+    def _pack(self, start, stop):
+        """Yield (sequence, position after it) for every packed sequence of the pass from ``start``"""
+        epoch, window_start, skip = start
+        window = []
+        for input_ids in self._examples(epoch, window_start):
+            if stop.is_set():
+                return
+            window.append(input_ids)
+            if len(window) == self.pack_window:
+                yield from self._pack_window(window, epoch, window_start, skip)
+                window_start += len(window)
+                window = []
+                skip = 0
+        if window:
+            yield from self._pack_window(window, epoch, window_start, skip)
+
+    def _pack_window(self, window, epoch, window_start, skip):
+        sequences = pack_documents(window, self.max_length)
+        stats = packing_stats([len(input_ids) for input_ids in window], len(sequences), self.max_length)
+        self.packing = merge_packing_stats(self.packing, stats)
+        if (window_start // self.pack_window) % LOG_EVERY_WINDOWS == 0:
+            log_packing_stats(self.packing, prefix=f'[Stream] Up to example {window_start + len(window)}:')
+        # Best-fit emits the fullest sequences first, mix them the same way on every run
+        random.Random(f'{self.seed}:{epoch}:{window_start}').shuffle(sequences)
+        for k, (input_ids, seq_lengths) in enumerate(sequences):
+            if k < skip:
+                continue
+            if k + 1 < len(sequences):
+                position = (epoch, window_start, k + 1)
+            else:
+                position = (epoch, window_start + len(window), 0)
+            yield {'input_ids': input_ids, 'seq_lengths': seq_lengths}, position
+
+    def _worker(self, start, output, stop):
+        try:
+            for item in self._pack(start, stop):
+                _put(output, item, stop)
+            _put(output, _END, stop)
+        except Exception as e:
+            _put(output, e, stop)
+
+    def __iter__(self):
+        while True:
+            # Only the first pass resumes from start, the ones after it read the data from the beginning
+            start = self.next_start
+            self.next_start = (start[0] + 1, 0, 0)
+            emitted = yield from self._iterate_pass(start)
+            # A run that stopped right at the end of a pass carries on with the next one instead of an empty pass
+            if emitted or start[1:] == (0, 0):
+                return
+
+    def _iterate_pass(self, start):
+        """Yield the sequences of one pass, return how many there were"""
+        output = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._worker, args=(start, output, stop), name='data-prefetch', daemon=True)
+        worker.start()
+        emitted = 0
+        try:
+            while True:
+                item = output.get()
+                if item is _END:
+                    return emitted
+                if isinstance(item, Exception):
+                    raise item
+                sequence, self.position = item
+                self.sequences += 1
+                emitted += 1
+                self.history.append((self.sequences, self.position))
+                yield sequence
+        finally:
+            stop.set()
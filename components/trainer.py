@@ -1,30 +1,101 @@
-from datasets import load_dataset
-from datasets import DatasetDict
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+import argparse
+import os
+from itertools import islice
+from datasets import Dataset
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig
 import torch
 from peft import LoraConfig, prepare_model_for_kbit_training, get_peft_model
 from trl import SFTConfig, SFTTrainer
+from components.preprocess import CACHE_DIR, DATASET_NAME, build_packed_dataset, load_tokenizers
+from components.stream_dataset import StreamingPackedDataset
+from components.packing import packed_attention
+from components.checkpointing import AsyncCheckpointCallback, latest_checkpoint, read_data_state
 
 
 model_name = 'TinyLlama/TinyLlama-1.1B-intermediate-step-1431k-3T'
-template_tokenizer = AutoTokenizer.from_pretrained('TinyLlama/TinyLlama-1.1B-Chat-v1.0')
-
-def format_prompt(example):
-    chat =  example['messages']
-    prompt = template_tokenizer.apply_chat_template(chat, tokenize=False)
-    return {
-        'text': prompt
-    }
 
 if __name__ == "__main__":
-    dataset = load_dataset('HuggingFaceH4/ultrachat_200k', trust_remote_code=True)
-    dataset_train = dataset['train_sft']
-    dataset_test = dataset['test_sft']
-    dataset = DatasetDict({
-        'train': dataset_train,
-        'test': dataset_test
-    })
-    dataset = dataset.map(format_prompt, remove_columns=dataset['train'].column_names)
+    parser = argparse.ArgumentParser(description='Fine-tune a LoRA adapter on TinyLlama')
+    parser.add_argument('--dataset', default=DATASET_NAME)
+    parser.add_argument('--revision', default='main')
+    parser.add_argument('--max-length', type=int, default=2048)
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='pre-tokenized datasets are reused from here')
+    parser.add_argument('--num-proc', type=int, default=os.cpu_count())
+    parser.add_argument('--streaming', action='store_true', help='read, tokenize and pack lazily instead of caching')
+    parser.add_argument('--data-files', nargs='+', help='local parquet/JSONL shards (paths or globs) to stream from')
+    parser.add_argument('--eval-files', nargs='+', help='local shards for evaluation when streaming from --data-files')
+    parser.add_argument('--eval-sequences', type=int, default=256, help='packed sequences evaluated when streaming')
+    parser.add_argument('--max-steps', type=int, default=-1, help='required with --streaming')
+    parser.add_argument('--shuffle-buffer', type=int, default=10000)
+    parser.add_argument('--prefetch', type=int, default=64, help='packed sequences prepared ahead of training')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--pack-window', type=int, default=1000, help='streamed examples best-fit packed together')
+    parser.add_argument('--resume-epoch', type=int, default=0, help='streaming position to start from')
+    parser.add_argument('--resume-example', type=int, default=0)
+    parser.add_argument('--resume-sequence', type=int, default=0)
+    parser.add_argument('--attn-implementation', default='flash_attention_2',
+                        help='only flash_attention_2 keeps attention inside each packed document')
+    parser.add_argument('--output-dir', default='train_dir')
+    parser.add_argument('--output-name', default='TinyLlama-1.1B-Chat-v1.1', help='where the final adapter is saved')
+    parser.add_argument('--save-steps', type=int, default=500, help='checkpoint interval, 0 disables checkpoints')
+    parser.add_argument('--keep-checkpoints', type=int, default=3)
+    parser.add_argument('--no-resume', action='store_true', help='start over even if checkpoints exist')
+    args = parser.parse_args()
+    if args.streaming and args.max_steps <= 0:
+        parser.error('--streaming needs --max-steps, a stream has no known length')
+
+    resume_from = None if args.no_resume else latest_checkpoint(args.output_dir)
+    # Sequences trained on before this run, the stream only counts the ones it emits itself
+    resumed_sequences = 0
+    stream_start = (args.resume_epoch, args.resume_example, args.resume_sequence)
+    if resume_from is not None:
+        print(f'[Trainer] Resuming from {resume_from}')
+        data_state = read_data_state(resume_from)
+        if args.streaming and data_state is not None:
+            # The stream restarts where the checkpoint left it instead of replaying skipped batches
+            stream_start = data_state['position']
+            resumed_sequences = data_state['consumed']
+
+    tokenizer, template_tokenizer = load_tokenizers(model_name)
+    if args.streaming:
+        def stream(source, split, **kwargs):
+            return StreamingPackedDataset(
+                source, tokenizer, template_tokenizer,
+                max_length=args.max_length,
+                split=split,
+                revision=args.revision,
+                seed=args.seed,
+                prefetch=args.prefetch,
+                pack_window=args.pack_window,
+                **kwargs,
+            )
+
+        dataset = {
+            'train': stream(
+                args.data_files or args.dataset, 'train_sft',
+                shuffle_buffer=args.shuffle_buffer,
+                start=stream_start,
+            ),
+            'test': None,
+        }
+        eval_source = args.eval_files or (None if args.data_files else args.dataset)
+        if eval_source is not None:
+            # A small fixed eval set is materialized so every evaluation sees the same sequences
+            eval_stream = stream(eval_source, 'test_sft', shuffle_buffer=0)
+            dataset['test'] = Dataset.from_list(list(islice(eval_stream, args.eval_sequences)))
+    else:
+        # Tokenized and packed once per dataset revision, template, tokenizer and max_length
+        dataset = {
+            name: build_packed_dataset(
+                split, tokenizer, template_tokenizer,
+                dataset_name=args.dataset,
+                revision=args.revision,
+                max_length=args.max_length,
+                cache_dir=args.cache_dir,
+                num_proc=args.num_proc,
+            )
+            for name, split in (('train', 'train_sft'), ('test', 'test_sft'))
+        }
 
     bnb_config = BitsAndBytesConfig(
         load_in_4bit=True,
@@ -34,13 +105,13 @@ if __name__ == "__main__":
         llm_int8_enable_fp32_cpu_offload=True
     )
 
-    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
     tokenizer.pad_token = '<PAD>'
     tokenizer.padding_size = 'left'
     model = AutoModelForCausalLM.from_pretrained(
         model_name,
         device_map='auto',
-        quantization_config=bnb_config
+        quantization_config=bnb_config,
+        attn_implementation=packed_attention(args.attn_implementation),
     )
     model.config.use_cache=False
     model.config.pretraining_tp=1
@@ -55,35 +126,53 @@ if __name__ == "__main__":
     model = prepare_model_for_kbit_training(model)
     model = get_peft_model(model, peft_config)
 
-    output_dir = 'train_dir'
+    output_dir = args.output_dir
 
     config = SFTConfig(
         output_dir=output_dir,
         per_device_train_batch_size=4,
         per_device_eval_batch_size=4,
         num_train_epochs=1,
+        max_steps=args.max_steps,
+        seed=args.seed,
         gradient_accumulation_steps=4,
         optim="paged_adamw_8bit",
         learning_rate=2e-4,
         lr_scheduler_type="cosine",
         logging_steps=100,
         eval_steps=100,
-        do_eval=True,
+        # Checkpoints are written by AsyncCheckpointCallback
+        save_strategy='no',
+        ignore_data_skip=args.streaming,
+        do_eval=dataset['test'] is not None,
         fp16=True,
         gradient_checkpointing=True,
-        packing=True,
-        max_length=2048,
-        dataset_text_field="text",
+        # The datasets are already tokenized and best-fit packed. The collator restarts position ids
+        # at every seq_lengths boundary, and flash attention keeps each document to itself
+        packing=False,
+        padding_free=True,
+        # Rows are packed to --max-length already, TRL must not truncate them again
+        max_length=None,
+        dataset_kwargs={'skip_prepare_dataset': True},
         completion_only_loss=False,
     )
 
+    def data_state(consumed):
+        return {'position': dataset['train'].position_at(consumed - resumed_sequences), 'consumed': consumed}
+
     trainer = SFTTrainer(
         model=model,
         args=config,
         train_dataset=dataset['train'],
         eval_dataset=dataset['test'],
         peft_config=peft_config,
-        processing_class=tokenizer
+        processing_class=tokenizer,
+        callbacks=[AsyncCheckpointCallback(
+            output_dir,
+            args.save_steps,
+            keep_last=args.keep_checkpoints,
+            data_state_fn=data_state if args.streaming else None,
+        )],
     )
-    trainer.train()
-    trainer.model.save_pretrained("TinyLlama-1.1B-Chat-v1.1")
\ No newline at end of file
+    trainer.train(resume_from_checkpoint=resume_from)
+    trainer.model.save_pretrained(args.output_name)
\ No newline at end of file
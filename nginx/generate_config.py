@@ -0,0 +1,108 @@
+import argparse
+import os
+
+# Requests naming a conversation go to the replica whose prefix and session caches already hold it,
+# everything else to the replica with the fewest open requests. Open-source nginx cannot combine
+# hash and least_conn in one upstream, so the header picks between two upstreams over the same servers.
+TEMPLATE = """# Generated by `python -m nginx.generate_config`, edit the template instead
+events {{
+    worker_connections 1000;
+}}
+
+http {{
+    log_format upstream '$remote_addr "$request" $status conversation=$http_x_conversation_id '
+                        'upstream=$upstream_addr upstream_time=$upstream_response_time';
+    access_log {access_log} upstream;
+
+    upstream tinyllama_affine {{
+        hash $http_x_conversation_id consistent;
+{affine_servers}
+        keepalive {keepalive};
+    }}
+
+    upstream tinyllama_least {{
+        least_conn;
+{least_servers}
+        keepalive {keepalive};
+    }}
+
+    map $http_x_conversation_id $tinyllama_pool {{
+        ""      tinyllama_least;
+        default tinyllama_affine;
+    }}
+
+    server {{
+        listen {listen};
+
+        location /api/v1/conversation/stream {{
+            proxy_pass http://$tinyllama_pool;
+            proxy_set_header Host $host;
+            proxy_set_header X-Real-IP $remote_addr;
+            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+
+            # Forward server-sent events as soon as they are produced
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+            proxy_buffering off;
+            proxy_cache off;
+
+            proxy_connect_timeout 300s;
+            proxy_send_timeout 300s;
+            proxy_read_timeout 300s;
+        }}
+
+        location / {{
+            proxy_pass http://$tinyllama_pool;
+            proxy_set_header Host $host;
+            proxy_set_header X-Real-IP $remote_addr;
+            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+
+            # Reuse upstream connections instead of opening one per request
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+
+            proxy_connect_timeout 300s;
+            proxy_send_timeout 300s;
+            proxy_read_timeout 300s;
+        }}
+    }}
+}}
+"""
+
+
+def server_lines(servers, max_fails=3, fail_timeout=10):
+    return "\n".join(f"        server {server} max_fails={max_fails} fail_timeout={fail_timeout}s;" for server in servers)
+
+
+def render_config(servers, listen=8082, keepalive=32, access_log='/dev/stdout'):
+    """nginx.conf balancing the API over ``servers`` (host:port)"""
+    if not servers:
+        raise ValueError("At least one upstream server is required")
+    lines = server_lines(servers)
+    return TEMPLATE.format(
+        affine_servers=lines,
+        least_servers=lines,
+        keepalive=keepalive,
+        listen=listen,
+        access_log=access_log,
+    )
+
+
+def write_config(path, servers, **kwargs):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(render_config(servers, **kwargs))
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate the nginx config for one or more API replicas')
+    parser.add_argument('--servers', nargs='+', default=['app:5003'], help='upstream replicas as host:port')
+    parser.add_argument('--listen', type=int, default=8082)
+    parser.add_argument('--keepalive', type=int, default=32, help='idle upstream connections kept per worker')
+    parser.add_argument('--access-log', default='/dev/stdout')
+    parser.add_argument('--output', default='nginx/nginx.conf')
+    args = parser.parse_args()
+
+    write_config(args.output, args.servers, listen=args.listen, keepalive=args.keepalive, access_log=args.access_log)
+    print(f"[nginx] Wrote {args.output} for {len(args.servers)} replica(s)")
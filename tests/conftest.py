@@ -0,0 +1,58 @@
+import time
+import pytest
+
+
+@pytest.fixture(scope='session')
+def tokenizer():
+    """Byte-level tokenizer with TinyLlama's special tokens, built in memory so tests run offline"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    tokens = ['<unk>', '<s>', '</s>'] + sorted(pre_tokenizers.ByteLevel.alphabet())
+    backend = Tokenizer(models.BPE(vocab={token: i for i, token in enumerate(tokens)}, merges=[], unk_token='<unk>'))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, bos_token='<s>', eos_token='</s>', unk_token='<unk>')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Frozen time.time that a test moves forward by hand"""
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    return clock
+
+
+class _Tokenizers:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def from_pretrained(self, *args, **kwargs):
+        return self.tokenizer
+
+
+@pytest.fixture(scope='session')
+def client(tokenizer):
+    """Test client of the API serving the tiny random-weight model on CPU, started once per test run"""
+    from fastapi.testclient import TestClient
+    import api.app as app_module
+
+    patch = pytest.MonkeyPatch()
+    patch.setattr(app_module, 'AutoTokenizer', _Tokenizers(tokenizer))
+    patch.setattr(app_module, 'TINY_RANDOM_MODEL', True)
+    patch.setattr(app_module, 'INFERENCE_BACKEND', 'fp32')
+    with TestClient(app_module.app) as client:
+        deadline = time.time() + 120
+        while client.get('/readyz').status_code != 200:
+            assert time.time() < deadline, 'the tiny model did not load'
+            time.sleep(0.1)
+        yield client
+    patch.undo()
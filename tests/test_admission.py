@@ -0,0 +1,124 @@
+import asyncio
+from concurrent.futures import Future
+import pytest
+import api.app as server
+from api.admission import AdmissionController, CancelToken, Rejected
+
+
+async def queue(controller, priorities, admitted):
+    """Start one waiter per priority that records its turn and frees the slot for the next one"""
+    async def wait(name, priority):
+        slot = await controller.acquire(priority, CancelToken())
+        admitted.append(name)
+        slot.release()
+
+    tasks = [asyncio.create_task(wait(name, priority)) for name, priority in priorities]
+    await asyncio.sleep(0)
+    return tasks
+
+
+def test_waiters_are_served_by_priority_then_arrival():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, max_queue=4)
+        slot = await controller.acquire('default', CancelToken())
+        admitted = []
+        tasks = await queue(controller, [('batch', 'batch'), ('default-1', 'default'),
+                                         ('interactive', 'interactive'), ('default-2', 'default')], admitted)
+        assert controller.stats()['waiting'] == 4
+        slot.release()
+        await asyncio.gather(*tasks)
+        assert admitted == ['interactive', 'default-1', 'default-2', 'batch']
+        assert controller.stats()['inflight'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_rejects_the_newcomer_unless_it_outranks_a_waiter():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, max_queue=2)
+        slot = await controller.acquire('default', CancelToken())
+        admitted = []
+        batch_1, batch_2 = await queue(controller, [('batch-1', 'batch'), ('batch-2', 'batch')], admitted)
+        with pytest.raises(Rejected) as rejected:
+            await controller.acquire('batch', CancelToken())
+        assert (rejected.value.status_code, rejected.value.reason) == (429, 'queue_full')
+
+        # The newest of the lowest-priority waiters makes room
+        [interactive] = await queue(controller, [('interactive', 'interactive')], admitted)
+        with pytest.raises(Rejected) as displaced:
+            await batch_2
+        assert displaced.value.status_code == 429
+        assert not batch_1.done()
+        slot.release()
+        await asyncio.gather(interactive, batch_1)
+        assert admitted == ['interactive', 'batch-1']
+        assert controller.stats()['rejected'] == {'queue_full': 2, 'deadline': 0}
+
+    asyncio.run(scenario())
+
+
+def test_waiter_past_its_deadline_gets_503_and_leaves_the_queue():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, max_queue=2)
+        slot = await controller.acquire('default', CancelToken())
+        with pytest.raises(Rejected) as rejected:
+            await controller.acquire('default', CancelToken(0.05))
+        assert (rejected.value.status_code, rejected.value.reason) == (503, 'deadline')
+        assert controller.stats()['waiting'] == 0
+        slot.release()
+        assert controller.stats()['inflight'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_waiting_for_the_load_is_bounded_by_queue_and_deadline():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, max_queue=1)
+        load = asyncio.get_running_loop().create_future()
+        waiter = asyncio.create_task(controller.wait_ready(load, CancelToken()))
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected) as rejected:
+            await controller.wait_ready(load, CancelToken())
+        assert rejected.value.status_code == 429
+        load.set_result('loaded')
+        assert await waiter == 'loaded'
+
+        with pytest.raises(Rejected) as rejected:
+            await controller.wait_ready(asyncio.get_running_loop().create_future(), CancelToken(0.05))
+        assert rejected.value.status_code == 503
+        assert controller.stats()['waiting_for_load'] == 0
+
+    asyncio.run(scenario())
+
+
+def ask(client, **fields):
+    payload = {'timestamp': 'now', 'content': ['<|user|>\nHi'], 'max_new_tokens': 2, 'use_cache': False, **fields}
+    return client.post('/api/v1/conversation', json=payload)
+
+
+def test_full_queue_returns_429_with_retry_after(client, monkeypatch):
+    monkeypatch.setattr(server, 'admission', AdmissionController(max_inflight=0, max_queue=0))
+    response = ask(client)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == str(server.RETRY_AFTER_SECONDS)
+
+
+class LoadingForever:
+    def __init__(self):
+        self.future = Future()
+
+    def start(self):
+        pass
+
+
+def test_requests_waiting_for_the_load_honor_timeout_and_queue(client, monkeypatch):
+    monkeypatch.setattr(server, 'loader', LoadingForever())
+    monkeypatch.setattr(server, 'admission', AdmissionController(max_inflight=1, max_queue=1))
+    response = ask(client, timeout=0.1)
+    assert response.status_code == 503
+    assert 'Deadline' in response.json()['detail']
+
+    monkeypatch.setattr(server, 'admission', AdmissionController(max_inflight=1, max_queue=0))
+    response = ask(client)
+    assert response.status_code == 429
+    assert 'Retry-After' in response.headers
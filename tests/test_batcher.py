@@ -0,0 +1,96 @@
+import asyncio
+import api.app as server
+from api.admission import CancelToken
+from api.batcher import MicroBatcher
+from api.generation import SamplingParams
+
+PROMPTS = ['<|user|>\nHi', '<|user|>\nWhat is the capital of France?', '<|user|>\nCount to five, slowly please']
+
+
+def run_batched(generate_fn, prompts, max_batch_size=8, max_wait_ms=50, spacing=0.0):
+    """Submit ``prompts`` to a fresh batcher ``spacing`` seconds apart and return their results or errors"""
+    async def scenario():
+        batcher = MicroBatcher(generate_fn, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        await batcher.start()
+
+        async def submit(i, prompt):
+            await asyncio.sleep(i * spacing)
+            return await batcher.submit(prompt)
+
+        try:
+            return await asyncio.gather(*(submit(i, p) for i, p in enumerate(prompts)), return_exceptions=True)
+        finally:
+            await batcher.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_requests_within_the_wait_window_share_a_call():
+    calls = []
+
+    def generate(prompts):
+        calls.append(list(prompts))
+        return [prompt * 2 for prompt in prompts]
+
+    assert run_batched(generate, [1, 2, 3], max_wait_ms=200) == [2, 4, 6]
+    assert calls == [[1, 2, 3]]
+    calls.clear()
+    # Arrivals further apart than the window are generated separately
+    assert run_batched(generate, [1, 2], max_wait_ms=5, spacing=0.1) == [2, 4]
+    assert calls == [[1], [2]]
+
+
+def test_batches_never_exceed_max_batch_size():
+    calls = []
+
+    def generate(prompts):
+        calls.append(len(prompts))
+        return list(prompts)
+
+    assert run_batched(generate, list(range(5)), max_batch_size=2, max_wait_ms=200) == list(range(5))
+    assert calls == [2, 2, 1]
+
+
+def requests_for(client, prompts, max_new_tokens=8):
+    params = SamplingParams(max_new_tokens)
+    return [(server.get_full_prompt([prompt]), None, params, CancelToken(), None) for prompt in prompts]
+
+
+# The tests below drive the tiny model directly, the API's own model thread is idle between requests
+
+
+def test_batched_output_equals_sequential_output(client):
+    requests = requests_for(client, PROMPTS)
+    batched = server.generate_batch(requests)
+    assert batched == [server.generate_batch([request])[0] for request in requests]
+    assert all(batched)
+
+
+def test_micro_batched_requests_match_their_sequential_answers(client):
+    requests = requests_for(client, PROMPTS)
+    calls = []
+
+    def generate(batch):
+        calls.append(len(batch))
+        return server.generate_batch(batch)
+
+    batched = run_batched(generate, requests, max_wait_ms=200)
+    assert calls == [3]
+    assert batched == [server.generate_batch([request])[0] for request in requests]
+
+
+def test_a_failing_request_does_not_fail_the_rest_of_its_batch(client):
+    good = requests_for(client, PROMPTS[:2])
+    # A token id past the vocabulary makes the embedding lookup of this row fail
+    bad = ([1, 10 ** 7], None, SamplingParams(8), CancelToken(), None)
+    calls = []
+
+    def generate(batch):
+        calls.append(len(batch))
+        return server.generate_batch(batch)
+
+    results = run_batched(generate, [good[0], bad, good[1]], max_wait_ms=200)
+    assert calls == [3]
+    assert isinstance(results[1], IndexError)
+    assert results[0] == server.generate_batch([good[0]])[0]
+    assert results[2] == server.generate_batch([good[1]])[0]
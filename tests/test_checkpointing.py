@@ -0,0 +1,147 @@
+import json
+import os
+import pytest
+import torch
+from components import checkpointing
+from components.checkpointing import (COMPLETE_MARKER, AsyncCheckpointCallback, latest_checkpoint, list_checkpoints,
+                                      read_data_state)
+
+peft = pytest.importorskip('peft')
+from transformers import Trainer, TrainerCallback, TrainingArguments
+from utils.tiny_model import build_tiny_llama
+
+VOCAB_SIZE = 64
+STEPS = 4
+
+
+class Examples(torch.utils.data.Dataset):
+    def __init__(self, count=16, length=8):
+        generator = torch.Generator().manual_seed(0)
+        self.input_ids = torch.randint(VOCAB_SIZE, (count, length), generator=generator)
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def __getitem__(self, i):
+        return {'input_ids': self.input_ids[i], 'labels': self.input_ids[i]}
+
+
+class RecordRng(TrainerCallback):
+    """Torch RNG state at the end and at the start of every step"""
+
+    def __init__(self):
+        self.at_end = {}
+        self.at_begin = {}
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.at_begin[state.global_step + 1] = torch.random.get_rng_state()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.at_end[state.global_step] = torch.random.get_rng_state()
+
+
+def train(output_dir, resume_from=None, save_steps=2, keep_last=3):
+    model = peft.get_peft_model(build_tiny_llama(VOCAB_SIZE), peft.LoraConfig(
+        r=4, lora_alpha=8, lora_dropout=0.0, target_modules=['q_proj', 'v_proj'], task_type='CAUSAL_LM'))
+    args = TrainingArguments(
+        output_dir=str(output_dir),
+        max_steps=STEPS,
+        per_device_train_batch_size=2,
+        learning_rate=1e-2,
+        lr_scheduler_type='linear',
+        warmup_steps=1,
+        save_strategy='no',
+        report_to=[],
+        use_cpu=True,
+        seed=3,
+        disable_tqdm=True,
+    )
+    rng = RecordRng()
+    callback = AsyncCheckpointCallback(
+        str(output_dir), save_steps, keep_last=keep_last,
+        data_state_fn=lambda consumed: {'position': [0, consumed, 0], 'consumed': consumed})
+    trainer = Trainer(model=model, args=args, train_dataset=Examples(), callbacks=[rng, callback])
+    trainer.train(resume_from_checkpoint=resume_from)
+    return trainer, rng
+
+
+def adapter_weights(model):
+    return {key: value.clone() for key, value in peft.get_peft_model_state_dict(model).items()}
+
+
+def test_resume_restores_weights_optimizer_scheduler_rng_and_data_position(tmp_path):
+    uninterrupted, rng = train(tmp_path / 'full')
+    checkpoint = str(tmp_path / 'full' / 'checkpoint-2')
+    assert list_checkpoints(str(tmp_path / 'full')) == [checkpoint, str(tmp_path / 'full' / 'checkpoint-4')]
+    assert read_data_state(checkpoint) == {'position': [0, 4, 0], 'consumed': 4}
+    saved_rng = torch.load(os.path.join(checkpoint, 'rng_state.pth'), weights_only=False)
+    assert torch.equal(saved_rng['cpu'], rng.at_end[2])
+
+    resumed, resumed_rng = train(tmp_path / 'resumed', resume_from=checkpoint)
+    # Training picks up at step 3 with the RNG it had when the checkpoint was taken
+    assert sorted(resumed_rng.at_begin) == [3, 4]
+    assert torch.equal(resumed_rng.at_begin[3], rng.at_begin[3])
+    assert resumed.lr_scheduler.state_dict() == uninterrupted.lr_scheduler.state_dict()
+    expected, actual = adapter_weights(uninterrupted.model), adapter_weights(resumed.model)
+    assert expected.keys() == actual.keys()
+    for key in expected:
+        torch.testing.assert_close(actual[key], expected[key])
+    # Adam moments only match if the optimizer state was restored as well
+    full_state = uninterrupted.optimizer.state_dict()['state']
+    resumed_state = resumed.optimizer.state_dict()['state']
+    for index, state in full_state.items():
+        assert resumed_state[index]['step'] == state['step']
+        torch.testing.assert_close(resumed_state[index]['exp_avg_sq'], state['exp_avg_sq'])
+
+
+def test_only_the_newest_checkpoints_are_kept(tmp_path):
+    train(tmp_path, save_steps=1, keep_last=2)
+    assert list_checkpoints(str(tmp_path)) == [str(tmp_path / 'checkpoint-3'), str(tmp_path / 'checkpoint-4')]
+    assert sorted(os.listdir(tmp_path)) == ['checkpoint-3', 'checkpoint-4']
+
+
+def test_marker_is_written_last_and_the_directory_renamed_into_place(tmp_path, monkeypatch):
+    events = []
+    real_open, real_replace = open, os.replace
+
+    def spy_open(path, *args, **kwargs):
+        if os.path.basename(path) == COMPLETE_MARKER:
+            directory = os.path.dirname(path)
+            events.append(('marker', os.path.basename(directory), sorted(os.listdir(directory))))
+        return real_open(path, *args, **kwargs)
+
+    def spy_replace(source, destination):
+        events.append(('rename', os.path.basename(source), os.path.basename(destination)))
+        return real_replace(source, destination)
+
+    monkeypatch.setattr(checkpointing, 'open', spy_open, raising=False)
+    monkeypatch.setattr(checkpointing.os, 'replace', spy_replace)
+    train(tmp_path, save_steps=4)
+
+    assert events == [
+        ('marker', 'checkpoint-4.tmp', ['adapter_config.json', 'adapter_model.safetensors', 'data_state.json',
+                                        'optimizer.pt', 'rng_state.pth', 'scheduler.pt', 'trainer_state.json']),
+        ('rename', 'checkpoint-4.tmp', 'checkpoint-4'),
+    ]
+    checkpoint = latest_checkpoint(str(tmp_path))
+    with open(os.path.join(checkpoint, 'trainer_state.json')) as f:
+        assert json.load(f)['global_step'] == 4
+
+
+def test_interrupted_writes_are_never_resumed_and_are_cleaned_up(tmp_path, monkeypatch):
+    def crash(*args, **kwargs):
+        raise OSError('disk full')
+
+    # The write dies after the weights but before the marker
+    monkeypatch.setattr(checkpointing.torch, 'save', crash)
+    with pytest.raises(OSError, match='disk full'):
+        train(tmp_path, save_steps=4)
+    assert os.listdir(tmp_path) == ['checkpoint-4.tmp']
+    assert latest_checkpoint(str(tmp_path)) is None
+    # A directory with the final name but no marker does not count either
+    os.makedirs(tmp_path / 'checkpoint-9')
+    assert latest_checkpoint(str(tmp_path)) is None
+
+    monkeypatch.undo()
+    AsyncCheckpointCallback(str(tmp_path), 4).on_train_begin(None, None, None)
+    assert os.listdir(tmp_path) == ['checkpoint-9']
@@ -0,0 +1,72 @@
+import pytest
+import torch
+from api.engine import BlockPool, ContinuousBatchingEngine
+from api.generation import SamplingParams
+from utils.tiny_model import build_tiny_llama
+
+EOS = 599
+PROMPTS = [list(range(3 + i, 8 + 8 * i)) for i in range(6)]
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    return build_tiny_llama(600).eval()
+
+
+def reference(model, prompt, max_new_tokens):
+    with torch.no_grad():
+        output = model.generate(torch.tensor([prompt]), max_new_tokens=max_new_tokens, do_sample=False,
+                                pad_token_id=0, eos_token_id=EOS)
+    return output[0, len(prompt):].tolist()
+
+
+def run_engine(model, num_blocks, max_new_tokens=24):
+    engine = ContinuousBatchingEngine(model, eos_token_id=EOS, num_blocks=num_blocks, block_size=4, max_running=6,
+                                      max_new_tokens=max_new_tokens, max_model_len=256)
+    engine.start()
+    try:
+        futures = [engine.add_request(prompt, params=SamplingParams(max_new_tokens)) for prompt in PROMPTS]
+        outputs = [future.result(timeout=120)[len(prompt):] for future, prompt in zip(futures, PROMPTS)]
+    finally:
+        engine.stop()
+    return outputs, engine.stats()
+
+
+def test_engine_matches_greedy_generate(model):
+    outputs, stats = run_engine(model, num_blocks=256)
+    assert outputs == [reference(model, prompt, 24) for prompt in PROMPTS]
+    assert stats['preempted'] == 0
+    assert stats['blocks_used'] == 0
+
+
+def test_engine_matches_greedy_generate_under_preemption(model):
+    # Too few blocks for every sequence at once, so some are preempted and recomputed
+    outputs, stats = run_engine(model, num_blocks=40)
+    assert outputs == [reference(model, prompt, 24) for prompt in PROMPTS]
+    assert stats['preempted'] > 0
+    assert stats['blocks_used'] == 0
+
+
+def test_pool_reads_a_run_as_a_view_and_gathers_scattered_blocks():
+    pool = BlockPool(num_blocks=8, block_size=4, num_layers=1, num_heads=2, head_dim=3)
+    assert pool.keys[0].shape == (2, 32, 3)
+    assert pool.index([2, 3, 4], 1, 10) == slice(9, 18)
+
+    scattered = [5, 1]
+    keys = torch.arange(2 * 6 * 3, dtype=torch.float32).view(2, 6, 3)
+    index = pool.index(scattered, 0, 6)
+    assert index.tolist() == [20, 21, 22, 23, 4, 5]
+    pool.write(0, index, keys, -keys)
+    read_keys, read_values = pool.read(0, pool.index(scattered, 0, 6))
+    assert torch.equal(read_keys, keys) and torch.equal(read_values, -keys)
+
+
+def test_new_sequences_are_placed_with_room_to_grow():
+    pool = BlockPool(num_blocks=16, block_size=4, num_layers=1, num_heads=1, head_dim=1)
+    first = pool.allocate_run(2)
+    second = pool.allocate_run(2)
+    assert first == [7, 8]
+    assert second == [11, 12]
+    assert pool.allocate(after=first[-1]) == 9
+    assert pool.allocate_run(20) is None
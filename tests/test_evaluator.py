@@ -0,0 +1,100 @@
+import copy
+import json
+import os
+import pytest
+
+pytest.importorskip('datasets')
+from components import evaluator
+
+CHAT_TEMPLATE = ("{% for message in messages %}<|{{ message['role'] }}|>\n{{ message['content'] }}</s>\n{% endfor %}"
+                 "{% if add_generation_prompt %}<|assistant|>\n{% endif %}")
+
+
+@pytest.fixture
+def tokenizers(tokenizer, monkeypatch):
+    # The evaluator sets a pad token and padding side, keep that off the shared tokenizer
+    template_tokenizer = copy.deepcopy(tokenizer)
+    template_tokenizer.chat_template = CHAT_TEMPLATE
+    loaded = []
+
+    def load_tokenizers():
+        loaded.append((copy.deepcopy(tokenizer), template_tokenizer))
+        return loaded[-1]
+
+    monkeypatch.setattr(evaluator, 'load_tokenizers', load_tokenizers)
+    return loaded
+
+
+@pytest.fixture
+def examples(tmp_path):
+    path = tmp_path / 'test.jsonl'
+    with open(path, 'w') as f:
+        for i in range(6):
+            messages = [{'role': 'user', 'content': f'What is {i} plus {i}?'},
+                        {'role': 'assistant', 'content': f'{i} plus {i} is {2 * i}.'}]
+            f.write(json.dumps({'messages': messages}) + '\n')
+        # Conversations that do not end on an answer are not scored
+        f.write(json.dumps({'messages': [{'role': 'user', 'content': 'Unanswered'}]}) + '\n')
+    return str(path)
+
+
+@pytest.fixture
+def evaluations(monkeypatch):
+    calls = []
+    evaluate_model = evaluator.evaluate_model
+
+    def counting(*args, **kwargs):
+        calls.append(len(args[2]))
+        return evaluate_model(*args, **kwargs)
+
+    monkeypatch.setattr(evaluator, 'evaluate_model', counting)
+    return calls
+
+
+def evaluate(tmp_path, examples, **kwargs):
+    kwargs = {'max_length': 64, 'max_new_tokens': 4, **kwargs}
+    return evaluator.evaluate_adapter(str(tmp_path / 'adapter'), source=examples, cache_dir=str(tmp_path / 'cache'),
+                                      tiny=True, **kwargs)
+
+
+def test_tiny_report_passes_an_identity_adapter_and_fails_tight_gates(tmp_path, examples, tokenizers):
+    report = evaluate(tmp_path, examples)
+    # A fresh LoRA does not change the model, so it scores exactly like its base
+    assert report['base'] == report['adapter_metrics']
+    assert report['base']['examples'] == 6
+    assert report['delta'] == {'perplexity': 0.0, 'rouge_l': 0.0}
+    assert report['gates'] == {'perplexity': True, 'rouge_l': True}
+    assert report['passed']
+    assert report['adapter_sha256'] == evaluator.file_sha256(str(tmp_path / 'adapter' / evaluator.ADAPTER_WEIGHTS))
+
+    report = evaluate(tmp_path, examples, max_perplexity_ratio=0.5)
+    assert report['gates'] == {'perplexity': False, 'rouge_l': True}
+    assert not report['passed']
+    report = evaluate(tmp_path, examples, min_rouge_delta=0.1)
+    assert report['gates'] == {'perplexity': True, 'rouge_l': False}
+    assert not report['passed']
+
+
+def test_base_results_are_cached_by_model_tokenizer_template_examples_and_length(
+        tmp_path, examples, tokenizers, evaluations, monkeypatch):
+    evaluate(tmp_path, examples)
+    assert evaluations == [6, 6]
+    [cached] = os.listdir(tmp_path / 'cache')
+    # Another adapter on the same base and data only evaluates itself
+    evaluate(tmp_path, examples, max_perplexity_ratio=2.0)
+    assert evaluations == [6, 6, 6]
+
+    evaluate(tmp_path, examples, max_examples=3)
+    evaluate(tmp_path, examples, max_new_tokens=5)
+    assert len(os.listdir(tmp_path / 'cache')) == 3
+
+    tokenizer, template_tokenizer = tokenizers[0]
+    encoded = evaluator.encode_examples(evaluator.load_examples(examples), tokenizer, template_tokenizer, 64, 4)
+    fingerprint = evaluator.cache_fingerprint('tiny-random', tokenizer, template_tokenizer, encoded, 4)
+    assert cached == f'base-{fingerprint}.json'
+    assert evaluator.cache_fingerprint(evaluator.BASE_MODEL, tokenizer, template_tokenizer, encoded, 4) != fingerprint
+    template_tokenizer.chat_template = CHAT_TEMPLATE.replace('\n', ' ')
+    assert evaluator.cache_fingerprint('tiny-random', tokenizer, template_tokenizer, encoded, 4) != fingerprint
+    template_tokenizer.chat_template = CHAT_TEMPLATE
+    monkeypatch.setattr(evaluator, 'EVAL_VERSION', evaluator.EVAL_VERSION + 1)
+    assert evaluator.cache_fingerprint('tiny-random', tokenizer, template_tokenizer, encoded, 4) != fingerprint
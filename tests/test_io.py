@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import pytest
+from boto3.s3.transfer import TransferConfig
+
+moto = pytest.importorskip('moto')
+import boto3
+from components import pusher
+from utils import io
+
+MODEL = 'tiny-model'
+PREFIX = f'{io.s3_prefix}/{MODEL}'
+FILES = {
+    'adapter_model.safetensors': bytes(range(256)) * 4,
+    'tokenizer/tokenizer.json': b'{"version": "1.0"}',
+}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    # Small chunks so a file is fetched as several ranged GETs
+    monkeypatch.setattr(io, 'transfer_config', TransferConfig(multipart_chunksize=100, max_concurrency=4))
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=io.bucket_name)
+        yield client
+
+
+def push(client, files, folder):
+    """Write ``files`` to ``folder`` and upload them with components.pusher, returning the new version"""
+    for relpath, body in files.items():
+        path = folder / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(body)
+    pusher.upload_folder(str(folder), PREFIX, client=client)
+    return json.loads(client.get_object(Bucket=io.bucket_name, Key=f'{PREFIX}/{io.LATEST_FILE}')['Body'].read())
+
+
+def puts_made(client):
+    keys = []
+    client.meta.events.register('provide-client-params.s3.PutObject', lambda params, **kwargs: keys.append(
+        params['Key'][len(PREFIX) + 1:]))
+    return keys
+
+
+def ranges_requested(client):
+    ranges = []
+    client.meta.events.register('before-call.s3.GetObject', lambda params, **kwargs: ranges.append(
+        params.get('headers', {}).get('Range')))
+    return ranges
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_second_push_uploads_only_changed_files_and_moves_latest_last(client, tmp_path):
+    first = push(client, FILES, tmp_path / 'v1')
+    keys = puts_made(client)
+    changed = {**FILES, 'tokenizer/tokenizer.json': b'{"version": "2.0"}'}
+
+    second = push(client, changed, tmp_path / 'v2')
+
+    assert second['version'] != first['version']
+    sha256 = hashlib.sha256(changed['tokenizer/tokenizer.json']).hexdigest()
+    # Readers only see the new version once its objects and manifest are all stored
+    assert keys == [f'{io.OBJECTS_DIR}/{sha256}', f"{io.VERSIONS_DIR}/{second['version']}/{io.MANIFEST_FILE}",
+                    io.LATEST_FILE]
+    # Pushing the same folder again only writes a manifest and LATEST
+    keys.clear()
+    push(client, changed, tmp_path / 'v2')
+    assert keys == [f"{io.VERSIONS_DIR}/{second['version']}/{io.MANIFEST_FILE}", io.LATEST_FILE]
+
+
+def test_download_writes_every_file_and_the_complete_marker(client, tmp_path):
+    latest = push(client, FILES, tmp_path / 'pushed')
+
+    io.download_dir(str(tmp_path), MODEL, client=client)
+
+    model_dir = tmp_path / MODEL
+    for relpath, body in FILES.items():
+        assert read(model_dir / relpath) == body
+    assert io.is_download_complete(str(model_dir))
+    marker = json.loads(read(model_dir / io.COMPLETE_MARKER))
+    assert marker == {'version': latest['version'], 'files': 2, 'bytes': sum(len(body) for body in FILES.values())}
+    assert not [name for name in os.listdir(model_dir) if name.endswith(('.part', '.part.json'))]
+
+
+def test_download_resumes_a_part_file(client, tmp_path):
+    push(client, FILES, tmp_path / 'pushed')
+    body = FILES['adapter_model.safetensors']
+    sha256 = hashlib.sha256(body).hexdigest()
+    etag = client.head_object(Bucket=io.bucket_name, Key=f'{PREFIX}/{io.OBJECTS_DIR}/{sha256}')['ETag']
+    # An earlier run finished the first two 100-byte chunks and died
+    model_dir = tmp_path / MODEL
+    model_dir.mkdir()
+    part = model_dir / 'adapter_model.safetensors.part'
+    part.write_bytes(body[:200] + b'\0' * (len(body) - 200))
+    (model_dir / 'adapter_model.safetensors.part.json').write_text(json.dumps({'etag': etag, 'chunks': [0, 1]}))
+    ranges = ranges_requested(client)
+
+    io.download_dir(str(tmp_path), MODEL, client=client)
+
+    assert read(model_dir / 'adapter_model.safetensors') == body
+    fetched = sorted(int(r.split('=')[1].split('-')[0]) for r in ranges if r)
+    # The 1024-byte file is fetched from the third chunk on, the tokenizer file in one range
+    assert fetched == [0, 200, 300, 400, 500, 600, 700, 800, 900, 1000]
+    assert not part.exists()
+    assert io.is_download_complete(str(model_dir))
+
+
+def test_checksum_mismatch_fails_without_the_complete_marker(client, tmp_path):
+    body = FILES['adapter_model.safetensors']
+    push(client, FILES, tmp_path / 'pushed')
+    # The stored object no longer matches the SHA-256 it is filed under
+    sha256 = hashlib.sha256(body).hexdigest()
+    client.put_object(Bucket=io.bucket_name, Key=f'{PREFIX}/{io.OBJECTS_DIR}/{sha256}', Body=body[:-1] + b'\x00')
+    model_dir = tmp_path / MODEL
+    model_dir.mkdir()
+    # A marker left by an earlier version must not survive a failed download
+    (model_dir / io.COMPLETE_MARKER).write_text('{}')
+
+    with pytest.raises(IOError, match='SHA-256 mismatch'):
+        io.download_dir(str(tmp_path), MODEL, client=client)
+
+    assert not io.is_download_complete(str(model_dir))
+    assert not (model_dir / 'adapter_model.safetensors').exists()
+    assert not (model_dir / 'adapter_model.safetensors.part').exists()
+    # The file that did verify is kept, a retry only fetches the broken one
+    assert read(model_dir / 'tokenizer/tokenizer.json') == FILES['tokenizer/tokenizer.json']
+    state = json.loads(read(model_dir / io.STATE_FILE))
+    assert list(state) == ['tokenizer/tokenizer.json']
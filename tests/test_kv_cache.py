@@ -0,0 +1,45 @@
+import logging
+import torch
+from transformers import DynamicCache
+from transformers.utils import logging as transformers_logging
+from api.kv_cache import PrefixKVCache, cache_layers, crop_cache
+
+
+def filled_cache(length, num_layers=2):
+    cache = DynamicCache()
+    for layer in range(num_layers):
+        states = torch.arange(length, dtype=torch.float32).view(1, 1, length, 1).expand(1, 2, length, 4)
+        cache.update(states.clone(), states.clone() + 100, layer)
+    return cache
+
+
+def test_crop_cache_keeps_the_leading_positions_without_deprecation_warnings(caplog):
+    cache = filled_cache(10)
+    transformers_logging.enable_propagation()
+    try:
+        with caplog.at_level(logging.WARNING):
+            crop_cache(cache, 6)
+    finally:
+        transformers_logging.disable_propagation()
+    assert not [record for record in caplog.records if 'crop' in record.getMessage()]
+    assert cache.get_seq_length() == 6
+    for key, value in cache_layers(cache):
+        assert key[0, 0, :, 0].tolist() == [0, 1, 2, 3, 4, 5]
+        assert value[0, 0, :, 0].tolist() == [100, 101, 102, 103, 104, 105]
+
+
+def test_crop_cache_leaves_a_shorter_cache_alone():
+    cache = filled_cache(4)
+    crop_cache(cache, 4)
+    crop_cache(cache, 9)
+    assert cache.get_seq_length() == 4
+
+
+def test_prefix_lookup_crops_to_the_matched_boundary():
+    prefix_cache = PrefixKVCache(max_bytes=1 << 20)
+    prefix_cache.store(list(range(10)), filled_cache(10), boundaries=(4,))
+
+    length, cache = prefix_cache.lookup([0, 1, 2, 3, 7, 7])
+
+    assert length == 4
+    assert cache.get_seq_length() == 4
@@ -0,0 +1,136 @@
+import os
+import re
+import shutil
+import subprocess
+import threading
+import uuid
+from contextlib import ExitStack, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from nginx.generate_config import render_config, write_config
+
+SERVERS = ['10.0.0.1:5003', '10.0.0.2:5003']
+
+
+def upstream_block(config, name):
+    match = re.search(r'upstream ' + name + r' \{(.*?)\}', config, re.S)
+    assert match, f"no upstream {name}"
+    return match.group(1)
+
+
+def test_conversation_header_picks_the_affine_upstream():
+    config = render_config(SERVERS)
+    assert re.search(
+        r'map \$http_x_conversation_id \$tinyllama_pool \{\s*""\s+tinyllama_least;\s*default\s+tinyllama_affine;\s*\}',
+        config)
+    assert config.count('proxy_pass http://$tinyllama_pool;') == 2
+
+
+def test_affine_upstream_hashes_the_conversation_id_consistently():
+    block = upstream_block(render_config(SERVERS), 'tinyllama_affine')
+    assert 'hash $http_x_conversation_id consistent;' in block
+    assert 'least_conn' not in block
+    assert re.findall(r'server (\S+) ', block) == SERVERS
+
+
+def test_unkeyed_upstream_balances_by_least_connections():
+    block = upstream_block(render_config(SERVERS), 'tinyllama_least')
+    assert 'least_conn;' in block
+    assert 'hash' not in block
+    assert re.findall(r'server (\S+) ', block) == SERVERS
+
+
+def test_render_config_fills_listen_keepalive_and_log():
+    config = render_config(SERVERS, listen=9000, keepalive=7, access_log='/tmp/access.log')
+    assert 'listen 9000;' in config
+    assert config.count('keepalive 7;') == 2
+    assert 'access_log /tmp/access.log upstream;' in config
+
+
+def test_render_config_requires_a_server():
+    with pytest.raises(ValueError):
+        render_config([])
+
+
+needs_nginx = pytest.mark.skipif(shutil.which('nginx') is None, reason='nginx is not installed')
+
+
+@contextmanager
+def stub_replica(name):
+    """HTTP server on a free port answering every request with its name in X-Replica"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self):
+            self.send_response(200)
+            self.send_header('X-Replica', name)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        do_GET = do_POST = respond
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f'127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+
+
+@needs_nginx
+def test_nginx_accepts_the_generated_config(tmp_path):
+    os.makedirs(tmp_path / 'logs')
+    config_path = str(tmp_path / 'nginx.conf')
+    write_config(config_path, SERVERS, listen=18082, access_log=str(tmp_path / 'logs' / 'access.log'))
+    result = subprocess.run(
+        ['nginx', '-t', '-p', str(tmp_path), '-c', config_path, '-e', 'stderr',
+         '-g', f"pid {tmp_path / 'nginx.pid'};"],
+        capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stderr
+
+
+@needs_nginx
+def test_nginx_pins_conversations_to_one_replica():
+    from benchmark.replicas import boot_nginx
+
+    with ExitStack() as stack:
+        servers = [stack.enter_context(stub_replica(f'replica-{i}')) for i in range(3)]
+        base_url = stack.enter_context(boot_nginx(servers, 18083))
+
+        def replica(conversation_id):
+            headers = {'X-Conversation-ID': conversation_id} if conversation_id else {}
+            response = requests.post(f'{base_url}/api/v1/conversation', headers=headers, timeout=10)
+            return response.headers['X-Replica']
+
+        conversations = [uuid.uuid4().hex for _ in range(16)]
+        pinned = {conversation_id: {replica(conversation_id) for _ in range(3)} for conversation_id in conversations}
+        assert all(len(replicas) == 1 for replicas in pinned.values())
+        assert len(set.union(*pinned.values())) > 1
+        assert {replica(None) for _ in range(12)} <= {f'replica-{i}' for i in range(3)}
+
+
+@needs_nginx
+def test_tiny_api_replicas_behind_nginx_pin_conversations_and_sessions():
+    from transformers import AutoTokenizer
+    from api.app import BASE_TOKENIZER
+    from benchmark.loadgen import boot_api
+    from benchmark.replicas import boot_nginx, check_replicas
+
+    # The replicas run the tiny random-weight model but still load the real tokenizer
+    try:
+        AutoTokenizer.from_pretrained(BASE_TOKENIZER)
+    except OSError:
+        pytest.skip(f'the {BASE_TOKENIZER} tokenizer is neither cached nor downloadable')
+    with ExitStack() as stack:
+        ports = [18090, 18091]
+        for i, port in enumerate(ports):
+            env = {'REPLICA_ID': f'replica-{i}', 'INFERENCE_BACKEND': 'fp32'}
+            stack.enter_context(boot_api(port, env, timeout=300))
+        base_url = stack.enter_context(boot_nginx([f'127.0.0.1:{port}' for port in ports], 18092))
+        report = check_replicas(base_url, conversations=8, turns=2)
+    assert report['checks'] == {'conversations_pinned': True, 'conversations_spread': True, 'session_pinned': True}
+    assert set(report['conversations_per_replica']) == {'replica-0', 'replica-1'}
@@ -0,0 +1,38 @@
+import pytest
+from components.packing import best_fit_decreasing, concat_documents, pack_documents
+
+
+def test_best_fit_decreasing_fills_tightest_bin():
+    bins = best_fit_decreasing([6, 5, 4, 3, 2], capacity=10)
+    assert sorted(sorted(members) for members in bins) == [[0, 2], [1, 3, 4]]
+
+
+def test_pack_documents_records_document_lengths():
+    documents = [[1] * 7, [2] * 3, [3] * 5, [4] * 12]
+    sequences = pack_documents(documents, max_length=10)
+    for input_ids, seq_lengths in sequences:
+        assert len(input_ids) <= 10
+        assert sum(seq_lengths) == len(input_ids)
+    # Every document stays whole, only the one longer than max_length is truncated
+    assert sorted(length for _, seq_lengths in sequences for length in seq_lengths) == [3, 5, 7, 10]
+
+
+def test_concat_documents_truncates_each_document():
+    input_ids, seq_lengths = concat_documents([[1, 2, 3, 4], [5, 6]], max_length=3)
+    assert input_ids == [1, 2, 3, 5, 6]
+    assert seq_lengths == [3, 2]
+
+
+def test_collator_restarts_position_ids_at_document_boundaries():
+    torch = pytest.importorskip('torch')
+    sft_trainer = pytest.importorskip('trl.trainer.sft_trainer')
+    collator = sft_trainer.DataCollatorForLanguageModeling(
+        pad_token_id=0, completion_only_loss=False, padding_free=True)
+    sequences = pack_documents([[11] * 4, [12] * 3, [13] * 6, [14] * 2], max_length=8)
+    examples = [{'input_ids': input_ids, 'seq_lengths': seq_lengths} for input_ids, seq_lengths in sequences]
+
+    batch = collator(examples)
+
+    expected = [position for _, seq_lengths in sequences for length in seq_lengths for position in range(length)]
+    assert batch['position_ids'].flatten().tolist() == expected
+    assert batch['input_ids'].shape == torch.Size([1, len(expected)])
@@ -0,0 +1,84 @@
+from api.prompt import PromptBuilder
+
+HISTORY = [
+    '<|user|>\nFirst question',
+    '<|assistant|>\nFirst answer',
+    '<|user|>\nSecond question',
+    '<|assistant|>\nSecond answer',
+    '<|user|>\nThird question',
+]
+
+
+class CountingTokenizer:
+    """Tokenizer wrapper that records every text it encodes"""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.bos_token_id = tokenizer.bos_token_id
+        self.encoded = []
+
+    def encode(self, text, **kwargs):
+        self.encoded.append(text)
+        return self.tokenizer.encode(text, **kwargs)
+
+
+def test_prompt_is_the_joined_conversation_when_it_fits(tokenizer):
+    builder = PromptBuilder(tokenizer, max_length=1000)
+    token_ids, truncated = builder.build(HISTORY)
+    assert not truncated
+    assert tokenizer.decode(token_ids) == '<s>\n' + '\n'.join(HISTORY) + '\n<|assistant|>\n'
+    # The pieces are exactly what tokenizing the whole prompt gives
+    assert token_ids == builder.bos_ids + tokenizer.encode('\n' + '\n'.join(HISTORY) + '\n<|assistant|>\n',
+                                                           add_special_tokens=False)
+
+
+def test_overflow_drops_whole_oldest_turns_and_never_starts_on_an_answer(tokenizer):
+    builder = PromptBuilder(tokenizer, max_length=1000)
+    full_length = len(builder.build(HISTORY)[0])
+    # Room for everything but the first question: the first answer would then lead, so it goes too
+    builder = PromptBuilder(tokenizer, max_length=full_length - 1)
+    token_ids, truncated = builder.build(HISTORY)
+    assert truncated
+    assert tokenizer.decode(token_ids) == '<s>\n' + '\n'.join(HISTORY[2:]) + '\n<|assistant|>\n'
+    # Reserved tokens for the answer shrink the budget the same way
+    reserved = PromptBuilder(tokenizer, max_length=full_length + 9, reserve_tokens=10)
+    assert reserved.build(HISTORY) == (token_ids, True)
+
+
+def test_newest_user_turn_is_kept_even_when_nothing_else_fits(tokenizer):
+    long_question = '<|user|>\n' + 'word ' * 100
+    builder = PromptBuilder(tokenizer, max_length=60)
+    token_ids, truncated = builder.build(HISTORY + [long_question])
+    assert truncated
+    assert len(token_ids) == 60
+    # Only the tail of the oversized newest message survives
+    assert tokenizer.decode(token_ids).endswith('word word \n<|assistant|>\n')
+    builder = PromptBuilder(tokenizer, max_length=40)
+    token_ids, _ = builder.build(HISTORY[:4] + ['<|user|>\nShort'])
+    assert tokenizer.decode(token_ids) == '<s>\n<|user|>\nShort\n<|assistant|>\n'
+
+
+def test_each_message_is_tokenized_once(tokenizer):
+    counting = CountingTokenizer(tokenizer)
+    builder = PromptBuilder(counting, max_length=1000)
+    counting.encoded.clear()
+    first, _ = builder.build(HISTORY[:3])
+    assert counting.encoded == ['\n' + message for message in HISTORY[:3]]
+    counting.encoded.clear()
+    # The next turn only encodes its two new messages and extends the previous prompt
+    second, _ = builder.build(HISTORY)
+    assert counting.encoded == ['\n' + message for message in HISTORY[3:]]
+    assert second[:len(first) - len(builder.suffix_ids)] == first[:-len(builder.suffix_ids)]
+
+
+def test_least_recently_used_messages_leave_the_cache(tokenizer):
+    counting = CountingTokenizer(tokenizer)
+    builder = PromptBuilder(counting, max_length=1000, cache_size=2)
+    builder.encode_message('a')
+    builder.encode_message('b')
+    builder.encode_message('a')
+    builder.encode_message('c')
+    counting.encoded.clear()
+    builder.encode_message('a')
+    builder.encode_message('b')
+    assert counting.encoded == ['\nb']
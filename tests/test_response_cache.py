@@ -0,0 +1,100 @@
+import json
+import pytest
+import api.app as server
+from api.admission import CancelToken
+from api.response_cache import ResponseCache, make_key
+from utils.io import COMPLETE_MARKER, weights_version
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = ResponseCache(max_entries=4, ttl_seconds=10)
+    cache.put('a', [1, 2])
+    clock.now += 9
+    assert cache.get('a') == [1, 2]
+    clock.now += 2
+    assert cache.get('a') is None
+    assert cache.stats() == {'entries': 0, 'max_entries': 4, 'hits': 1, 'misses': 1}
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = ResponseCache(max_entries=2, ttl_seconds=10)
+    cache.put('a', [1])
+    cache.put('b', [2])
+    assert cache.get('a') == [1]
+    cache.put('c', [3])
+    assert cache.get('b') is None
+    assert cache.get('a') == [1]
+    assert cache.get('c') == [3]
+
+
+def test_persisted_entries_survive_a_restart_until_they_expire(clock, tmp_path):
+    path = str(tmp_path / 'responses')
+    cache = ResponseCache(max_entries=4, ttl_seconds=10, path=path)
+    cache.put('a', [1, 2])
+    cache.close()
+
+    cache = ResponseCache(max_entries=4, ttl_seconds=10, path=path)
+    assert cache.get('a') == [1, 2]
+    clock.now += 11
+    assert cache.get('a') is None
+    cache.close()
+
+
+def test_key_covers_prompt_and_parameters():
+    assert make_key([1, 2], {'model': 'm'}) == make_key([1, 2], {'model': 'm'})
+    assert make_key([1, 2], {'model': 'm'}) != make_key([1, 3], {'model': 'm'})
+    assert make_key([1, 2], {'model': 'm'}) != make_key([1, 2], {'model': 'other'})
+
+
+def test_weights_version_prefers_the_pushed_version(tmp_path):
+    (tmp_path / 'adapter_model.safetensors').write_bytes(b'weights')
+    fingerprint = weights_version(str(tmp_path))
+    (tmp_path / 'adapter_model.safetensors').write_bytes(b'new weights')
+    assert weights_version(str(tmp_path)) != fingerprint
+    (tmp_path / COMPLETE_MARKER).write_text(json.dumps({'version': 'v7'}))
+    assert weights_version(str(tmp_path)) == 'v7'
+
+
+@pytest.fixture
+def fresh_cache(client, monkeypatch):
+    cache = ResponseCache(max_entries=16, ttl_seconds=60)
+    monkeypatch.setattr(server, 'response_cache', cache)
+    return cache
+
+
+def ask(client, **fields):
+    payload = {'timestamp': 'now', 'content': ['<|user|>\nTell me something'], 'max_new_tokens': 6, **fields}
+    response = client.post('/api/v1/conversation', json=payload)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_greedy_answers_are_served_from_the_cache(client, fresh_cache):
+    first = ask(client)
+    assert ask(client) == first
+    assert fresh_cache.stats()['hits'] == 1
+
+
+def test_sampled_answers_are_never_cached(client, fresh_cache):
+    ask(client, temperature=0.8)
+    ask(client, temperature=0.8)
+    assert fresh_cache.stats() == {'entries': 0, 'max_entries': 16, 'hits': 0, 'misses': 0}
+
+
+def test_cut_short_answers_are_never_cached(client, fresh_cache, monkeypatch):
+    def expired(data):
+        token = CancelToken()
+        token.cancel('deadline')
+        return token
+
+    monkeypatch.setattr(server, 'request_deadline', expired)
+    assert ask(client)['finish_reason'] == 'deadline'
+    assert fresh_cache.stats()['entries'] == 0
+
+
+def test_new_model_version_misses_the_cache(client, fresh_cache, monkeypatch):
+    ask(client)
+    monkeypatch.setattr(server, 'model_identity', 'fp32:TinyLlama-1.1B-Chat-v1.2-merged@next')
+    ask(client)
+    assert fresh_cache.stats()['hits'] == 0
+    assert fresh_cache.stats()['entries'] == 2
@@ -0,0 +1,136 @@
+import threading
+import pytest
+import api.app as server
+from api.sessions import FileBackend, MemoryBackend, RedisBackend, SessionStore
+
+
+def turn(role, length):
+    return {'role': role, 'ids': list(range(length))}
+
+
+@pytest.fixture(params=['memory', 'file', 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        backend = MemoryBackend(max_sessions=2)
+    elif request.param == 'file':
+        backend = FileBackend(str(tmp_path / 'sessions'), max_sessions=2)
+    else:
+        fakeredis = pytest.importorskip('fakeredis')
+        backend = RedisBackend(fakeredis.FakeRedis())
+    yield backend
+    backend.close()
+
+
+def test_turns_are_appended_until_the_session_is_deleted(backend, clock):
+    store = SessionStore(backend, ttl_seconds=60, max_tokens=100)
+    session_id = store.create()
+    assert store.get(session_id) == []
+    assert store.append(session_id, [turn('user', 3), turn('assistant', 2)])
+    assert store.get(session_id) == [turn('user', 3), turn('assistant', 2)]
+    assert store.delete(session_id)
+    # An answer finishing after the DELETE must not bring the session back
+    assert not store.append(session_id, [turn('user', 1)])
+    assert store.get(session_id) is None
+    assert not store.append('never-created', [turn('user', 1)])
+    assert store.get('never-created') is None
+
+
+def test_client_chosen_ids_are_claimed_once(backend, clock):
+    store = SessionStore(backend, ttl_seconds=60)
+    assert store.create('conversation-1') == 'conversation-1'
+    assert store.create('conversation-1') is None
+    clock.now += 61
+    assert store.create('conversation-1') == 'conversation-1'
+
+
+def test_sessions_expire_after_their_ttl(backend, clock):
+    store = SessionStore(backend, ttl_seconds=60)
+    session_id = store.create()
+    clock.now += 50
+    # Every turn renews the TTL
+    assert store.append(session_id, [turn('user', 1)])
+    clock.now += 50
+    assert store.get(session_id) == [turn('user', 1)]
+    clock.now += 61
+    assert store.get(session_id) is None
+    assert not store.append(session_id, [turn('user', 1)])
+
+
+def test_whole_oldest_turns_are_trimmed(backend, clock):
+    store = SessionStore(backend, ttl_seconds=60, max_tokens=10)
+    session_id = store.create()
+    store.append(session_id, [turn('user', 4), turn('assistant', 4)])
+    store.append(session_id, [turn('user', 3)])
+    assert store.get(session_id) == [turn('assistant', 4), turn('user', 3)]
+    # A single turn longer than the budget is still kept, the prompt builder keeps its tail
+    store.append(session_id, [turn('assistant', 12)])
+    assert store.get(session_id) == [turn('assistant', 12)]
+
+
+def test_concurrent_appends_keep_every_turn(backend, clock):
+    store = SessionStore(backend, ttl_seconds=60, max_tokens=10000)
+    session_id = store.create()
+
+    def append_turns(role):
+        for _ in range(50):
+            assert store.append(session_id, [turn(role, 1)])
+
+    threads = [threading.Thread(target=append_turns, args=(f'role-{i}',)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    history = store.get(session_id)
+    assert len(history) == 200
+    assert sorted({t['role'] for t in history}) == ['role-0', 'role-1', 'role-2', 'role-3']
+
+
+def test_least_recently_used_session_is_evicted(clock):
+    store = SessionStore(MemoryBackend(max_sessions=2), ttl_seconds=60)
+    first, second = store.create(), store.create()
+    store.append(first, [turn('user', 1)])
+    third = store.create()
+    assert store.get(second) is None
+    assert store.get(first) == [turn('user', 1)]
+    assert store.get(third) == []
+    assert store.stats()['sessions'] == 2
+
+
+def test_file_sessions_survive_a_restart(tmp_path, clock):
+    path = str(tmp_path / 'sessions')
+    store = SessionStore(FileBackend(path, max_sessions=2), ttl_seconds=60)
+    session_id = store.create()
+    store.append(session_id, [turn('user', 2)])
+    store.close()
+    store = SessionStore(FileBackend(path, max_sessions=2), ttl_seconds=60)
+    assert store.get(session_id) == [turn('user', 2)]
+    clock.now += 61
+    assert store.get(session_id) is None
+    store.close()
+    assert FileBackend(path).size() == 0
+
+
+@pytest.fixture
+def fresh_sessions(client, monkeypatch):
+    store = SessionStore(MemoryBackend(), ttl_seconds=60, max_tokens=server.MAX_LENGTH)
+    monkeypatch.setattr(server, 'sessions', store)
+    return store
+
+
+def test_delete_during_generation_does_not_resurrect_the_session(client, fresh_sessions, monkeypatch):
+    session_id = client.post('/api/v1/sessions').json()['session_id']
+    body = {'timestamp': 'now', 'session_id': session_id, 'content': ['<|user|>\nHello'], 'max_new_tokens': 4}
+    assert client.post('/api/v1/conversation', json=body).status_code == 200
+    assert len(fresh_sessions.get(session_id)) == 2
+
+    build_prompt = server.build_prompt
+
+    def delete_after_prompt(data):
+        prompt = build_prompt(data)
+        # What DELETE /api/v1/conversation/{id} does while the answer is being generated
+        assert fresh_sessions.delete(session_id)
+        return prompt
+
+    monkeypatch.setattr(server, 'build_prompt', delete_after_prompt)
+    assert client.post('/api/v1/conversation', json=body).status_code == 200
+    assert fresh_sessions.get(session_id) is None
@@ -0,0 +1,47 @@
+import torch
+from api.generation import StopSequences
+from api.speculative import prompt_lookup_generate
+
+LETTERS = 'abcdefghij'
+
+
+class LetterTokenizer:
+    """Token id i decodes to the i-th letter"""
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return ''.join(LETTERS[i] for i in token_ids)
+
+
+class CountingModel:
+    """Greedy next token is always the current token plus one, modulo ten"""
+
+    device = torch.device('cpu')
+
+    def __call__(self, input_ids, **kwargs):
+        return type('Output', (), {'logits': torch.nn.functional.one_hot((input_ids + 1) % 10, 10).float()})
+
+
+class NullCache:
+    def get_seq_length(self):
+        return 0
+
+
+def test_find_looks_back_over_every_new_token():
+    stop = StopSequences(LetterTokenizer(), ['cd'])
+    token_ids = [3, 4, 5, 6, 7, 8, 9, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 0, 1]
+    assert stop.find(token_ids) is None
+    assert stop.find(token_ids, new_tokens=9) == 9
+    assert stop.truncate(token_ids) == token_ids[:9]
+
+
+def test_prompt_lookup_stops_inside_a_long_accepted_draft():
+    stop = StopSequences(LetterTokenizer(), ['cd'])
+    prompt_ids = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 0, 1, 2]
+
+    generated, stats = prompt_lookup_generate(
+        CountingModel(), prompt_ids, NullCache(), 0, max_new_tokens=40, eos_token_id=None,
+        num_draft=8, stop=stop)
+
+    # Each pass accepts all 8 drafted tokens, the stop string spans the boundary of two passes
+    assert LetterTokenizer().decode(generated) == 'defghijab'
+    assert stats['forward_passes'] == 3
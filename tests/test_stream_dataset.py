@@ -0,0 +1,64 @@
+import json
+import pytest
+
+pytest.importorskip('datasets')
+from components.stream_dataset import StreamingPackedDataset
+
+
+class ChatTemplate:
+    def apply_chat_template(self, messages, tokenize=False):
+        return '\n'.join(f"{message['role']}: {message['content']}" for message in messages)
+
+
+@pytest.fixture
+def shard(tmp_path):
+    path = tmp_path / 'train.jsonl'
+    with open(path, 'w') as f:
+        for i in range(40):
+            messages = [{'role': 'user', 'content': f'question {i} ' + 'x' * (i % 9)},
+                        {'role': 'assistant', 'content': f'answer {i} ' + 'y' * (i * 7 % 13)}]
+            f.write(json.dumps({'messages': messages}) + '\n')
+    return str(path)
+
+
+def stream(shard, tokenizer, start=(0, 0, 0)):
+    return StreamingPackedDataset([shard], tokenizer, ChatTemplate(), max_length=96, seed=3, shuffle_buffer=8,
+                                  prefetch=4, pack_window=6, start=start)
+
+
+def read_passes(dataset, passes):
+    """Sequences of the next ``passes`` iterations and the position after each of them"""
+    sequences, positions = [], []
+    for _ in range(passes):
+        for sequence in dataset:
+            sequences.append(sequence['input_ids'])
+            positions.append(dataset.position)
+    return sequences, positions
+
+
+def test_every_pass_reads_all_data_in_a_new_order(shard, tokenizer):
+    dataset = stream(shard, tokenizer)
+    first, first_positions = read_passes(dataset, 1)
+    second, second_positions = read_passes(dataset, 1)
+    # Windows hold other examples, so the sequences differ but their tokens do not
+    assert first != second
+    assert sorted(sum(first, [])) == sorted(sum(second, []))
+    assert first_positions[-1] == (0, 40, 0)
+    assert second_positions[-1] == (1, 40, 0)
+
+
+def test_resumed_stream_emits_the_suffix_of_an_uninterrupted_one(shard, tokenizer):
+    sequences, positions = read_passes(stream(shard, tokenizer), 3)
+    per_pass = len(sequences) // 3
+    for stopped in range(1, 2 * per_pass + 1):
+        # Positions come back from the checkpoint's JSON as lists
+        start = json.loads(json.dumps(positions[stopped - 1]))
+        resumed = stream(shard, tokenizer, start=start)
+        passes = 3 - start[0]
+        assert read_passes(resumed, passes)[0][:len(sequences) - stopped] == sequences[stopped:]
+
+
+def test_resume_from_a_two_part_position_starts_in_the_first_pass(shard, tokenizer):
+    sequences, positions = read_passes(stream(shard, tokenizer), 1)
+    epoch, example, sequence = positions[4]
+    assert read_passes(stream(shard, tokenizer, start=[example, sequence]), 1)[0] == sequences[5:]
@@ -1,5 +1,25 @@
-from pydantic import BaseModel
+from typing import Literal
+from pydantic import BaseModel, Field
 
 class Message(BaseModel):
     timestamp: str
     content: list[str]
+    # Continue a server-side session, content then holds only the new messages
+    session_id: str | None = None
+    # LoRA adapter to answer with when the API serves several, defaults to the first of ADAPTERS
+    adapter: str | None = None
+    # Set to false to skip the response cache for this request
+    use_cache: bool = True
+    # Opt into prompt-lookup speculative decoding, output is identical under greedy decoding
+    speculative: bool = False
+    # Generation controls, unset fields fall back to the server defaults
+    max_new_tokens: int | None = Field(default=None, ge=1)
+    # 0 decodes greedily, anything higher samples and bypasses the response cache
+    temperature: float = Field(default=0.0, ge=0.0, le=2.0)
+    top_p: float = Field(default=1.0, gt=0.0, le=1.0)
+    # Extra strings that end the answer, the chat template's role tags always do
+    stop: list[str] = Field(default_factory=list, max_length=8)
+    # Queued requests are admitted interactive first, then default, then batch
+    priority: Literal['interactive', 'default', 'batch'] = 'default'
+    # Seconds until the server gives up on the request, capped by REQUEST_TIMEOUT
+    timeout: float | None = Field(default=None, gt=0)
@@ -1,5 +1,12 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
 import os
+import threading
+import time
 
 bucket_name = "mausneg-mlops"
 s3_prefix = "saved_models"
@@ -10,15 +17,248 @@ s3 = boto3.client(
     aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
 )
 
-def download_dir(local_path, model_name):
+COMPLETE_MARKER = '_COMPLETE'
+MANIFEST_FILE = 'manifest.json'
+# Pushed versions: files stored once under objects/<sha256>, an immutable manifest per version
+# under versions/<id>/, and a LATEST pointer naming the current version
+OBJECTS_DIR = 'objects'
+VERSIONS_DIR = 'versions'
+LATEST_FILE = 'LATEST'
+STATE_FILE = '.download_state.json'
+MAX_WORKERS = int(os.environ.get("S3_MAX_WORKERS", 8))
+# Large weight files are fetched as concurrent ranged GETs
+transfer_config = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=64 * 1024 * 1024,
+    max_concurrency=8,
+)
+
+
+def write_json_atomic(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def is_download_complete(model_dir):
+    return os.path.exists(os.path.join(model_dir, COMPLETE_MARKER))
+
+
+def weights_version(model_dir):
+    """Pushed version recorded in the download marker, else a fingerprint of the local files"""
+    version = read_json(os.path.join(model_dir, COMPLETE_MARKER)).get('version')
+    if version:
+        return version
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(model_dir):
+        dirs.sort()
+        for file in sorted(files):
+            if file in (COMPLETE_MARKER, STATE_FILE) or file.endswith(('.part', '.part.json')):
+                continue
+            path = os.path.join(root, file)
+            stat = os.stat(path)
+            digest.update(f'{os.path.relpath(path, model_dir)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()[:16]
+
+
+def file_md5(path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_sha256(path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _remove_partial(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _download_range(client, obj, tmp_file, start, end, read_size=1024 * 1024):
+    # If-Match makes a changed object fail loudly instead of splicing two versions together
+    response = client.get_object(Bucket=bucket_name, Key=obj['Key'], Range=f'bytes={start}-{end}', IfMatch=obj['ETag'])
+    with open(tmp_file, 'r+b') as f:
+        f.seek(start)
+        for piece in response['Body'].iter_chunks(read_size):
+            f.write(piece)
+
+
+def _download_object(client, obj, local_file, sha256=None):
+    """Fetch ``obj`` as concurrent ranged GETs into ``local_file``.part, resuming the chunks a previous run finished"""
+    etag = obj['ETag'].strip('"')
+    tmp_file = f'{local_file}.part'
+    progress_path = f'{tmp_file}.json'
+    chunk_size = transfer_config.multipart_chunksize
+    chunks = [(start, min(start + chunk_size, obj['Size']) - 1) for start in range(0, obj['Size'], chunk_size)]
+
+    progress = read_json(progress_path)
+    if progress.get('etag') == obj['ETag'] and os.path.exists(tmp_file) and os.path.getsize(tmp_file) == obj['Size']:
+        done = set(progress.get('chunks', []))
+    else:
+        done = set()
+        with open(tmp_file, 'wb') as f:
+            f.truncate(obj['Size'])
+    lock = threading.Lock()
+
+    def fetch(index):
+        _download_range(client, obj, tmp_file, *chunks[index])
+        with lock:
+            done.add(index)
+            write_json_atomic(progress_path, {'etag': obj['ETag'], 'chunks': sorted(done)})
+
+    pending = [index for index in range(len(chunks)) if index not in done]
+    with ThreadPoolExecutor(max_workers=transfer_config.max_concurrency) as executor:
+        list(executor.map(fetch, pending))
+
+    try:
+        size = os.path.getsize(tmp_file)
+        if size != obj['Size']:
+            raise IOError(f"Size mismatch for {obj['Key']}: {size} != {obj['Size']}")
+        # Multipart ETags are not a plain MD5, those are checked by size only
+        if '-' not in etag and file_md5(tmp_file) != etag:
+            raise IOError(f"Checksum mismatch for {obj['Key']}")
+        if sha256 is not None and file_sha256(tmp_file) != sha256:
+            raise IOError(f"SHA-256 mismatch for {obj['Key']}")
+    except IOError:
+        # Nothing in a corrupt file is worth resuming
+        _remove_partial(tmp_file, progress_path)
+        raise
+    os.replace(tmp_file, local_file)
+    _remove_partial(progress_path)
+    return size
+
+
+def list_objects(client, prefix):
+    objects = []
+    paginator = client.get_paginator('list_objects_v2')
+    for result in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        objects.extend(result.get('Contents', []))
+    return objects
+
+
+def read_s3_json(client, key):
+    """JSON object at ``key``, None if there is none"""
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+
+def resolve_version(client, model_prefix):
+    """(version, manifest, [(relpath, object, sha256)]) of the version LATEST points to"""
+    latest = read_s3_json(client, f"{model_prefix}/{LATEST_FILE}")
+    if latest is None:
+        return None
+    version = latest['version']
+    manifest = read_s3_json(client, f"{model_prefix}/{VERSIONS_DIR}/{version}/{MANIFEST_FILE}")
+    if manifest is None:
+        raise FileNotFoundError(f"{model_prefix}/{LATEST_FILE} points to version {version} without a manifest")
+    stored = {obj['Key']: obj for obj in list_objects(client, f"{model_prefix}/{OBJECTS_DIR}/")}
+    files = []
+    for relpath, meta in manifest['files'].items():
+        key = f"{model_prefix}/{OBJECTS_DIR}/{meta['sha256']}"
+        if key not in stored:
+            raise FileNotFoundError(f"{key} of version {version} is missing from {bucket_name}")
+        files.append((relpath, stored[key], meta['sha256']))
+    return version, manifest, files
+
+
+def resolve_in_place(client, model_prefix):
+    """Files of a model pushed before versioning, uploaded in place under its prefix"""
+    objects = list_objects(client, f"{model_prefix}/")
+    if not objects:
+        raise FileNotFoundError(f"No objects found under {model_prefix}/ in {bucket_name}")
+    manifest = read_s3_json(client, f"{model_prefix}/{MANIFEST_FILE}")
+    checksums = {}
+    if manifest is not None:
+        checksums = {f"{model_prefix}/{relpath}": meta['sha256'] for relpath, meta in manifest['files'].items()}
+    return None, manifest, [
+        (os.path.relpath(obj['Key'], model_prefix), obj, checksums.get(obj['Key']))
+        for obj in objects
+        if obj['Key'] in checksums or manifest is None
+    ]
+
+
+def download_dir(local_path, model_name, client=None, max_workers=MAX_WORKERS):
+    client = client or s3
+    model_dir = os.path.join(local_path, model_name)
     print(f'[S3] Downloading model {model_name} to {local_path}')
-    os.makedirs(local_path, exist_ok=True)
-    paginator = s3.get_paginator('list_objects_v2')
-    for result in paginator.paginate(Bucket=bucket_name, Prefix=f"{s3_prefix}/{model_name}"):
-        if 'Contents' in result:
-            for key in result['Contents']:
-                s3_key = key['Key']
-                local_file = os.path.join(local_path, os.path.relpath(s3_key, s3_prefix))
-                os.makedirs(os.path.dirname(local_file), exist_ok=True)
-                s3.download_file(bucket_name, s3_key, local_file)
-    print(f'[S3] Download completed for model {model_name} to {local_path}')
\ No newline at end of file
+    os.makedirs(model_dir, exist_ok=True)
+    marker = os.path.join(model_dir, COMPLETE_MARKER)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+    # Only the version LATEST names is fetched, so a push in progress is never half-read
+    model_prefix = f"{s3_prefix}/{model_name}"
+    resolved = resolve_version(client, model_prefix)
+    version, manifest, files = resolved if resolved is not None else resolve_in_place(client, model_prefix)
+
+    # Skip files a previous attempt already finished with the same ETag and size
+    state_path = os.path.join(model_dir, STATE_FILE)
+    state = read_json(state_path)
+    pending = []
+    for relpath, obj, sha256 in files:
+        local_file = os.path.join(model_dir, relpath)
+        done = state.get(relpath)
+        if (done and done['etag'] == obj['ETag'] and os.path.exists(local_file)
+                and os.path.getsize(local_file) == obj['Size']):
+            continue
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        pending.append((relpath, obj, local_file, sha256))
+    print(f'[S3] {len(files) - len(pending)} of {len(files)} files already present')
+
+    start = time.perf_counter()
+    downloaded = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_download_object, client, obj, local_file, sha256): (relpath, obj)
+            for relpath, obj, local_file, sha256 in pending
+        }
+        for future in as_completed(futures):
+            relpath, obj = futures[future]
+            try:
+                downloaded += future.result()
+            except Exception as e:
+                print(f"[S3] Failed to download {obj['Key']} ({relpath}): {e}")
+                errors.append(e)
+                continue
+            # Record progress as files land so an interrupted run can resume
+            state[relpath] = {'etag': obj['ETag'], 'size': obj['Size']}
+            write_json_atomic(state_path, state)
+    if errors:
+        raise errors[0]
+
+    elapsed = time.perf_counter() - start
+    throughput = downloaded / elapsed / 1024 / 1024 if elapsed > 0 else 0.0
+    if manifest is not None:
+        write_json_atomic(os.path.join(model_dir, MANIFEST_FILE), manifest)
+    write_json_atomic(marker, {
+        'version': version,
+        'files': len(files),
+        'bytes': sum(obj['Size'] for _, obj, _ in files),
+    })
+    label = f'{model_name} version {version}' if version else model_name
+    print(f'[S3] Download completed for model {label} to {local_path}: '
+          f'{downloaded / 1024 / 1024:.1f} MB in {elapsed:.1f}s ({throughput:.1f} MB/s)')
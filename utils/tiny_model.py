@@ -0,0 +1,19 @@
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+
+def build_tiny_llama(vocab_size, seed=0):
+    """Random-weight Llama small enough to exercise the serving and training paths on CPU"""
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=2048,
+    )
+    model = LlamaForCausalLM(config)
+    model.eval()
+    return model